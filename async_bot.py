@@ -0,0 +1,372 @@
+import asyncio
+import logging
+import re
+
+import aiohttp
+import redis.asyncio
+import requests
+from environs import Env
+from telegram import Update
+from telegram.error import BadRequest
+from telegram.ext import Application, CallbackContext, CallbackQueryHandler, CommandHandler, MessageHandler, filters
+
+from async_strapi_api import AsyncStrapiClient
+from async_strapi_api import save_customer_email
+from catalog_cache import CatalogCache
+from chat_guard import ChatGuard
+from image_cache import ProductImageCache
+from metrics import Metrics, start_metrics
+from models_config import get_models_config
+from render_cache import RenderCache
+from resilience import CallGuard, CircuitBreaker, is_not_found
+from screens import EMPTY_CART_MARKUP, get_cart_text, render_cart_markup, render_menu_markup, render_product_card
+from session_store import AsyncRedisSessionStore
+from transitions import get_screen_id, show_photo_async, show_text_async
+from user_cache import add_product_to_cart_async, get_session_cart_async, get_user_customer_id_async
+from user_cache import load_user_cart_async, remove_ordered_product_from_cart_async, remove_product_from_cart_async
+
+logger = logging.getLogger(__name__)
+
+EMAIL_PATTERN = re.compile(r'[^@\s]+@[^@\s]+\.[^@\s]+')
+
+UNAVAILABLE_ERRORS = (requests.exceptions.ConnectionError, aiohttp.ClientConnectionError, asyncio.TimeoutError)
+"""Errors of STRAPI being down, `StrapiUnavailableError` of the circuit breaker is a `requests` error."""
+
+
+def main():
+    """Запускает бота на asyncio: python-telegram-bot 20, aiohttp и redis.asyncio."""
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    env = Env()
+    env.read_env()
+    tg_bot_token = env.str('TG_BOT_TOKEN')
+    admin_tg_ids = env.list('ADMIN_TG_IDS', [], subcast=int)
+    bot_mode = env.str('BOT_MODE', 'polling')
+
+    redis_db = redis.asyncio.Redis(host=env.str('REDIS_DB_HOST'),
+                                   port=env.int('REDIS_DB_PORT'),
+                                   password=env.str('REDIS_DB_PASSWORD'),
+                                   decode_responses=True)
+
+    application = (
+        Application.builder()
+        .token(tg_bot_token)
+        .concurrent_updates(env.int('ASYNC_CONCURRENT_UPDATES', 256))
+        .post_shutdown(close_bot_data)
+        .build()
+    )
+    init_bot_data(application.bot_data, env, redis_db)
+    start_metrics(application.bot_data['metrics'], env)
+    add_handlers(application, admin_tg_ids)
+
+    if bot_mode == 'webhook':
+        webhook_url = env.str('WEBHOOK_URL')
+        webhook_path = env.str('WEBHOOK_PATH', 'telegram')
+        application.run_webhook(listen=env.str('WEBHOOK_LISTEN', '0.0.0.0'),
+                                port=env.int('WEBHOOK_PORT', 8443),
+                                url_path=webhook_path,
+                                webhook_url=f'{webhook_url.rstrip("/")}/{webhook_path}',
+                                secret_token=env.str('WEBHOOK_SECRET'),
+                                max_connections=env.int('WEBHOOK_MAX_CONNECTIONS', 40))
+    else:
+        application.run_polling()
+
+
+def init_bot_data(bot_data: dict, env: Env, redis_db: redis.asyncio.Redis):
+    """Создаёт асинхронные клиенты CRM, кэши и хранилище сессий и кладёт их в bot_data.
+
+    Настройки те же, что у синхронного бота, но запросы к CRM и Redis не блокируют цикл событий.
+    """
+    strapi_token = env.str('STRAPI_TOKEN')
+    strapi_host = env.str('STRAPI_HOST', 'http://localhost:1337/')
+    strapi_connect_timeout = env.float('STRAPI_CONNECT_TIMEOUT', 3.05)
+    strapi_read_timeout = env.float('STRAPI_READ_TIMEOUT', 10)
+    strapi_async_pool_size = env.int('STRAPI_ASYNC_POOL_SIZE', 100)
+    strapi_max_concurrency = env.int('STRAPI_MAX_CONCURRENCY', strapi_async_pool_size)
+    strapi_rate_limit = env.float('STRAPI_RATE_LIMIT', None)
+    strapi_rate_burst = env.float('STRAPI_RATE_BURST', None)
+    strapi_acquire_timeout = env.float('STRAPI_ACQUIRE_TIMEOUT', 5)
+    strapi_breaker_failures = env.int('STRAPI_BREAKER_FAILURES', 5)
+    strapi_breaker_reset_timeout = env.float('STRAPI_BREAKER_RESET_TIMEOUT', 30)
+    catalog_ttl = env.float('CATALOG_TTL', 600)
+    catalog_max_details = env.int('CATALOG_MAX_DETAILS', 256)
+    catalog_page_size = env.int('CATALOG_PAGE_SIZE', 8)
+    image_cache_dir = env.str('IMAGE_CACHE_DIR', None)
+    redis_namespace = env.str('REDIS_NAMESPACE', 'fish_shop')
+    session_idle_ttl = env.int('SESSION_IDLE_TTL', 30 * 24 * 60 * 60)
+    dedup_window = env.float('DEDUP_WINDOW', 1.5)
+
+    models_config = get_models_config(env)
+    metrics = Metrics()
+    strapi_breaker = CircuitBreaker(failure_threshold=strapi_breaker_failures,
+                                    reset_timeout=strapi_breaker_reset_timeout)
+    strapi_guard = CallGuard(max_concurrency=strapi_max_concurrency,
+                             rate=strapi_rate_limit,
+                             burst=strapi_rate_burst,
+                             acquire_timeout=strapi_acquire_timeout,
+                             breaker=strapi_breaker)
+    async_strapi_client = AsyncStrapiClient(strapi_host,
+                                            strapi_token,
+                                            models_config,
+                                            pool_size=strapi_async_pool_size,
+                                            timeout=(strapi_connect_timeout, strapi_read_timeout),
+                                            metrics=metrics,
+                                            guard=strapi_guard)
+
+    bot_data['redis_db'] = redis_db
+    bot_data['metrics'] = metrics
+    bot_data['async_strapi_client'] = async_strapi_client
+    bot_data['models_config'] = models_config
+    bot_data['catalog'] = CatalogCache(None,
+                                       ttl=catalog_ttl,
+                                       max_details=catalog_max_details,
+                                       async_strapi_client=async_strapi_client)
+    bot_data['catalog_page_size'] = catalog_page_size
+    bot_data['render_cache'] = RenderCache(bot_data['catalog'], max_screens=2 * catalog_max_details)
+    bot_data['image_cache'] = ProductImageCache(None,
+                                                None,
+                                                cache_dir=image_cache_dir,
+                                                key_prefix=f'{redis_namespace}:tg_file_id',
+                                                async_redis_db=redis_db,
+                                                async_strapi_client=async_strapi_client)
+    bot_data['sessions'] = AsyncRedisSessionStore(redis_db,
+                                                  namespace=redis_namespace,
+                                                  idle_ttl=session_idle_ttl,
+                                                  metrics=metrics)
+    bot_data['chat_guard'] = ChatGuard(dedup_window=dedup_window)
+    metrics.register_gauges('strapi_guard', strapi_guard.stats)
+    metrics.register_gauges('catalog_cache', bot_data['catalog'].stats)
+    metrics.register_gauges('render_cache', bot_data['render_cache'].stats)
+    metrics.register_gauges('image_cache', bot_data['image_cache'].stats)
+    metrics.register_gauges('chat_guard', bot_data['chat_guard'].stats)
+
+
+async def close_bot_data(application: Application):
+    await application.bot_data['async_strapi_client'].close()
+    await application.bot_data['redis_db'].close()
+
+
+def add_handlers(application: Application, admin_tg_ids: list[int]):
+    application.add_handler(CommandHandler('reload_catalog', reload_catalog, filters=filters.User(user_id=admin_tg_ids)))
+    application.add_handler(CallbackQueryHandler(handle_users_reply))
+    application.add_handler(MessageHandler(filters.TEXT, handle_users_reply))
+    application.add_handler(CommandHandler('start', handle_users_reply))
+
+
+async def start(update: Update, context: CallbackContext, page: int = 1):
+    """Хэндлер для состояния START."""
+    catalog = context.bot_data['catalog']
+    page_size = context.bot_data['catalog_page_size']
+
+    async def render():
+        return render_menu_markup(*await catalog.get_products_page_async(page, page_size))
+
+    reply_markup = await context.bot_data['render_cache'].get_async(('menu', page, page_size), render)
+    text = 'Привет! Выбери товар.' if update.message else 'Выбрать товар или посмотреть корзину.'
+    await show_text_async(update, text, reply_markup=reply_markup, metrics=context.bot_data['metrics'])
+    return 'HANDLE_MENU'
+
+
+async def cart(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
+
+    user_cart = await load_user_cart_async(context.bot_data['async_strapi_client'],
+                                           context.bot_data['sessions'],
+                                           context.session)
+    ordered_products = user_cart['ordered_products']
+    metrics = context.bot_data['metrics']
+    if not ordered_products:
+        await show_text_async(update, 'Ваша корзина пуста.', reply_markup=EMPTY_CART_MARKUP, metrics=metrics)
+        return 'HANDLE_CART'
+
+    await show_text_async(update,
+                          get_cart_text(user_cart),
+                          reply_markup=render_cart_markup(ordered_products),
+                          metrics=metrics)
+    return 'HANDLE_CART'
+
+
+async def select_cart_item(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
+    if query.data == 'cancel':
+        return await start(update, context)
+    if query.data.startswith('remove_product'):
+        product_id = query.data.split(';')[1]
+        if product_id.isdigit():
+            await remove_product_from_cart_async(context.bot_data['async_strapi_client'],
+                                                 context.bot_data['sessions'],
+                                                 context.session,
+                                                 int(product_id))
+        return await cart(update, context)
+    if query.data.startswith('remove_item'):
+        await remove_ordered_product_from_cart_async(context.bot_data['async_strapi_client'],
+                                                     context.bot_data['sessions'],
+                                                     context.session,
+                                                     query.data.split(';')[1])
+        return await cart(update, context)
+    if query.data == 'payment':
+        return await request_an_email(update, context)
+
+
+async def request_an_email(update: Update, context: CallbackContext):
+    await show_text_async(update, 'Для оплаты введите Ваш адрес электронной почты.', metrics=context.bot_data['metrics'])
+    return 'WAITING_EMAIL'
+
+
+async def process_email(update: Update, context: CallbackContext):
+    strapi_client = context.bot_data['async_strapi_client']
+    users_email = update.message.text
+    sessions = context.bot_data['sessions']
+    try:
+        customer_id = await get_user_customer_id_async(strapi_client, sessions, context.session)
+        try:
+            await save_customer_email(strapi_client, customer_id, users_email)
+        except aiohttp.ClientResponseError as error:
+            if not is_not_found(error):
+                raise
+            await sessions.delete_field(context.session, 'customer_id')
+            customer_id = await get_user_customer_id_async(strapi_client, sessions, context.session)
+            await save_customer_email(strapi_client, customer_id, users_email)
+        await update.message.reply_text('Заказ принят! Ожидайте обращения нашего менеджера на Ваш e-mail!')
+        return await start(update, context)
+    except aiohttp.ClientResponseError:
+        await update.message.reply_text('E-mail введён некорректно! Повторите ввод.')
+        return 'WAITING_EMAIL'
+
+
+async def select_menu_item(update: Update, context: CallbackContext):
+    image_cache = context.bot_data['image_cache']
+
+    query = update.callback_query
+    if query.data == 'cart':
+        return await cart(update, context)
+    await query.answer()
+    if query.data.startswith('menu_page'):
+        return await start(update, context, page=int(query.data.split(';')[1]))
+
+    catalog = context.bot_data['catalog']
+
+    async def render():
+        return render_product_card(query.data, await catalog.get_product_detail_async(query.data))
+
+    product_card = await context.bot_data['render_cache'].get_async(('product', query.data), render)
+    image = product_card['image']
+    caption = product_card['caption']
+    reply_markup = product_card['reply_markup']
+    photo = await image_cache.get_photo_async(query.data, image)
+
+    metrics = context.bot_data['metrics']
+    try:
+        with metrics.track_call('telegram_send_photo', {'source': 'file_id' if isinstance(photo, str) else 'upload'}):
+            message = await show_photo_async(update, photo, caption, reply_markup=reply_markup, metrics=metrics)
+    except BadRequest:
+        if not isinstance(photo, str):
+            raise
+        await image_cache.forget_async(query.data, image)
+        photo = await image_cache.get_photo_async(query.data, image)
+        with metrics.track_call('telegram_send_photo', {'source': 'upload'}):
+            message = await show_photo_async(update, photo, caption, reply_markup=reply_markup, metrics=metrics)
+    if not isinstance(photo, str):
+        await image_cache.remember_async(query.data, image, message)
+    return 'HANDLE_DESCRIPTION'
+
+
+async def detail_result(update: Update, context: CallbackContext):
+    query = update.callback_query
+    if query.data == 'cancel':
+        await query.answer()
+        return await start(update, context)
+    elif query.data == 'cart':
+        await query.answer()
+        return await cart(update, context)
+    elif query.data.startswith('add_to_cart'):
+        await query.answer()
+        product_id = int(query.data.split(';')[1])
+        strapi_client = context.bot_data['async_strapi_client']
+        sessions = context.bot_data['sessions']
+        # Карточка товара и корзина, которой нет в сессии, загружаются одновременно
+        product_detail, _ = await asyncio.gather(
+            context.bot_data['catalog'].get_product_detail_async(product_id),
+            get_session_cart_async(strapi_client, sessions, context.session),
+        )
+        await add_product_to_cart_async(strapi_client,
+                                        sessions,
+                                        context.session,
+                                        product_id,
+                                        product_detail['Title'],
+                                        product_detail['Price'])
+        return await start(update, context)
+
+
+async def reload_catalog(update: Update, context: CallbackContext):
+    """Админская команда /reload_catalog: сбрасывает кэш каталога и загружает его заново."""
+    catalog = context.bot_data['catalog']
+    products = await catalog.refresh_async()
+    stats = catalog.stats()
+    await update.message.reply_text(f'Каталог обновлён, товаров: {len(products)}.\n'
+                                    f'Попаданий в кэш: {stats["hits"]}, промахов: {stats["misses"]}.')
+
+
+async def handle_users_reply(update: Update, context: CallbackContext):
+    """То же, что `bot.handle_users_reply`, для asyncio.
+
+    Обновления одного чата обрабатываются по очереди в порядке поступления,
+    разных чатов — одновременно, пока хэндлеры ждут ответа CRM, Redis или Telegram.
+    """
+    chat_guard = context.bot_data['chat_guard']
+    if update.message:
+        user_reply = update.message.text
+        chat_id = update.message.chat_id
+    elif update.callback_query:
+        user_reply = update.callback_query.data
+        chat_id = update.callback_query.message.chat_id
+        message = update.callback_query.message
+        if chat_guard.is_duplicate(chat_id, message.message_id, user_reply, get_screen_id(message)):
+            await update.callback_query.answer()
+            return
+    else:
+        return
+    async with chat_guard.lock_async(chat_id):
+        await process_users_reply(update, context, chat_id, user_reply)
+
+
+async def process_users_reply(update: Update, context: CallbackContext, chat_id: int, user_reply: str):
+    sessions = context.bot_data['sessions']
+    session = await sessions.load(chat_id)
+    context.session = session
+    states_functions = {
+        'START': start,
+        'HANDLE_MENU': select_menu_item,
+        'HANDLE_DESCRIPTION': detail_result,
+        'HANDLE_CART': select_cart_item,
+        'WAITING_EMAIL': process_email
+    }
+    if user_reply == '/start':
+        user_state = 'START'
+    else:
+        user_state = session.get('state', 'START')
+    if user_state not in states_functions:
+        user_state = 'START'
+    state_handler = states_functions[user_state]
+
+    metrics = context.bot_data['metrics']
+    try:
+        with metrics.timer('bot_handler_seconds', {'handler': state_handler.__name__}):
+            next_state = await state_handler(update, context)
+        if next_state is not None:
+            session.set('state', next_state)
+        await sessions.save(session)
+    except UNAVAILABLE_ERRORS as err:
+        metrics.inc('bot_handler_unavailable_total', {'handler': state_handler.__name__})
+        logger.warning('CRM is unavailable: %s', err)
+        message = update.message or update.callback_query.message
+        await message.reply_text('Магазин временно недоступен, попробуйте через минуту.')
+    except Exception as err:
+        metrics.inc('bot_handler_errors_total', {'handler': state_handler.__name__})
+        logger.exception(err)
+        raise err
+
+
+if __name__ == '__main__':
+    main()
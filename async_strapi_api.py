@@ -0,0 +1,350 @@
+import asyncio
+import posixpath
+import threading
+from collections import deque
+from concurrent.futures import Future
+from decimal import Decimal
+from io import BytesIO
+from typing import AsyncIterator
+from urllib.parse import urljoin
+
+import aiohttp
+
+from metrics import Metrics
+from resilience import CallGuard
+from strapi_api import QUERY_PROFILES
+from strapi_api import compile_query_profile, get_page_params
+
+
+class AsyncStrapiClient:
+    """Non-blocking STRAPI client with a pooled aiohttp session.
+
+    Session is created lazily inside the running event loop,
+    so the client may be constructed outside of it.
+    Concurrency and rate are limited by the guard, its circuit breaker fails calls fast while STRAPI is down.
+
+    Args:
+        hostname(str): STRAPI host url
+        api_token(str): STRAPI Token
+        models_config(dict): STRAPI models names
+        pool_size(int): Max number of simultaneous connections to STRAPI.
+        timeout(float | tuple): Connect and read timeouts in seconds.
+        metrics(Metrics): Registry for call counts, latencies and status codes of STRAPI endpoints.
+        guard(CallGuard): Concurrency and rate limits with circuit breaker, usually shared with `StrapiClient`.
+        By default calls are limited by pool size.
+    """
+
+    def __init__(self,
+                 hostname: str,
+                 api_token: str,
+                 models_config: dict,
+                 pool_size: int = 100,
+                 timeout: float | tuple = (3.05, 10),
+                 metrics: Metrics = None,
+                 guard: CallGuard = None):
+        self.hostname = hostname
+        self.metrics = metrics or Metrics()
+        self.guard = guard or CallGuard(max_concurrency=pool_size)
+        self.models_config = models_config
+        self.pool_size = pool_size
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self._headers = {'Authorization': f'bearer {api_token}'}
+        self._session = None
+        self._profiles_params = {}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    def get_api_url(self, model_plural_key: str, *path) -> str:
+        model_plural = self.models_config[model_plural_key]
+        api_hand = posixpath.join('/api/', model_plural, *map(str, path))
+        return urljoin(self.hostname, api_hand)
+
+    def get_profile_params(self, profile: str) -> dict:
+        if profile not in self._profiles_params:
+            self._profiles_params[profile] = compile_query_profile(QUERY_PROFILES[profile], self.models_config)
+        return self._profiles_params[profile]
+
+    async def request(self,
+                      method: str,
+                      model_plural_key: str,
+                      *path,
+                      profile: str = None,
+                      params: dict = None,
+                      **kwargs) -> dict:
+        """Make request to STRAPI REST API and return decoded JSON.
+
+        Same as `StrapiClient.request`, params are encoded the way `requests` does it.
+        """
+        api_url = self.get_api_url(model_plural_key, *path)
+        if profile:
+            params = {**self.get_profile_params(profile), **(params or {})}
+        endpoint = posixpath.join('/api/', self.models_config[model_plural_key], ':id' if path else '')
+        labels = {'method': method, 'endpoint': endpoint}
+        async with self.guard.call_async():
+            with self.metrics.track_call('strapi_request', labels) as call:
+                async with self.session.request(method,
+                                                api_url,
+                                                headers=self._headers,
+                                                params=encode_params(params),
+                                                **kwargs) as response:
+                    call['status'] = response.status
+                    response.raise_for_status()
+                    return await response.json(content_type=None)
+
+    async def get_file(self, file_url: str) -> bytes:
+        full_file_url = urljoin(self.hostname, file_url)
+        labels = {'method': 'GET', 'endpoint': 'file'}
+        async with self.guard.call_async():
+            with self.metrics.track_call('strapi_request', labels) as call:
+                async with self.session.get(full_file_url) as response:
+                    call['status'] = response.status
+                    response.raise_for_status()
+                    return await response.read()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+def encode_params(params: dict = None) -> list[tuple]:
+    """Encode query params like `requests` does: skip None values and repeat keys for lists."""
+    encoded_params = []
+    for key, value in (params or {}).items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        encoded_params += [(key, str(item)) for item in values if item is not None]
+    return encoded_params
+
+
+class AsyncRunner:
+    """Event loop running in a background thread.
+
+    Lets synchronous code, e.g. prewarm and catalog prefetch,
+    run coroutines and issue independent STRAPI calls concurrently.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='async-runner', daemon=True)
+        self._thread.start()
+
+    def submit(self, coroutine) -> Future:
+        """Schedule coroutine without waiting for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine, timeout: float = None):
+        """Run coroutine and wait for its result."""
+        return self.submit(coroutine).result(timeout)
+
+    def gather(self, *coroutines, timeout: float = None) -> list:
+        """Run coroutines concurrently and wait for all results."""
+        async def gather_all():
+            return await asyncio.gather(*coroutines)
+        return self.run(gather_all(), timeout)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+async def get_entries_page(strapi_client: AsyncStrapiClient,
+                           model_plural_key: str,
+                           profile: str,
+                           page: int = 1,
+                           page_size: int = 100) -> tuple[list[dict], dict]:
+    response = await strapi_client.request('GET',
+                                           model_plural_key,
+                                           profile=profile,
+                                           params=get_page_params(page, page_size))
+    return response['data'], response['meta']['pagination']
+
+
+async def iter_entries(strapi_client: AsyncStrapiClient,
+                       model_plural_key: str,
+                       profile: str,
+                       page_size: int = 100,
+                       prefetch: int = 4) -> AsyncIterator[dict]:
+    """Iterate over all entries of the model in ID order, page by page.
+
+    Up to `prefetch` next pages are fetched concurrently while the current one is consumed,
+    so no more than `prefetch + 1` pages are kept in memory.
+
+    Args:
+        strapi_client(AsyncStrapiClient): STRAPI client
+        model_plural_key(str): Key of the model in models config, e.g. `strapi_cart_name_plural`
+        profile(str): Name of the query profile selecting fields and relations of entries.
+        page_size(int): Number of entries in a page.
+        prefetch(int): Number of pages fetched ahead.
+    """
+    entries, pagination = await get_entries_page(strapi_client, model_plural_key, profile, 1, page_size)
+    pages = iter(range(2, pagination['pageCount'] + 1))
+    pending = deque()
+
+    def fetch_next_page():
+        page = next(pages, None)
+        if page is not None:
+            pending.append(asyncio.ensure_future(
+                get_entries_page(strapi_client, model_plural_key, profile, page, page_size)
+            ))
+
+    for _ in range(prefetch):
+        fetch_next_page()
+    try:
+        while True:
+            for entry in entries:
+                yield entry
+            if not pending:
+                return
+            entries, _ = await pending.popleft()
+            fetch_next_page()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def get_products_page(strapi_client: AsyncStrapiClient,
+                            page: int = 1,
+                            page_size: int = 10) -> tuple[list[dict], dict]:
+    response = await strapi_client.request('GET',
+                                           'strapi_product_name_plural',
+                                           profile='product_title',
+                                           params=get_page_params(page, page_size))
+    return response['data'], response['meta']['pagination']
+
+
+async def get_products(strapi_client: AsyncStrapiClient, page_size: int = 100) -> list[dict]:
+    """Get all products with titles only, rest of pages are fetched concurrently."""
+    products, pagination = await get_products_page(strapi_client, page_size=page_size)
+    pages = await asyncio.gather(*[
+        get_products_page(strapi_client, page, page_size) for page in range(2, pagination['pageCount'] + 1)
+    ])
+    for page_products, _ in pages:
+        products += page_products
+    return products
+
+
+async def get_product_detail(strapi_client: AsyncStrapiClient,
+                             product_id: int | str,
+                             with_img: bool = True) -> dict:
+    profile = 'product_detail' if with_img else 'product_detail_without_image'
+    response = await strapi_client.request('GET', 'strapi_product_name_plural', product_id, profile=profile)
+    return response['data']['attributes']
+
+
+async def get_product_img(strapi_client: AsyncStrapiClient, img_url: str) -> BytesIO:
+    image = BytesIO(await strapi_client.get_file(img_url))
+    return image
+
+
+async def get_or_create_cart(strapi_client: AsyncStrapiClient, user_id: int | str) -> dict:
+    params = {
+        'filters[user_tg_id][$eq]': user_id
+    }
+    response = await strapi_client.request('GET', 'strapi_cart_name_plural', profile='cart', params=params)
+    carts = response['data']
+    if carts:
+        return carts[0]
+    new_cart = {
+        'data': {
+            'user_tg_id': user_id
+        }
+    }
+    create_response = await strapi_client.request('POST', 'strapi_cart_name_plural', profile='cart', json=new_cart)
+    return create_response['data']
+
+
+async def get_cart(strapi_client: AsyncStrapiClient, cart_id: int | str) -> dict:
+    """Get cart by ID populated with ordered products and their product titles."""
+    response = await strapi_client.request('GET', 'strapi_cart_name_plural', cart_id, profile='cart')
+    return response['data']
+
+
+async def create_ordered_product(strapi_client: AsyncStrapiClient,
+                                 product_id: int | str,
+                                 cart_id: int | str = None,
+                                 amount: float = 1.0,
+                                 fixed_price: Decimal = None) -> dict:
+    """Same as `strapi_api.create_ordered_product`."""
+    if not fixed_price:
+        product = await get_product_detail(strapi_client, product_id, with_img=False)
+        fixed_price = product['Price']
+    new_ordered_product = {
+        'data': {
+            'product': {
+                'connect': [product_id, ]
+            },
+            'cart': {
+                'connect': [cart_id, ]
+            },
+            'amount': amount,
+            'fixed_price': fixed_price,
+        }
+    }
+    create_response = await strapi_client.request('POST',
+                                                  'strapi_ordered_product_name_plural',
+                                                  profile='ordered_product',
+                                                  json=new_ordered_product)
+    return create_response['data']
+
+
+async def remove_ordered_product(strapi_client: AsyncStrapiClient, product_id: int | str):
+    response = await strapi_client.request('DELETE', 'strapi_ordered_product_name_plural', product_id)
+    return response
+
+
+async def update_ordered_product_amount(strapi_client: AsyncStrapiClient,
+                                        ordered_product_id: int | str,
+                                        amount: float) -> dict:
+    update_json = {
+        'data': {
+            'amount': amount,
+        }
+    }
+    response = await strapi_client.request('PUT',
+                                           'strapi_ordered_product_name_plural',
+                                           ordered_product_id,
+                                           profile='ordered_product',
+                                           json=update_json)
+    return response['data']
+
+
+async def get_or_create_customer(strapi_client: AsyncStrapiClient, user_tg_id: int | str) -> dict:
+    params = {
+        'filters[telegram_id][$eq]': user_tg_id
+    }
+    response = await strapi_client.request('GET', 'strapi_customer_name_plural', profile='customer', params=params)
+    users = response['data']
+    if users:
+        return users[0]
+    new_customer = {
+        'data': {
+            'telegram_id': user_tg_id,
+        }
+    }
+    create_response = await strapi_client.request('POST',
+                                                  'strapi_customer_name_plural',
+                                                  profile='customer',
+                                                  json=new_customer)
+    return create_response['data']
+
+
+async def save_customer_email(strapi_client: AsyncStrapiClient,
+                              customer_id: int | str,
+                              email: str):
+    update_json = {
+        'data': {
+            'email': email,
+        }
+    }
+    response = await strapi_client.request('PUT',
+                                           'strapi_customer_name_plural',
+                                           customer_id,
+                                           profile='customer',
+                                           json=update_json)
+    return response['data']
@@ -0,0 +1,313 @@
+"""Offline benchmark of the bot with fake STRAPI, Redis and Telegram.
+
+Replays user journeys start → product → add to cart → cart → payment → email
+through `handle_users_reply` and reports throughput, handler latencies
+and STRAPI calls per journey.
+
+Examples:
+    python benchmark.py --users 50 --journeys 5 --strapi-latency 0.01
+    python benchmark.py --json > baseline.json
+    python benchmark.py --baseline baseline.json --max-regression 0.2
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import count
+from types import SimpleNamespace
+
+from environs import Env
+
+from bot import close_bot_data, handle_users_reply, init_bot_data
+from fakes import FakeRedis, FakeStrapi
+from prewarm import prewarm
+
+
+class FakeTelegram:
+    """Records Telegram API calls made by handlers instead of sending them.
+
+    Args:
+        latency(float): Delay of every API call in seconds.
+    """
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._message_ids = count(1)
+
+    def call(self,
+             method: str,
+             chat_id: int,
+             text: str = None,
+             photo: bool = False,
+             message: 'FakeMessage' = None) -> 'FakeMessage':
+        """Record the call and return the sent message or the edited one."""
+        time.sleep(self.latency)
+        with self._lock:
+            self.calls[method] += 1
+            message_id = next(self._message_ids)
+        return message or FakeMessage(self, chat_id, message_id, text=text, photo=photo)
+
+
+class FakeMessage:
+    def __init__(self, telegram: FakeTelegram, chat_id: int, message_id: int, text: str = None, photo: bool = False):
+        self.telegram = telegram
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.caption = None
+        self.reply_markup = None
+        self.edit_date = None
+        self.photo = [SimpleNamespace(file_id=f'file-{message_id}')] if photo else []
+
+    def reply_text(self, text: str, reply_markup=None, **kwargs) -> 'FakeMessage':
+        message = self.telegram.call('sendMessage', self.chat_id, text=text)
+        message.reply_markup = reply_markup
+        return message
+
+    def reply_photo(self, photo, caption: str = None, reply_markup=None, **kwargs) -> 'FakeMessage':
+        method = 'sendPhoto(file_id)' if isinstance(photo, str) else 'sendPhoto(upload)'
+        message = self.telegram.call(method, self.chat_id, photo=True)
+        message.caption = caption
+        message.reply_markup = reply_markup
+        return message
+
+
+class FakeCallbackQuery:
+    def __init__(self, message: FakeMessage, data: str):
+        self.message = message
+        self.data = data
+
+    def answer(self, *args, **kwargs):
+        self.message.telegram.call('answerCallbackQuery', self.message.chat_id)
+
+    def delete_message(self, *args, **kwargs):
+        self.message.telegram.call('deleteMessage', self.message.chat_id)
+
+    def edit_message_text(self, text: str, reply_markup=None, **kwargs) -> FakeMessage:
+        message = self.message.telegram.call('editMessageText', self.message.chat_id, message=self.message)
+        message.text = text
+        message.reply_markup = reply_markup
+        message.edit_date = datetime.now()
+        return message
+
+    def edit_message_media(self, media, reply_markup=None, **kwargs) -> FakeMessage:
+        method = 'editMessageMedia(file_id)' if isinstance(media.media, str) else 'editMessageMedia(upload)'
+        message = self.message.telegram.call(method, self.message.chat_id, message=self.message)
+        message.photo = [SimpleNamespace(file_id=f'file-{message.message_id}-{time.monotonic_ns()}')]
+        message.caption = media.caption
+        message.reply_markup = reply_markup
+        message.edit_date = datetime.now()
+        return message
+
+
+def send_message(telegram: FakeTelegram, chat_id: int, text: str) -> SimpleNamespace:
+    message = FakeMessage(telegram, chat_id, 0, text=text)
+    return SimpleNamespace(message=message, callback_query=None, effective_chat=SimpleNamespace(id=chat_id))
+
+
+def tap_button(message: FakeMessage, callback_data: str) -> SimpleNamespace:
+    callback_query = FakeCallbackQuery(message, callback_data)
+    return SimpleNamespace(message=None, callback_query=callback_query, effective_chat=SimpleNamespace(id=message.chat_id))
+
+
+class JourneyRunner:
+    """Replays user journeys through `handle_users_reply` and records step latencies."""
+
+    def __init__(self, bot_data: dict, telegram: FakeTelegram, products_count: int):
+        self.bot_data = bot_data
+        self.telegram = telegram
+        self.products_count = products_count
+        self.latencies = defaultdict(list)
+        self.updates = 0
+        self._lock = threading.Lock()
+
+    def step(self, name: str, update: SimpleNamespace) -> FakeMessage:
+        """Process update and return the last message bot sent to the chat or edited."""
+        chat_id = update.effective_chat.id
+        sent_messages = []
+        original_call = self.telegram.call
+
+        def call(method, message_chat_id, **kwargs):
+            message = original_call(method, message_chat_id, **kwargs)
+            if method.startswith(('send', 'edit')):
+                sent_messages.append(message)
+            return message
+
+        context = SimpleNamespace(bot_data=self.bot_data)
+        for message in (update.message, update.callback_query and update.callback_query.message):
+            if message:
+                message.telegram = SimpleNamespace(call=call)
+        started_at = time.perf_counter()
+        handle_users_reply(update, context)
+        elapsed = time.perf_counter() - started_at
+        with self._lock:
+            self.latencies[name].append(elapsed)
+            self.updates += 1
+        if not sent_messages:
+            raise RuntimeError(f'Bot sent nothing to chat {chat_id} on step {name}')
+        last_message = sent_messages[-1]
+        last_message.telegram = self.telegram
+        return last_message
+
+    def run_journey(self, chat_id: int, journey_number: int):
+        product_id = (chat_id + journey_number) % self.products_count + 1
+        menu = self.step('start', send_message(self.telegram, chat_id, '/start'))
+        product_card = self.step('product', tap_button(menu, str(product_id)))
+        menu = self.step('add', tap_button(product_card, f'add_to_cart;{product_id}'))
+        cart = self.step('cart', tap_button(menu, 'cart'))
+        self.step('payment', tap_button(cart, 'payment'))
+        self.step('email', send_message(self.telegram, chat_id, f'user{chat_id}@example.com'))
+
+
+def run_benchmark(users: int = 20,
+                  journeys: int = 5,
+                  products_count: int = 40,
+                  strapi_latency: float = 0.005,
+                  telegram_latency: float = 0,
+                  image_size: int = 200_000,
+                  write_behind: bool = False,
+                  prewarm_caches: bool = False) -> dict:
+    fake_strapi = FakeStrapi(products_count, latency=strapi_latency, image_size=image_size)
+    os.environ['STRAPI_HOST'] = fake_strapi.start()
+    os.environ['STRAPI_TOKEN'] = 'benchmark'
+    os.environ['WRITE_BEHIND'] = str(write_behind).lower()
+    fake_redis = FakeRedis()
+    telegram = FakeTelegram(latency=telegram_latency)
+    bot_data = {}
+    init_bot_data(bot_data, Env(), fake_redis)
+    prewarm_durations = prewarm(bot_data) if prewarm_caches else {}
+    fake_strapi.calls.clear()
+    runner = JourneyRunner(bot_data, telegram, products_count)
+
+    def run_user(chat_id: int):
+        for journey_number in range(journeys):
+            runner.run_journey(chat_id, journey_number)
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as executor:
+        list(executor.map(run_user, range(1, users + 1)))
+    elapsed = time.perf_counter() - started_at
+    caches = {name: bot_data[name].stats() for name in ('catalog', 'image_cache', 'render_cache')}
+    if bot_data['write_behind']:
+        while any(bot_data['write_behind'].stats()[state] for state in ('pending', 'processing')):
+            time.sleep(0.05)
+    close_bot_data(bot_data)
+    fake_strapi.stop()
+
+    journeys_count = users * journeys
+    return {
+        'updates': runner.updates,
+        'seconds': elapsed,
+        'updates_per_second': runner.updates / elapsed,
+        'latencies': {
+            name: {
+                'p50': statistics.median(latencies),
+                'p99': percentile(latencies, 99),
+            } for name, latencies in runner.latencies.items()
+        },
+        'strapi_calls_per_journey': sum(fake_strapi.calls.values()) / journeys_count,
+        'strapi_calls': dict(fake_strapi.calls),
+        'redis_commands_per_journey': fake_redis.commands / journeys_count,
+        'telegram_calls': dict(telegram.calls),
+        'prewarm': prewarm_durations,
+        'caches': caches,
+    }
+
+
+def percentile(values: list[float], percent: float) -> float:
+    ordered_values = sorted(values)
+    return ordered_values[min(len(ordered_values) - 1, int(len(ordered_values) * percent / 100))]
+
+
+def compare_reports(report: dict, baseline: dict, max_regression: float = 0.2) -> list[str]:
+    """Find metrics which got worse than in the baseline report by more than `max_regression` share.
+
+    Throughput should not fall, p99 latencies of steps and STRAPI and Redis calls per journey should not grow.
+
+    Return:
+        list: Descriptions of regressed metrics, empty if there are none
+    """
+    compared_metrics = [
+        ('updates_per_second', report['updates_per_second'], baseline['updates_per_second'], -1),
+        ('strapi_calls_per_journey', report['strapi_calls_per_journey'], baseline['strapi_calls_per_journey'], 1),
+        ('redis_commands_per_journey', report['redis_commands_per_journey'], baseline['redis_commands_per_journey'], 1),
+    ]
+    for name, latency in report['latencies'].items():
+        if name in baseline['latencies']:
+            compared_metrics.append((f'{name} p99', latency['p99'], baseline['latencies'][name]['p99'], 1))
+    regressions = []
+    for name, value, baseline_value, worse_direction in compared_metrics:
+        if not baseline_value:
+            continue
+        change = (value - baseline_value) / baseline_value
+        if change * worse_direction > max_regression:
+            regressions.append(f'{name}: {value:.4g} against {baseline_value:.4g} in baseline ({change:+.0%})')
+    return regressions
+
+
+def print_report(report: dict):
+    print(f'Updates: {report["updates"]} in {report["seconds"]:.2f} s, {report["updates_per_second"]:.1f} updates/s')
+    print(f'STRAPI calls per journey: {report["strapi_calls_per_journey"]:.2f}')
+    print(f'Redis commands per journey: {report["redis_commands_per_journey"]:.2f}')
+    if report['prewarm']:
+        print(f'Prewarm: {report["prewarm"]["total"]:.2f} s')
+    print('Cache hit ratio: ' + ', '.join(f'{name} {stats["hit_ratio"]:.0%}' for name, stats in report['caches'].items()))
+    print('Handler latency, ms:')
+    for name, latency in report['latencies'].items():
+        print(f'  {name:<10} p50 {latency["p50"] * 1000:8.2f}   p99 {latency["p99"] * 1000:8.2f}')
+    print('STRAPI calls:')
+    for endpoint, calls in sorted(report['strapi_calls'].items()):
+        print(f'  {endpoint:<40} {calls}')
+    print('Telegram calls:')
+    for method, calls in sorted(report['telegram_calls'].items()):
+        print(f'  {method:<40} {calls}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the bot with fake STRAPI, Redis and Telegram')
+    parser.add_argument('--users', type=int, default=20, help='Number of concurrent users')
+    parser.add_argument('--journeys', type=int, default=5, help='Journeys made by every user')
+    parser.add_argument('--products', type=int, default=40, help='Number of products in the catalog')
+    parser.add_argument('--strapi-latency', type=float, default=0.005, help='STRAPI response delay in seconds')
+    parser.add_argument('--telegram-latency', type=float, default=0, help='Telegram API call delay in seconds')
+    parser.add_argument('--image-size', type=int, default=200_000, help='Product image size in bytes')
+    parser.add_argument('--write-behind', action='store_true', help='Flush cart and checkout writes in background')
+    parser.add_argument('--prewarm', action='store_true', help='Warm connections and caches before the run')
+    parser.add_argument('--json', action='store_true', help='Print report as JSON')
+    parser.add_argument('--baseline', help='JSON report of a previous run, exit with code 1 if results regressed')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='Allowed regression share against baseline')
+    args = parser.parse_args()
+    report = run_benchmark(users=args.users,
+                           journeys=args.journeys,
+                           products_count=args.products,
+                           strapi_latency=args.strapi_latency,
+                           telegram_latency=args.telegram_latency,
+                           image_size=args.image_size,
+                           write_behind=args.write_behind,
+                           prewarm_caches=args.prewarm)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    if not args.baseline:
+        return
+    with open(args.baseline) as baseline_file:
+        regressions = compare_reports(report, json.load(baseline_file), args.max_regression)
+    if regressions:
+        print(f'Regressions against {args.baseline} by more than {args.max_regression:.0%}:', file=sys.stderr)
+        for regression in regressions:
+            print(f'  {regression}', file=sys.stderr)
+        sys.exit(1)
+    print(f'No regressions against {args.baseline}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,48 @@
 import logging
+import re
+import signal
+import threading
 
 import redis
 import requests
 from environs import Env
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram import Update
+from telegram.error import BadRequest
 from telegram.ext import Filters, Updater, CallbackContext
-from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler
-
-from strapi_api import get_products, get_product_detail, get_product_img
-from strapi_api import get_or_create_cart, create_ordered_product, get_cart_ordered_products
-from strapi_api import remove_ordered_product
-from strapi_api import get_or_create_customer, save_customer_email
+from telegram.ext import CallbackQueryHandler, CommandHandler, MessageHandler, TypeHandler
+
+from async_strapi_api import AsyncRunner, AsyncStrapiClient
+from catalog_cache import CatalogCache
+from chat_guard import ChatGuard, RedisChatGuard
+from image_cache import ProductImageCache
+from metrics import Metrics, start_metrics
+from models_config import get_models_config
+from prewarm import prewarm
+from render_cache import RenderCache
+from screens import EMPTY_CART_MARKUP, get_cart_text, render_cart_markup, render_menu_markup, render_product_card
+from resilience import CallGuard, CircuitBreaker, is_not_found
+from session_store import RedisSessionStore
+from sharding import CatalogSync, StreamUpdateConsumer, StreamUpdateProducer
+from strapi_api import StrapiClient
+from strapi_api import save_customer_email
+from transitions import get_screen_id, show_photo, show_text
+from user_cache import add_product_to_cart, get_session_cart, get_user_customer_id, load_user_cart
+from user_cache import remove_ordered_product_from_cart, remove_product_from_cart
+from webhook import ChatOrderedWorkerPool, get_webhook_server
+from write_behind import WriteBehindQueue
 
 logger = logging.getLogger(__name__)
 
+EMAIL_PATTERN = re.compile(r'[^@\s]+@[^@\s]+\.[^@\s]+')
 
 def main():
     logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
     env = Env()
     env.read_env()
     tg_bot_token = env.str('TG_BOT_TOKEN')
-    strapi_token = env.str('STRAPI_TOKEN')
-    strapi_host = env.str('STRAPI_HOST', 'http://localhost:1337/')
-    strapi_product_name = env.str('PRODUCT', 'product')
-    strapi_product_name_plural = env.str('PRODUCT_PLURAL', 'products')
-    strapi_ordered_product_name_plural = env.str('ORDERED_PRODUCT_PLURAL', 'ordered-products')
-    strapi_cart_name_plural = env.str('CART_PLURAL', 'carts')
-    strapi_customer_name_plural = env.str('CUSTOMER_PLURAL', 'customers')
+    admin_tg_ids = env.list('ADMIN_TG_IDS', [], subcast=int)
+    bot_mode = env.str('BOT_MODE', 'polling')
+    bot_role = env.str('BOT_ROLE', 'standalone')
 
     redis_db = redis.Redis(host=env.str('REDIS_DB_HOST'),
                            port=env.int('REDIS_DB_PORT'),
@@ -35,41 +51,241 @@ def main():
 
     updater = Updater(tg_bot_token)
     dispatcher = updater.dispatcher
+    if bot_role == 'front':
+        metrics = Metrics()
+        start_metrics(metrics, env)
+        run_front(updater, env, redis_db, metrics)
+        return
 
-    dispatcher.bot_data['redis_db'] = redis_db
-    dispatcher.bot_data['strapi_token'] = strapi_token
-    dispatcher.bot_data['strapi_host'] = strapi_host
-    dispatcher.bot_data['models_config'] = {
-        'strapi_product_name': strapi_product_name,
-        'strapi_product_name_plural': strapi_product_name_plural,
-        'strapi_ordered_product_name_plural': strapi_ordered_product_name_plural,
-        'strapi_cart_name_plural': strapi_cart_name_plural,
-        'strapi_customer_name_plural': strapi_customer_name_plural
-    }
-
+    init_bot_data(dispatcher.bot_data, env, redis_db)
+    metrics = dispatcher.bot_data['metrics']
+    start_metrics(metrics, env)
+    if env.bool('PREWARM', True):
+        durations = prewarm(dispatcher.bot_data,
+                            updater.bot,
+                            snapshot_key=f'{env.str("REDIS_NAMESPACE", "fish_shop")}:catalog_snapshot')
+        logger.info('Prewarm took %.2f s: %s',
+                    durations.pop('total'),
+                    ', '.join(f'{step} {duration:.2f} s' for step, duration in durations.items()))
+
+    dispatcher.add_handler(CommandHandler('reload_catalog', reload_catalog, filters=Filters.user(user_id=admin_tg_ids)))
     dispatcher.add_handler(CallbackQueryHandler(handle_users_reply))
     dispatcher.add_handler(MessageHandler(Filters.text, handle_users_reply))
     dispatcher.add_handler(CommandHandler('start', handle_users_reply))
 
+    if bot_role == 'worker':
+        run_worker(updater, env)
+    elif bot_mode == 'webhook':
+        worker_pool = ChatOrderedWorkerPool(dispatcher.process_update,
+                                            workers=env.int('WEBHOOK_WORKERS', 4),
+                                            queue_size=env.int('WEBHOOK_QUEUE_SIZE', 100))
+        run_webhook(updater, env, worker_pool, metrics)
+    else:
+        updater.start_polling()
+        updater.idle()
+    close_bot_data(dispatcher.bot_data)
+
+
+def init_bot_data(bot_data: dict, env: Env, redis_db: redis.Redis):
+    """Создаёт клиенты CRM, кэши и хранилище сессий по настройкам из окружения и кладёт их в bot_data."""
+    strapi_token = env.str('STRAPI_TOKEN')
+    strapi_host = env.str('STRAPI_HOST', 'http://localhost:1337/')
+    strapi_pool_size = env.int('STRAPI_POOL_SIZE', 10)
+    strapi_connect_timeout = env.float('STRAPI_CONNECT_TIMEOUT', 3.05)
+    strapi_read_timeout = env.float('STRAPI_READ_TIMEOUT', 10)
+    strapi_retries = env.int('STRAPI_RETRIES', 3)
+    strapi_backoff_factor = env.float('STRAPI_BACKOFF_FACTOR', 0.3)
+    strapi_async_pool_size = env.int('STRAPI_ASYNC_POOL_SIZE', 100)
+    strapi_max_concurrency = env.int('STRAPI_MAX_CONCURRENCY', strapi_pool_size)
+    strapi_rate_limit = env.float('STRAPI_RATE_LIMIT', None)
+    strapi_rate_burst = env.float('STRAPI_RATE_BURST', None)
+    strapi_acquire_timeout = env.float('STRAPI_ACQUIRE_TIMEOUT', 5)
+    strapi_breaker_failures = env.int('STRAPI_BREAKER_FAILURES', 5)
+    strapi_breaker_reset_timeout = env.float('STRAPI_BREAKER_RESET_TIMEOUT', 30)
+    catalog_ttl = env.float('CATALOG_TTL', 600)
+    catalog_max_details = env.int('CATALOG_MAX_DETAILS', 256)
+    catalog_page_size = env.int('CATALOG_PAGE_SIZE', 8)
+    image_cache_dir = env.str('IMAGE_CACHE_DIR', None)
+    redis_namespace = env.str('REDIS_NAMESPACE', 'fish_shop')
+    session_idle_ttl = env.int('SESSION_IDLE_TTL', 30 * 24 * 60 * 60)
+    dedup_window = env.float('DEDUP_WINDOW', 1.5)
+    bot_role = env.str('BOT_ROLE', 'standalone')
+    shards = env.int('SHARDS', 4)
+    worker_shards = env.list('WORKER_SHARDS', list(range(shards)), subcast=int) if bot_role == 'worker' else None
+    write_behind_enabled = env.bool('WRITE_BEHIND', False)
+
+    models_config = get_models_config(env)
+    metrics = Metrics()
+    strapi_breaker = CircuitBreaker(failure_threshold=strapi_breaker_failures,
+                                    reset_timeout=strapi_breaker_reset_timeout)
+    strapi_guard = CallGuard(max_concurrency=strapi_max_concurrency,
+                             rate=strapi_rate_limit,
+                             burst=strapi_rate_burst,
+                             acquire_timeout=strapi_acquire_timeout,
+                             breaker=strapi_breaker)
+    strapi_client = StrapiClient(strapi_host,
+                                 strapi_token,
+                                 models_config,
+                                 pool_size=strapi_pool_size,
+                                 timeout=(strapi_connect_timeout, strapi_read_timeout),
+                                 retries=strapi_retries,
+                                 backoff_factor=strapi_backoff_factor,
+                                 metrics=metrics,
+                                 guard=strapi_guard)
+    async_runner = AsyncRunner()
+    async_strapi_client = AsyncStrapiClient(strapi_host,
+                                            strapi_token,
+                                            models_config,
+                                            pool_size=strapi_async_pool_size,
+                                            timeout=(strapi_connect_timeout, strapi_read_timeout),
+                                            metrics=metrics,
+                                            guard=strapi_guard)
+
+    bot_data['redis_db'] = redis_db
+    bot_data['metrics'] = metrics
+    bot_data['strapi_client'] = strapi_client
+    bot_data['async_runner'] = async_runner
+    bot_data['async_strapi_client'] = async_strapi_client
+    bot_data['models_config'] = models_config
+    bot_data['catalog'] = CatalogCache(strapi_client,
+                                       ttl=catalog_ttl,
+                                       max_details=catalog_max_details,
+                                       async_runner=async_runner,
+                                       async_strapi_client=async_strapi_client)
+    bot_data['catalog_page_size'] = catalog_page_size
+    bot_data['render_cache'] = RenderCache(bot_data['catalog'], max_screens=2 * catalog_max_details)
+    bot_data['image_cache'] = ProductImageCache(redis_db,
+                                                strapi_client,
+                                                cache_dir=image_cache_dir,
+                                                key_prefix=f'{redis_namespace}:tg_file_id')
+    bot_data['sessions'] = RedisSessionStore(redis_db,
+                                             namespace=redis_namespace,
+                                             idle_ttl=session_idle_ttl,
+                                             metrics=metrics)
+    bot_data['catalog_sync'] = None
+    if bot_role == 'worker':
+        # Чаты одного шарда обрабатывает один процесс, но блокировки и нажатия общие на случай смены шардов
+        bot_data['chat_guard'] = RedisChatGuard(redis_db, namespace=redis_namespace, dedup_window=dedup_window)
+        bot_data['catalog_sync'] = CatalogSync(redis_db, bot_data['catalog'], namespace=redis_namespace)
+        bot_data['catalog_sync'].start()
+    else:
+        bot_data['chat_guard'] = ChatGuard(dedup_window=dedup_window)
+    bot_data['write_behind'] = None
+    if write_behind_enabled:
+        bot_data['write_behind'] = WriteBehindQueue(redis_db,
+                                                    strapi_client,
+                                                    bot_data['sessions'],
+                                                    namespace=redis_namespace,
+                                                    shards=shards,
+                                                    worker_shards=worker_shards,
+                                                    batch_size=env.int('WRITE_BEHIND_BATCH_SIZE', 50),
+                                                    flush_interval=env.float('WRITE_BEHIND_FLUSH_INTERVAL', 0.5),
+                                                    max_attempts=env.int('WRITE_BEHIND_MAX_ATTEMPTS', 5),
+                                                    metrics=metrics)
+        bot_data['write_behind'].start()
+        metrics.register_gauges('write_behind', bot_data['write_behind'].stats)
+    metrics.register_gauges('strapi_guard', strapi_guard.stats)
+    metrics.register_gauges('catalog_cache', bot_data['catalog'].stats)
+    metrics.register_gauges('render_cache', bot_data['render_cache'].stats)
+    metrics.register_gauges('image_cache', bot_data['image_cache'].stats)
+    metrics.register_gauges('chat_guard', bot_data['chat_guard'].stats)
+
+
+def close_bot_data(bot_data: dict):
+    if bot_data['catalog_sync']:
+        bot_data['catalog_sync'].stop()
+    if bot_data['write_behind']:
+        bot_data['write_behind'].stop()
+    bot_data['strapi_client'].close()
+    async_runner = bot_data['async_runner']
+    async_runner.run(bot_data['async_strapi_client'].close())
+    async_runner.stop()
+
+
+def run_webhook(updater: Updater,
+                env: Env,
+                update_queue: ChatOrderedWorkerPool | StreamUpdateProducer,
+                metrics: Metrics):
+    """Принимает обновления от Telegram через вебхук и передаёт их в пул воркеров или в шарды."""
+    webhook_url = env.str('WEBHOOK_URL')
+    webhook_path = env.str('WEBHOOK_PATH', 'telegram')
+    webhook_secret = env.str('WEBHOOK_SECRET')
+    metrics.register_gauges('bot_updates', update_queue.stats)
+    server = get_webhook_server(updater.bot,
+                                update_queue,
+                                webhook_secret,
+                                listen=env.str('WEBHOOK_LISTEN', '0.0.0.0'),
+                                port=env.int('WEBHOOK_PORT', 8443),
+                                url_path=webhook_path)
+    update_queue.start()
+    updater.bot.set_webhook(f'{webhook_url.rstrip("/")}/{webhook_path}',
+                            max_connections=env.int('WEBHOOK_MAX_CONNECTIONS', 40),
+                            secret_token=webhook_secret)
+    logger.info('Webhook server is listening on %s:%s', *server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        update_queue.stop()
+
+
+def run_front(updater: Updater, env: Env, redis_db: redis.Redis, metrics: Metrics):
+    """Получает обновления от Telegram и раскладывает их по шардам в Redis, не обрабатывая.
+
+    Все обновления одного чата попадают в один шард, шард обрабатывает один процесс-воркер.
+    """
+    producer = StreamUpdateProducer(redis_db,
+                                    namespace=env.str('REDIS_NAMESPACE', 'fish_shop'),
+                                    shards=env.int('SHARDS', 4),
+                                    queue_size=env.int('SHARD_QUEUE_SIZE', 1000))
+    if env.str('BOT_MODE', 'polling') == 'webhook':
+        run_webhook(updater, env, producer, metrics)
+        return
+    metrics.register_gauges('bot_updates', producer.stats)
+
+    def forward_update(update: Update, context: CallbackContext):
+        if not producer.put(update):
+            logger.error('Update %s is rejected, shard queue is full', update.update_id)
+
+    updater.dispatcher.add_handler(TypeHandler(Update, forward_update))
     updater.start_polling()
     updater.idle()
 
 
-def start(update: Update, context: CallbackContext):
+def run_worker(updater: Updater, env: Env):
+    """Обрабатывает обновления своих шардов из Redis, пока процесс не остановят."""
+    shards = env.int('SHARDS', 4)
+    bot_data = updater.dispatcher.bot_data
+    consumer = StreamUpdateConsumer(bot_data['redis_db'],
+                                    updater.bot,
+                                    updater.dispatcher.process_update,
+                                    env.list('WORKER_SHARDS', list(range(shards)), subcast=int),
+                                    namespace=env.str('REDIS_NAMESPACE', 'fish_shop'))
+    bot_data['metrics'].register_gauges('bot_updates', consumer.stats)
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    consumer.start()
+    logger.info('Worker is processing shards %s', ', '.join(map(str, consumer.shards)))
+    try:
+        stopped.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        consumer.stop()
+
+
+def start(update: Update, context: CallbackContext, page: int = 1):
     """Хэндлер для состояния START."""
-    hostname = context.bot_data['strapi_host']
-    models_config = context.bot_data['models_config']
-    products = get_products(context.bot_data['strapi_token'], hostname, models_config)
-    keyboard = [
-        [InlineKeyboardButton(product['attributes']['Title'], callback_data=product['id'])] for product in products
-    ]
-    keyboard += [[InlineKeyboardButton('Моя корзина', callback_data='cart')]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    if update.message:
-        update.message.reply_text(text='Привет! Выбери товар.', reply_markup=reply_markup)
-    else:
-        update.callback_query.message.reply_text(text='Выбрать товар или посмотреть корзину.', reply_markup=reply_markup)
-        update.callback_query.delete_message()
+    catalog = context.bot_data['catalog']
+    page_size = context.bot_data['catalog_page_size']
+    reply_markup = context.bot_data['render_cache'].get(
+        ('menu', page, page_size),
+        lambda: render_menu_markup(*catalog.get_products_page(page, page_size))
+    )
+    text = 'Привет! Выбери товар.' if update.message else 'Выбрать товар или посмотреть корзину.'
+    show_text(update, text, reply_markup=reply_markup, metrics=context.bot_data['metrics'])
     return 'HANDLE_MENU'
 
 
@@ -77,56 +293,77 @@ def cart(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
 
-    api_token = context.bot_data['strapi_token']
-    hostname = context.bot_data['strapi_host']
-    models_config = context.bot_data['models_config']
-    user_cart = get_or_create_cart(query.message.chat_id, hostname, models_config, api_token)
-    ordered_products = get_cart_ordered_products(user_cart, api_token, hostname, models_config, as_text=False)
-    cart_text = get_cart_ordered_products(user_cart, api_token, hostname, models_config, as_text=True)
-
-    keyboard = [[InlineKeyboardButton(f'Отказаться от {product["title"]} {product["amount"]}',
-                                     callback_data=f'remove_item;{product["id"]}')] for product in ordered_products]
-    keyboard += [
-        [InlineKeyboardButton('В меню', callback_data='cancel')],
-        [InlineKeyboardButton('Оплатить', callback_data='payment')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.callback_query.message.reply_text(cart_text, reply_markup=reply_markup)
-    update.callback_query.delete_message()
+    strapi_client = context.bot_data['strapi_client']
+    if context.bot_data['write_behind']:
+        # Cart in the session is ahead of STRAPI while the queue is not flushed
+        user_cart = get_session_cart(strapi_client, context.bot_data['sessions'], context.session)
+    else:
+        user_cart = load_user_cart(strapi_client, context.bot_data['sessions'], context.session)
+    ordered_products = user_cart['ordered_products']
+    if not ordered_products:
+        show_text(update, 'Ваша корзина пуста.', reply_markup=EMPTY_CART_MARKUP, metrics=context.bot_data['metrics'])
+        return 'HANDLE_CART'
+
+    show_text(update,
+              get_cart_text(user_cart),
+              reply_markup=render_cart_markup(ordered_products),
+              metrics=context.bot_data['metrics'])
     return 'HANDLE_CART'
 
 
 def select_cart_item(update: Update, context: CallbackContext):
-    hostname = context.bot_data['strapi_host']
-    models_config = context.bot_data['models_config']
-
     query = update.callback_query
     query.answer()
     if query.data == 'cancel':
         query.answer()
         return start(update, context)
+    if query.data.startswith('remove_product'):
+        product_id = query.data.split(';')[1]
+        if product_id.isdigit():
+            remove_product_from_cart(context.bot_data['strapi_client'],
+                                     context.bot_data['sessions'],
+                                     context.session,
+                                     int(product_id),
+                                     write_behind=context.bot_data['write_behind'])
+        return cart(update, context)
     if query.data.startswith('remove_item'):
-        ordered_product_id = query.data.split(';')[1]
-        remove_ordered_product(ordered_product_id, context.bot_data['starapi_token'], hostname, models_config)
+        # Строки удалённых товаров и кнопки корзин, отправленных до удаления по ID товара
+        remove_ordered_product_from_cart(context.bot_data['strapi_client'],
+                                         context.bot_data['sessions'],
+                                         context.session,
+                                         query.data.split(';')[1])
         return cart(update, context)
     if query.data == 'payment':
         return request_an_email(update, context)
 
 
 def request_an_email(update: Update, context: CallbackContext):
-    update.callback_query.message.reply_text(text='Для оплаты введите Ваш адрес электронной почты.')
-    update.callback_query.delete_message()
+    show_text(update, 'Для оплаты введите Ваш адрес электронной почты.', metrics=context.bot_data['metrics'])
     return 'WAITING_EMAIL'
 
 
 def process_email(update: Update, context: CallbackContext):
-    api_token = context.bot_data['strapi_token']
-    hostname = context.bot_data['strapi_host']
-    models_config = context.bot_data['models_config']
+    strapi_client = context.bot_data['strapi_client']
     users_email = update.message.text
-    customer_id = get_or_create_customer(update.message.chat_id, api_token, hostname, models_config)['id']
+    sessions = context.bot_data['sessions']
+    write_behind = context.bot_data['write_behind']
+    if write_behind:
+        if not EMAIL_PATTERN.fullmatch(users_email):
+            update.message.reply_text('E-mail введён некорректно! Повторите ввод.')
+            return 'WAITING_EMAIL'
+        write_behind.save_email(context.session.chat_id, users_email, context.session.get('customer_id'))
+        update.message.reply_text('Заказ принят! Ожидайте обращения нашего менеджера на Ваш e-mail!')
+        return start(update, context)
     try:
-        customer = save_customer_email(customer_id, users_email, api_token, hostname, models_config)
+        customer_id = get_user_customer_id(strapi_client, sessions, context.session)
+        try:
+            customer = save_customer_email(strapi_client, customer_id, users_email)
+        except requests.exceptions.HTTPError as error:
+            if not is_not_found(error):
+                raise
+            sessions.delete_field(context.session, 'customer_id')
+            customer_id = get_user_customer_id(strapi_client, sessions, context.session)
+            customer = save_customer_email(strapi_client, customer_id, users_email)
         update.message.reply_text('Заказ принят! Ожидайте обращения нашего менеджера на Ваш e-mail!')
         return start(update, context)
     except requests.exceptions.HTTPError:
@@ -135,25 +372,38 @@ def process_email(update: Update, context: CallbackContext):
 
 
 def select_menu_item(update: Update, context: CallbackContext):
-    hostname = context.bot_data['strapi_host']
-    models_config = context.bot_data['models_config']
+    image_cache = context.bot_data['image_cache']
 
     query = update.callback_query
     if query.data == 'cart':
         return cart(update, context)
     query.answer()
-
-    product_detail = get_product_detail(query.data, context.bot_data['starapi_token'], hostname, models_config)
-    image = get_product_img(product_detail['Image']['data']['attributes']['url'], hostname)
-
-    keyboard = [
-        [InlineKeyboardButton('Добавить в корзину', callback_data=f'add_to_cart;{query.data}')],
-        [InlineKeyboardButton('Моя корзина', callback_data='cart')],
-        [InlineKeyboardButton('Назад', callback_data='cancel')],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    update.callback_query.message.reply_photo(image, caption=product_detail['Description'], reply_markup=reply_markup)
-    query.delete_message()
+    if query.data.startswith('menu_page'):
+        return start(update, context, page=int(query.data.split(';')[1]))
+
+    catalog = context.bot_data['catalog']
+    product_card = context.bot_data['render_cache'].get(
+        ('product', query.data),
+        lambda: render_product_card(query.data, catalog.get_product_detail(query.data))
+    )
+    image = product_card['image']
+    caption = product_card['caption']
+    reply_markup = product_card['reply_markup']
+    photo = image_cache.get_photo(query.data, image)
+
+    metrics = context.bot_data['metrics']
+    try:
+        with metrics.track_call('telegram_send_photo', {'source': 'file_id' if isinstance(photo, str) else 'upload'}):
+            message = show_photo(update, photo, caption, reply_markup=reply_markup, metrics=metrics)
+    except BadRequest:
+        if not isinstance(photo, str):
+            raise
+        image_cache.forget(query.data, image)
+        photo = image_cache.get_photo(query.data, image)
+        with metrics.track_call('telegram_send_photo', {'source': 'upload'}):
+            message = show_photo(update, photo, caption, reply_markup=reply_markup, metrics=metrics)
+    if not isinstance(photo, str):
+        image_cache.remember(query.data, image, message)
     return 'HANDLE_DESCRIPTION'
 
 
@@ -168,14 +418,28 @@ def detail_result(update: Update, context: CallbackContext):
     elif query.data.startswith('add_to_cart'):
         query.answer()
         product_id = int(query.data.split(';')[1])
-        api_token = context.bot_data['strapi_token']
-        hostname = context.bot_data['strapi_host']
-        models_config = context.bot_data['models_config']
-        user_cart = get_or_create_cart(query.message.chat_id, hostname, models_config, api_token)
-        ordered_product = create_ordered_product(product_id, api_token, hostname, models_config, cart_id=user_cart['id'])
+        product_detail = context.bot_data['catalog'].get_product_detail(product_id)
+        add_product_to_cart(context.bot_data['strapi_client'],
+                            context.bot_data['sessions'],
+                            context.session,
+                            product_id,
+                            product_detail['Title'],
+                            product_detail['Price'],
+                            write_behind=context.bot_data['write_behind'])
         return start(update, context)
 
 
+def reload_catalog(update: Update, context: CallbackContext):
+    """Админская команда /reload_catalog: сбрасывает кэш каталога и загружает его заново."""
+    catalog = context.bot_data['catalog']
+    products = catalog.refresh()
+    if context.bot_data['catalog_sync']:
+        context.bot_data['catalog_sync'].publish()
+    stats = catalog.stats()
+    update.message.reply_text(f'Каталог обновлён, товаров: {len(products)}.\n'
+                              f'Попаданий в кэш: {stats["hits"]}, промахов: {stats["misses"]}.')
+
+
 def handle_users_reply(update: Update, context: CallbackContext):
     """
     Функция, которая запускается при любом сообщении от пользователя и решает как его обработать.
@@ -189,20 +453,27 @@ def handle_users_reply(update: Update, context: CallbackContext):
     поэтому по этой фразе выставляется стартовое состояние.
     Если пользователь захочет начать общение с ботом заново, он также может воспользоваться этой командой.
     """
-    redis_db = context.bot_data['redis_db']
+    chat_guard = context.bot_data['chat_guard']
     if update.message:
         user_reply = update.message.text
         chat_id = update.message.chat_id
     elif update.callback_query:
         user_reply = update.callback_query.data
         chat_id = update.callback_query.message.chat_id
+        message = update.callback_query.message
+        if chat_guard.is_duplicate(chat_id, message.message_id, user_reply, get_screen_id(message)):
+            update.callback_query.answer()
+            return
     else:
         return
-    if user_reply == '/start':
-        user_state = 'START'
-    else:
-        user_state = redis_db.get(chat_id)
+    with chat_guard.lock(chat_id):
+        process_users_reply(update, context, chat_id, user_reply)
 
+
+def process_users_reply(update: Update, context: CallbackContext, chat_id: int, user_reply: str):
+    sessions = context.bot_data['sessions']
+    session = sessions.load(chat_id)
+    context.session = session
     states_functions = {
         'START': start,
         'HANDLE_MENU': select_menu_item,
@@ -210,13 +481,32 @@ def handle_users_reply(update: Update, context: CallbackContext):
         'HANDLE_CART': select_cart_item,
         'WAITING_EMAIL': process_email
     }
+    if user_reply == '/start':
+        user_state = 'START'
+    else:
+        user_state = session.get('state', 'START')
+    if user_state not in states_functions:
+        # Сессия с испорченным состоянием не должна ломать все следующие обновления
+        user_state = 'START'
     state_handler = states_functions[user_state]
 
+    metrics = context.bot_data['metrics']
     try:
-        next_state = state_handler(update, context)
-        redis_db.set(chat_id, next_state)
+        with metrics.timer('bot_handler_seconds', {'handler': state_handler.__name__}):
+            next_state = state_handler(update, context)
+        # Хэндлер, не узнавший нажатую кнопку, возвращает None: состояние не меняем
+        if next_state is not None:
+            session.set('state', next_state)
+        sessions.save(session)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+        # Экран, которого нет в кэше, не показать, пока CRM недоступна: состояние не меняем
+        metrics.inc('bot_handler_unavailable_total', {'handler': state_handler.__name__})
+        logger.warning('CRM is unavailable: %s', err)
+        message = update.message or update.callback_query.message
+        message.reply_text('Магазин временно недоступен, попробуйте через минуту.')
     except Exception as err:
-        print(err)
+        metrics.inc('bot_handler_errors_total', {'handler': state_handler.__name__})
+        logger.exception(err)
         raise err
 
 
@@ -0,0 +1,292 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+import aiohttp
+import requests
+
+import async_strapi_api
+from async_strapi_api import AsyncRunner, AsyncStrapiClient
+from resilience import is_failure, is_not_found
+from strapi_api import StrapiClient
+from strapi_api import get_products, get_products_page, get_product_detail
+
+
+ASYNC_REQUEST_ERRORS = (requests.exceptions.RequestException, aiohttp.ClientError, asyncio.TimeoutError)
+"""Errors of loading entries with the async client, circuit breaker rejects calls with `requests` errors."""
+
+
+class CatalogCache:
+    """In-process TTL cache for STRAPI catalog.
+
+    Products list, pages of products and product details are kept for `ttl` seconds.
+    Details and pages are evicted in LRU order when more than `max_details` of them are cached.
+    Expired entries are served only if STRAPI is unavailable, e.g. while its circuit is open.
+    Entry of a product STRAPI doesn't find anymore is dropped.
+    `version` is increased every time cached catalog changes, so things built from it may be rebuilt.
+    If async client is passed, the next page of products is prefetched in background:
+    by the async runner for synchronous handlers, in the running event loop for async ones.
+    Methods with `_async` suffix load missing entries with the async client and share entries with the others.
+
+    Args:
+        strapi_client(StrapiClient): STRAPI client, may be None if only `_async` methods are used.
+        ttl(float): Time to live of cached entries in seconds.
+        max_details(int): Max number of cached product details and pages.
+        async_runner(AsyncRunner): Event loop for background prefetch.
+        async_strapi_client(AsyncStrapiClient): STRAPI client for `_async` methods and background prefetch.
+    """
+
+    def __init__(self,
+                 strapi_client: StrapiClient,
+                 ttl: float = 600,
+                 max_details: int = 256,
+                 async_runner: AsyncRunner = None,
+                 async_strapi_client: AsyncStrapiClient = None):
+        self.strapi_client = strapi_client
+        self.ttl = ttl
+        self.max_details = max_details
+        self.async_runner = async_runner
+        self.async_strapi_client = async_strapi_client
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.version = 0
+        self._lock = threading.Lock()
+        self._products = None
+        self._products_expire_at = 0
+        self._details = OrderedDict()
+        self._pages = OrderedDict()
+        self._prefetching = {}
+
+    def get_products(self) -> list[dict]:
+        cached_products, is_fresh = self._get_cached_products()
+        if is_fresh:
+            return cached_products
+        try:
+            products = get_products(self.strapi_client)
+        except requests.exceptions.RequestException as error:
+            return self._get_stale_products(cached_products, error)
+        return self._save_products(products)
+
+    async def get_products_async(self) -> list[dict]:
+        cached_products, is_fresh = self._get_cached_products()
+        if is_fresh:
+            return cached_products
+        try:
+            products = await async_strapi_api.get_products(self.async_strapi_client)
+        except ASYNC_REQUEST_ERRORS as error:
+            return self._get_stale_products(cached_products, error)
+        return self._save_products(products)
+
+    def get_product_detail(self, product_id: int | str) -> dict:
+        key = str(product_id)
+        return self._get_entry(self._details, key, lambda: get_product_detail(self.strapi_client, key))
+
+    async def get_product_detail_async(self, product_id: int | str) -> dict:
+        key = str(product_id)
+        return await self._get_entry_async(
+            self._details,
+            key,
+            lambda: async_strapi_api.get_product_detail(self.async_strapi_client, key)
+        )
+
+    def get_products_page(self, page: int, page_size: int) -> tuple[list[dict], dict]:
+        """Get cached page of products and prefetch the next one.
+
+        Return:
+            tuple: Products of the page and STRAPI pagination info
+        """
+        products_page = self._get_entry(self._pages,
+                                        (page, page_size),
+                                        lambda: get_products_page(self.strapi_client, page, page_size))
+        _, pagination = products_page
+        if page < pagination['pageCount']:
+            self.prefetch_products_page(page + 1, page_size)
+        return products_page
+
+    async def get_products_page_async(self, page: int, page_size: int) -> tuple[list[dict], dict]:
+        products_page = await self._get_entry_async(
+            self._pages,
+            (page, page_size),
+            lambda: async_strapi_api.get_products_page(self.async_strapi_client, page, page_size)
+        )
+        _, pagination = products_page
+        if page < pagination['pageCount']:
+            self.prefetch_products_page(page + 1, page_size)
+        return products_page
+
+    def prefetch_products_page(self, page: int, page_size: int):
+        """Load page of products into the cache in background."""
+        key = (page, page_size)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if not self.async_strapi_client or not (loop or self.async_runner):
+            return
+        with self._lock:
+            cached = self._pages.get(key)
+            if key in self._prefetching or (cached and cached[0] > time.monotonic()):
+                return
+            self._prefetching[key] = None
+
+        def save_page(future):
+            with self._lock:
+                self._prefetching.pop(key, None)
+            if not future.cancelled() and not future.exception():
+                self._save_entry(self._pages, key, future.result())
+
+        coroutine = async_strapi_api.get_products_page(self.async_strapi_client, page, page_size)
+        prefetch = loop.create_task(coroutine) if loop else self.async_runner.submit(coroutine)
+        with self._lock:
+            # Task of the event loop is kept referenced until it is done
+            if key in self._prefetching:
+                self._prefetching[key] = prefetch
+        prefetch.add_done_callback(save_page)
+
+    def invalidate(self, product_id: int | str = None):
+        """Drop cached entries.
+
+        Args:
+            product_id(int | str): Drop only this product detail. Whole catalog is dropped by default.
+        """
+        with self._lock:
+            self.version += 1
+            if product_id is not None:
+                self._details.pop(str(product_id), None)
+                return
+            self._products = None
+            self._details.clear()
+            self._pages.clear()
+
+    def refresh(self) -> list[dict]:
+        """Drop all cached entries and load fresh products list."""
+        self.invalidate()
+        return self.get_products()
+
+    async def refresh_async(self) -> list[dict]:
+        self.invalidate()
+        return await self.get_products_async()
+
+    def fill(self, products: list[dict], details: dict, page_size: int):
+        """Put whole catalog into the cache, e.g. at startup.
+
+        Pages of `page_size` are cut from the products list, which has the same order and fields as a page.
+
+        Args:
+            products(list): All products with titles
+            details(dict): Product details by product ID
+            page_size(int): Size of menu pages to fill
+        """
+        page_count = max(1, -(-len(products) // page_size))
+        with self._lock:
+            self.version += 1
+            self._products = products
+            self._products_expire_at = time.monotonic() + self.ttl
+        for page in range(1, page_count + 1):
+            pagination = {'page': page, 'pageSize': page_size, 'pageCount': page_count, 'total': len(products)}
+            page_products = products[(page - 1) * page_size:page * page_size]
+            self._save_entry(self._pages, (page, page_size), (page_products, pagination))
+        for product_id, detail in list(details.items())[:self.max_details]:
+            self._save_entry(self._details, str(product_id), detail)
+
+    def snapshot(self) -> dict:
+        """Get cached products and details, which may be passed to `fill` after restart."""
+        with self._lock:
+            return {
+                'products': self._products or [],
+                'details': {product_id: detail for product_id, (_, detail) in self._details.items()},
+            }
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / (self.hits + self.misses) if self.hits + self.misses else 0,
+                'stale_hits': self.stale_hits,
+                'products_cached': self._products is not None,
+                'details_cached': len(self._details),
+                'pages_cached': len(self._pages),
+            }
+
+    def _get_entry(self, entries: OrderedDict, key, load: Callable):
+        cached = self._get_cached_entry(entries, key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        try:
+            value = load()
+        except requests.exceptions.RequestException as error:
+            return self._get_stale_entry(entries, key, cached, error)
+        self._save_entry(entries, key, value)
+        return value
+
+    async def _get_entry_async(self, entries: OrderedDict, key, load: Callable[[], Awaitable]):
+        cached = self._get_cached_entry(entries, key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        try:
+            value = await load()
+        except ASYNC_REQUEST_ERRORS as error:
+            return self._get_stale_entry(entries, key, cached, error)
+        self._save_entry(entries, key, value)
+        return value
+
+    def _get_cached_entry(self, entries: OrderedDict, key) -> tuple | None:
+        """Get cached entry with its expiration time and count a hit if it is fresh, otherwise a miss."""
+        with self._lock:
+            cached = entries.get(key)
+            if cached and cached[0] > time.monotonic():
+                entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return cached
+
+    def _get_stale_entry(self, entries: OrderedDict, key, cached: tuple | None, error: Exception):
+        """Serve expired entry while STRAPI is unavailable, otherwise re-raise the error of loading it."""
+        if cached and is_failure(error):
+            with self._lock:
+                self.stale_hits += 1
+            return cached[1]
+        if is_not_found(error):
+            with self._lock:
+                if entries.pop(key, None):
+                    self.version += 1
+        raise error
+
+    def _get_cached_products(self) -> tuple[list[dict] | None, bool]:
+        """Get cached products list and whether it is fresh, count a hit or a miss."""
+        with self._lock:
+            if self._products is not None and self._products_expire_at > time.monotonic():
+                self.hits += 1
+                return self._products, True
+            self.misses += 1
+            return self._products, False
+
+    def _get_stale_products(self, stale_products: list[dict] | None, error: Exception) -> list[dict]:
+        if stale_products is None or not is_failure(error):
+            raise error
+        with self._lock:
+            self.stale_hits += 1
+        return stale_products
+
+    def _save_products(self, products: list[dict]) -> list[dict]:
+        with self._lock:
+            if products != self._products:
+                self.version += 1
+            self._products = products
+            self._products_expire_at = time.monotonic() + self.ttl
+        return products
+
+    def _save_entry(self, entries: OrderedDict, key, value):
+        with self._lock:
+            cached = entries.get(key)
+            if cached and cached[1] != value:
+                self.version += 1
+            entries[key] = (time.monotonic() + self.ttl, value)
+            entries.move_to_end(key)
+            while len(entries) > self.max_details:
+                entries.popitem(last=False)
@@ -0,0 +1,170 @@
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+
+import redis
+
+
+class ChatGuard:
+    """Serializes processing of updates of the same chat and drops repeated taps.
+
+    Args:
+        dedup_window(float): Identical callback taps within this number of seconds are treated as duplicates.
+    """
+
+    def __init__(self, dedup_window: float = 1.5):
+        self.dedup_window = dedup_window
+        self.duplicates = 0
+        self._lock = threading.Lock()
+        self._chat_locks = {}
+        self._async_chat_locks = {}
+        self._recent_taps = OrderedDict()
+
+    @contextmanager
+    def lock(self, chat_id: int | str):
+        """Hold lock of the chat while its update is processed."""
+        with self._lock:
+            chat_lock, users = self._chat_locks.get(chat_id, (threading.Lock(), 0))
+            self._chat_locks[chat_id] = (chat_lock, users + 1)
+        try:
+            with chat_lock:
+                yield
+        finally:
+            with self._lock:
+                chat_lock, users = self._chat_locks[chat_id]
+                if users == 1:
+                    del self._chat_locks[chat_id]
+                else:
+                    self._chat_locks[chat_id] = (chat_lock, users - 1)
+
+    @asynccontextmanager
+    async def lock_async(self, chat_id: int | str):
+        """Same as `lock`, but waits for the chat without blocking the event loop.
+
+        Waiting updates of a chat get the lock in order they came.
+        """
+        with self._lock:
+            chat_lock, users = self._async_chat_locks.get(chat_id, (asyncio.Lock(), 0))
+            self._async_chat_locks[chat_id] = (chat_lock, users + 1)
+        try:
+            async with chat_lock:
+                yield
+        finally:
+            with self._lock:
+                chat_lock, users = self._async_chat_locks[chat_id]
+                if users == 1:
+                    del self._async_chat_locks[chat_id]
+                else:
+                    self._async_chat_locks[chat_id] = (chat_lock, users - 1)
+
+    def is_duplicate(self, chat_id: int | str, message_id: int, callback_data: str, screen_id: str = None) -> bool:
+        """Check if the same button of the same screen was already tapped within dedup window.
+
+        Message edited in place is a new screen: taps on the screens it showed before are forgotten,
+        so going back to a screen shown a moment ago doesn't turn the next tap into a duplicate.
+
+        Args:
+            chat_id(int | str): Chat ID
+            message_id(int): ID of the message with the button
+            callback_data(str): Data of the button
+            screen_id(str): ID of the screen the message showed, see `transitions.get_screen_id`
+        """
+        now = time.monotonic()
+        message_key = (chat_id, message_id)
+        with self._lock:
+            while self._recent_taps:
+                _, (_, last_tapped_at, _) = next(iter(self._recent_taps.items()))
+                if now - last_tapped_at < self.dedup_window:
+                    break
+                self._recent_taps.popitem(last=False)
+            shown_screen_id, _, taps = self._recent_taps.pop(message_key, (screen_id, now, {}))
+            if shown_screen_id != screen_id:
+                taps = {}
+            tapped_at = taps.get(callback_data)
+            is_duplicate = tapped_at is not None and now - tapped_at < self.dedup_window
+            if is_duplicate:
+                self.duplicates += 1
+            else:
+                taps[callback_data] = now
+            self._recent_taps[message_key] = (screen_id, now, taps)
+            return is_duplicate
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'duplicates': self.duplicates,
+                'locked_chats': len(self._chat_locks) + len(self._async_chat_locks),
+            }
+
+
+class RedisChatGuard:
+    """Same as `ChatGuard`, but locks and recent taps are kept in Redis and shared by all bot processes.
+
+    Args:
+        redis_db(redis.Redis): Redis connection
+        namespace(str): Prefix of Redis keys.
+        dedup_window(float): Identical callback taps within this number of seconds are treated as duplicates.
+        lock_timeout(float): Max time in seconds to hold a chat lock.
+    """
+
+    def __init__(self,
+                 redis_db: redis.Redis,
+                 namespace: str = 'fish_shop',
+                 dedup_window: float = 1.5,
+                 lock_timeout: float = 30):
+        self.redis_db = redis_db
+        self.namespace = namespace
+        self.dedup_window = dedup_window
+        self.lock_timeout = lock_timeout
+        self.duplicates = 0
+        self.locked_chats = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lock(self, chat_id: int | str):
+        """Hold lock of the chat while its update is processed."""
+        with self.redis_db.lock(f'{self.namespace}:chat_lock:{chat_id}',
+                                timeout=self.lock_timeout,
+                                blocking_timeout=self.lock_timeout):
+            with self._lock:
+                self.locked_chats += 1
+            try:
+                yield
+            finally:
+                with self._lock:
+                    self.locked_chats -= 1
+
+    def is_duplicate(self, chat_id: int | str, message_id: int, callback_data: str, screen_id: str = None) -> bool:
+        """Check if the same button of the same screen was already tapped within dedup window.
+
+        Taps of a message are kept in a hash together with ID of the screen they were made on.
+        Updates of a chat are processed by a single process, so the hash is not changed concurrently.
+        """
+        if not self.dedup_window:
+            return False
+        key = f'{self.namespace}:taps:{chat_id}:{message_id}'
+        screen_id = screen_id or ''
+        now = time.time()
+        taps = self.redis_db.hgetall(key)
+        is_same_screen = taps.get('screen') == screen_id
+        if is_same_screen and now - float(taps.get(f'tap:{callback_data}', '-inf')) < self.dedup_window:
+            with self._lock:
+                self.duplicates += 1
+            return True
+        pipeline = self.redis_db.pipeline(transaction=False)
+        if not is_same_screen:
+            pipeline.delete(key)
+        pipeline.hset(key, mapping={'screen': screen_id, f'tap:{callback_data}': now})
+        pipeline.expire(key, math.ceil(self.dedup_window))
+        pipeline.execute()
+        return False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'duplicates': self.duplicates,
+                'locked_chats': self.locked_chats,
+            }
@@ -0,0 +1,179 @@
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+from collections import defaultdict
+from decimal import Decimal
+from typing import Iterable, Iterator
+
+from environs import Env
+
+from async_strapi_api import AsyncStrapiClient, iter_entries
+from models_config import get_models_config
+
+logger = logging.getLogger(__name__)
+
+CUSTOMER_FIELDS = ['telegram_id', 'email', 'carts', 'ordered_products', 'amount', 'total_price']
+PRODUCT_FIELDS = ['product_id', 'title', 'customers', 'ordered_products', 'amount', 'total_price']
+
+
+async def load_cart_owners(strapi_client: AsyncStrapiClient, page_size: int = 100, prefetch: int = 4) -> dict:
+    """Get Telegram IDs of cart owners indexed by cart ID."""
+    return {
+        cart['id']: cart['attributes']['user_tg_id']
+        async for cart in iter_entries(strapi_client, 'strapi_cart_name_plural', 'cart_owner', page_size, prefetch)
+    }
+
+
+async def load_customer_emails(strapi_client: AsyncStrapiClient, page_size: int = 100, prefetch: int = 4) -> dict:
+    """Get e-mails of customers indexed by Telegram ID."""
+    return {
+        customer['attributes']['telegram_id']: customer['attributes']['email']
+        async for customer in iter_entries(strapi_client, 'strapi_customer_name_plural', 'customer', page_size, prefetch)
+    }
+
+
+async def collect_totals(strapi_client: AsyncStrapiClient, page_size: int = 100, prefetch: int = 4) -> dict:
+    """Stream carts, ordered products and customers and sum ordered products per customer and per product.
+
+    Carts and customers are indexed by ID first, then ordered products are streamed
+    and joined with them locally, so only indexes and totals are kept in memory.
+
+    Return:
+        dict: Totals by customer Telegram ID and by product ID, customer e-mails and number of skipped lines, e.g.
+        `{'customers': {99: {...}}, 'products': {2: {...}}, 'emails': {99: 'user@example.com'}, 'orphans': 0}`
+    """
+    cart_owners, emails = await asyncio.gather(load_cart_owners(strapi_client, page_size, prefetch),
+                                               load_customer_emails(strapi_client, page_size, prefetch))
+    product_name = strapi_client.models_config['strapi_product_name']
+    customers = defaultdict(lambda: {'carts': set(), 'ordered_products': 0, 'amount': Decimal(0), 'total_price': Decimal(0)})
+    products = defaultdict(lambda: {'title': '', 'customers': set(), 'ordered_products': 0,
+                                    'amount': Decimal(0), 'total_price': Decimal(0)})
+    orphans = 0
+    ordered_products = iter_entries(strapi_client,
+                                    'strapi_ordered_product_name_plural',
+                                    'ordered_product_export',
+                                    page_size,
+                                    prefetch)
+    async for ordered_product in ordered_products:
+        attributes = ordered_product['attributes']
+        cart = (attributes.get('cart') or {}).get('data')
+        product = (attributes.get(product_name) or {}).get('data')
+        if not cart or cart['id'] not in cart_owners or not product:
+            orphans += 1
+            continue
+        telegram_id = cart_owners[cart['id']]
+        amount = Decimal(str(attributes['amount'] or 0))
+        price = amount * Decimal(str(attributes['fixed_price'] or 0))
+        customer_totals = customers[telegram_id]
+        customer_totals['carts'].add(cart['id'])
+        product_totals = products[product['id']]
+        product_totals['title'] = product['attributes']['Title']
+        product_totals['customers'].add(telegram_id)
+        for totals in (customer_totals, product_totals):
+            totals['ordered_products'] += 1
+            totals['amount'] += amount
+            totals['total_price'] += price
+    return {'customers': customers, 'products': products, 'emails': emails, 'orphans': orphans}
+
+
+def iter_customer_rows(customers: dict, emails: dict) -> Iterator[dict]:
+    for telegram_id, totals in sorted(customers.items(), key=lambda item: item[1]['total_price'], reverse=True):
+        yield {
+            'telegram_id': telegram_id,
+            'email': emails.get(telegram_id) or '',
+            'carts': len(totals['carts']),
+            'ordered_products': totals['ordered_products'],
+            'amount': totals['amount'],
+            'total_price': totals['total_price'],
+        }
+
+
+def iter_product_rows(products: dict) -> Iterator[dict]:
+    for product_id, totals in sorted(products.items(), key=lambda item: item[1]['total_price'], reverse=True):
+        yield {
+            'product_id': product_id,
+            'title': totals['title'],
+            'customers': len(totals['customers']),
+            'ordered_products': totals['ordered_products'],
+            'amount': totals['amount'],
+            'total_price': totals['total_price'],
+        }
+
+
+def write_rows(rows: Iterable[dict], path: str, fields: list[str], output_format: str = 'csv') -> int:
+    """Write rows to CSV or JSONL file one by one.
+
+    Return:
+        int: Number of written rows
+    """
+    written = 0
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        if output_format == 'csv':
+            writer = csv.DictWriter(file, fieldnames=fields)
+            writer.writeheader()
+        for row in rows:
+            if output_format == 'csv':
+                writer.writerow(row)
+            else:
+                file.write(json.dumps(row, ensure_ascii=False, default=str) + '\n')
+            written += 1
+    return written
+
+
+async def export_orders(strapi_client: AsyncStrapiClient,
+                        output_dir: str = '.',
+                        output_format: str = 'csv',
+                        page_size: int = 100,
+                        prefetch: int = 4) -> dict:
+    """Write totals per customer and per product into `customers.<format>` and `products.<format>`.
+
+    Return:
+        dict: Paths of written reports and numbers of rows
+    """
+    try:
+        totals = await collect_totals(strapi_client, page_size, prefetch)
+    finally:
+        await strapi_client.close()
+    if totals['orphans']:
+        logger.warning('%s ordered products without cart, owner or product were skipped', totals['orphans'])
+    os.makedirs(output_dir, exist_ok=True)
+    customers_path = os.path.join(output_dir, f'customers.{output_format}')
+    products_path = os.path.join(output_dir, f'products.{output_format}')
+    return {
+        customers_path: write_rows(iter_customer_rows(totals['customers'], totals['emails']),
+                                   customers_path,
+                                   CUSTOMER_FIELDS,
+                                   output_format),
+        products_path: write_rows(iter_product_rows(totals['products']),
+                                  products_path,
+                                  PRODUCT_FIELDS,
+                                  output_format),
+    }
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Export order totals per customer and per product from STRAPI')
+    parser.add_argument('--output-dir', default='.', help='Directory for customers and products reports')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), default='csv', help='Format of reports')
+    parser.add_argument('--page-size', type=int, default=100, help='Number of entries in a STRAPI page')
+    parser.add_argument('--prefetch', type=int, default=4, help='Number of pages fetched concurrently')
+    args = parser.parse_args()
+    env = Env()
+    env.read_env()
+    strapi_client = AsyncStrapiClient(env.str('STRAPI_HOST', 'http://localhost:1337/'),
+                                      env.str('STRAPI_TOKEN'),
+                                      get_models_config(env),
+                                      pool_size=args.prefetch * 2,
+                                      timeout=(env.float('STRAPI_CONNECT_TIMEOUT', 3.05),
+                                               env.float('STRAPI_READ_TIMEOUT', 10)))
+    reports = asyncio.run(export_orders(strapi_client, args.output_dir, args.format, args.page_size, args.prefetch))
+    for path, rows in reports.items():
+        logger.info('%s rows written to %s', rows, path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,487 @@
+"""In-memory fakes of STRAPI and Redis shared by the benchmark and tests.
+
+They don't depend on python-telegram-bot, so tests of both bot engines can use them.
+"""
+import asyncio
+import fnmatch
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from urllib.parse import parse_qs, urlparse
+
+import redis
+
+
+class FakeStrapi:
+    """In-memory STRAPI serving products, carts, ordered products and customers over HTTP.
+
+    Args:
+        products_count(int): Number of products in the catalog.
+        latency(float): Delay of every response in seconds.
+        image_size(int): Size of product images in bytes.
+    """
+
+    def __init__(self, products_count: int = 40, latency: float = 0, image_size: int = 200_000):
+        self.latency = latency
+        self.image = os.urandom(image_size)
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._ids = count(1)
+        self.products = {
+            product_id: {
+                'Title': f'Рыба №{product_id}',
+                'Description': f'Свежемороженая рыба №{product_id}, 1 кг',
+                'Price': 100 + product_id,
+                'Image': {'url': f'/uploads/fish_{product_id}.png', 'updatedAt': '2023-09-08T09:30:42.656Z'},
+            } for product_id in range(1, products_count + 1)
+        }
+        self.carts = {}
+        self.ordered_products = {}
+        self.customers = {}
+        self.server = None
+
+    def start(self) -> str:
+        """Start server in a background thread and return its url."""
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._get_handler(), bind_and_activate=False)
+        # Default backlog of 5 connections makes concurrent clients wait for SYN retransmits
+        self.server.request_queue_size = 1024
+        self.server.server_bind()
+        self.server.server_activate()
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='fake-strapi', daemon=True).start()
+        return f'http://127.0.0.1:{self.server.server_port}/'
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method: str, path: str, query: dict, body: dict) -> tuple[int, dict | bytes]:
+        parts = path.strip('/').split('/')
+        if parts[0] == 'uploads':
+            self._count(method, '/uploads/*')
+            return 200, self.image
+        model, entity_id = parts[1], int(parts[2]) if len(parts) > 2 else None
+        self._count(method, f'/api/{model}' + ('/:id' if entity_id else ''))
+        with self._lock:
+            handler = getattr(self, f'_{method.lower()}_{model.replace("-", "_")}', None)
+            if not handler:
+                return 405, {'error': {'status': 405}}
+            return handler(entity_id, query, body)
+
+    def _count(self, method: str, endpoint: str):
+        with self._lock:
+            self.calls[f'{method} {endpoint}'] += 1
+
+    def _get_products(self, product_id: int, query: dict, body: dict):
+        if product_id:
+            if product_id not in self.products:
+                return 404, {'error': {'status': 404}}
+            product = self.products[product_id]
+            attributes = {**product, 'Image': {'data': {'id': product_id, 'attributes': product['Image']}}}
+            return 200, {'data': {'id': product_id, 'attributes': attributes}}
+        products = [
+            {'id': product_id, 'attributes': {'Title': product['Title']}} for product_id, product in self.products.items()
+        ]
+        return 200, paginate(products, query)
+
+    def _get_carts(self, cart_id: int, query: dict, body: dict):
+        if cart_id:
+            if cart_id not in self.carts:
+                return 404, {'error': {'status': 404}}
+            return 200, {'data': self._render_cart(cart_id)}
+        user_tg_id = query.get('filters[user_tg_id][$eq]')
+        carts = [
+            self._render_cart(cart_id) for cart_id, cart in self.carts.items()
+            if user_tg_id is None or str(cart['user_tg_id']) == user_tg_id
+        ]
+        return 200, paginate(carts, query)
+
+    def _post_carts(self, cart_id: int, query: dict, body: dict):
+        cart_id = next(self._ids)
+        self.carts[cart_id] = {'user_tg_id': body['data']['user_tg_id']}
+        return 200, {'data': self._render_cart(cart_id)}
+
+    def _render_cart(self, cart_id: int) -> dict:
+        ordered_products = [
+            self._render_ordered_product(ordered_product_id)
+            for ordered_product_id, ordered_product in self.ordered_products.items()
+            if ordered_product['cart'] == cart_id
+        ]
+        return {
+            'id': cart_id,
+            'attributes': {
+                'user_tg_id': self.carts[cart_id]['user_tg_id'],
+                'ordered_products': {'data': ordered_products},
+            },
+        }
+
+    def _render_ordered_product(self, ordered_product_id: int) -> dict:
+        ordered_product = self.ordered_products[ordered_product_id]
+        product_id = ordered_product['product']
+        return {
+            'id': ordered_product_id,
+            'attributes': {
+                'amount': ordered_product['amount'],
+                'fixed_price': ordered_product['fixed_price'],
+                'product': {'data': {'id': product_id, 'attributes': {'Title': self.products[product_id]['Title']}}},
+                'cart': {'data': {'id': ordered_product['cart'], 'attributes': {}}},
+            },
+        }
+
+    def _get_ordered_products(self, ordered_product_id: int, query: dict, body: dict):
+        ordered_products = [self._render_ordered_product(ordered_product_id) for ordered_product_id in self.ordered_products]
+        return 200, paginate(ordered_products, query)
+
+    def _post_ordered_products(self, ordered_product_id: int, query: dict, body: dict):
+        data = body['data']
+        ordered_product_id = next(self._ids)
+        self.ordered_products[ordered_product_id] = {
+            'product': data['product']['connect'][0],
+            'cart': int(data['cart']['connect'][0]),
+            'amount': data['amount'],
+            'fixed_price': data['fixed_price'],
+        }
+        return 200, {'data': self._render_ordered_product(ordered_product_id)}
+
+    def _put_ordered_products(self, ordered_product_id: int, query: dict, body: dict):
+        if ordered_product_id not in self.ordered_products:
+            return 404, {'error': {'status': 404}}
+        data = body['data']
+        ordered_product = self.ordered_products[ordered_product_id]
+        if 'amount' in data:
+            ordered_product['amount'] = data['amount']
+        if 'cart' in data:
+            ordered_product['cart'] = int(data['cart']['connect'][0])
+        return 200, {'data': self._render_ordered_product(ordered_product_id)}
+
+    def _delete_ordered_products(self, ordered_product_id: int, query: dict, body: dict):
+        if ordered_product_id not in self.ordered_products:
+            return 404, {'error': {'status': 404}}
+        rendered = self._render_ordered_product(ordered_product_id)
+        del self.ordered_products[ordered_product_id]
+        return 200, {'data': rendered}
+
+    def _get_customers(self, customer_id: int, query: dict, body: dict):
+        telegram_id = query.get('filters[telegram_id][$eq]')
+        customers = [
+            {'id': customer_id, 'attributes': customer} for customer_id, customer in self.customers.items()
+            if telegram_id is None or str(customer['telegram_id']) == telegram_id
+        ]
+        return 200, paginate(customers, query)
+
+    def _post_customers(self, customer_id: int, query: dict, body: dict):
+        customer_id = next(self._ids)
+        self.customers[customer_id] = {'telegram_id': body['data']['telegram_id'], 'email': None}
+        return 200, {'data': {'id': customer_id, 'attributes': self.customers[customer_id]}}
+
+    def _put_customers(self, customer_id: int, query: dict, body: dict):
+        if customer_id not in self.customers:
+            return 404, {'error': {'status': 404}}
+        email = body['data'].get('email')
+        if email is not None and not re.fullmatch(r'[^@\s]+@[^@\s]+\.[^@\s]+', email):
+            return 400, {'error': {'status': 400, 'name': 'ValidationError'}}
+        self.customers[customer_id]['email'] = email
+        return 200, {'data': {'id': customer_id, 'attributes': self.customers[customer_id]}}
+
+    def _get_handler(self) -> type[BaseHTTPRequestHandler]:
+        fake_strapi = self
+
+        class FakeStrapiHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def handle_method(self):
+                url = urlparse(self.path)
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length)) if length else {}
+                time.sleep(fake_strapi.latency)
+                status, response = fake_strapi.handle(self.command, url.path, query, body)
+                payload = response if isinstance(response, bytes) else json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'image/png' if isinstance(response, bytes) else 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_DELETE = handle_method
+
+            def log_message(self, format, *args):
+                pass
+
+        return FakeStrapiHandler
+
+
+def paginate(items: list, query: dict) -> dict:
+    page = int(query.get('pagination[page]', 1))
+    page_size = int(query.get('pagination[pageSize]', 25))
+    return {
+        'data': items[(page - 1) * page_size:page * page_size],
+        'meta': {
+            'pagination': {
+                'page': page,
+                'pageSize': page_size,
+                'pageCount': max(1, -(-len(items) // page_size)),
+                'total': len(items),
+            }
+        },
+    }
+
+
+class FakeRedis:
+    """In-memory substitute of `redis.Redis(decode_responses=True)` with commands used by the bot."""
+
+    def __init__(self):
+        self.commands = 0
+        self._data = {}
+        self._expire_at = {}
+        self._lock = threading.RLock()
+        self._locks = defaultdict(threading.Lock)
+
+    def _get(self, key: str):
+        if key in self._expire_at and self._expire_at[key] <= time.monotonic():
+            self._data.pop(key, None)
+            self._expire_at.pop(key)
+        return self._data.get(key)
+
+    def _command(method):
+        def locked_command(self, *args, **kwargs):
+            with self._lock:
+                self.commands += 1
+                return method(self, *args, **kwargs)
+        return locked_command
+
+    @_command
+    def ping(self):
+        return True
+
+    @_command
+    def get(self, key: str):
+        return self._get(key)
+
+    @_command
+    def set(self, key: str, value, nx: bool = False, ex: float = None, px: float = None):
+        if nx and self._get(key) is not None:
+            return None
+        self._data[key] = str(value)
+        self._expire_at.pop(key, None)
+        if ex or px:
+            self._expire_at[key] = time.monotonic() + (ex or px / 1000)
+        return True
+
+    @_command
+    def delete(self, *keys: str):
+        deleted = 0
+        for key in keys:
+            deleted += self._data.pop(key, None) is not None
+            self._expire_at.pop(key, None)
+        return deleted
+
+    @_command
+    def exists(self, *keys: str):
+        return sum(self._get(key) is not None for key in keys)
+
+    @_command
+    def expire(self, key: str, seconds: float):
+        if self._get(key) is None:
+            return False
+        self._expire_at[key] = time.monotonic() + seconds
+        return True
+
+    @_command
+    def keys(self, pattern: str = '*'):
+        return [key for key in list(self._data) if self._get(key) is not None and fnmatch.fnmatchcase(key, pattern)]
+
+    @_command
+    def hget(self, key: str, field: str):
+        return (self._get(key) or {}).get(field)
+
+    @_command
+    def hgetall(self, key: str):
+        return dict(self._get(key) or {})
+
+    @_command
+    def hset(self, key: str, field: str = None, value=None, mapping: dict = None):
+        fields = {**({field: value} if field is not None else {}), **(mapping or {})}
+        hash_value = self._get(key)
+        if hash_value is None:
+            hash_value = self._data[key] = {}
+        hash_value.update({name: str(field_value) for name, field_value in fields.items()})
+        return len(fields)
+
+    @_command
+    def hdel(self, key: str, *fields: str):
+        hash_value = self._get(key) or {}
+        return sum(hash_value.pop(field, None) is not None for field in fields)
+
+    @_command
+    def lpush(self, key: str, *values: str):
+        list_value = self._get_list(key)
+        for value in values:
+            list_value.insert(0, str(value))
+        return len(list_value)
+
+    @_command
+    def rpush(self, key: str, *values: str):
+        list_value = self._get_list(key)
+        list_value.extend(str(value) for value in values)
+        return len(list_value)
+
+    @_command
+    def llen(self, key: str):
+        return len(self._get(key) or [])
+
+    @_command
+    def lrem(self, key: str, count: int, value: str):
+        list_value = self._get(key) or []
+        removed = 0
+        while value in list_value and (not count or removed < count):
+            list_value.remove(value)
+            removed += 1
+        return removed
+
+    @_command
+    def lmove(self, first_list: str, second_list: str, src: str = 'LEFT', dest: str = 'RIGHT'):
+        source = self._get(first_list)
+        if not source:
+            return None
+        value = source.pop(0 if src == 'LEFT' else -1)
+        destination = self._get_list(second_list)
+        destination.insert(0 if dest == 'LEFT' else len(destination), value)
+        return value
+
+    def rpoplpush(self, src: str, dst: str):
+        return self.lmove(src, dst, 'RIGHT', 'LEFT')
+
+    def _get_list(self, key: str) -> list:
+        list_value = self._get(key)
+        if list_value is None:
+            list_value = self._data[key] = []
+        return list_value
+
+    @_command
+    def xadd(self, key: str, fields: dict) -> str:
+        stream = self._get_stream(key)
+        stream['last_id'] += 1
+        entry_id = f'{stream["last_id"]}-0'
+        stream['entries'][entry_id] = {name: str(value) for name, value in fields.items()}
+        return entry_id
+
+    @_command
+    def xlen(self, key: str) -> int:
+        return len(self._get_stream(key)['entries'])
+
+    @_command
+    def xgroup_create(self, key: str, group: str, id: str = '$', mkstream: bool = False):
+        stream = self._get_stream(key)
+        if group in stream['groups']:
+            raise redis.exceptions.ResponseError('BUSYGROUP Consumer Group name already exists')
+        stream['groups'][group] = {'last_delivered': 0 if id == '0' else stream['last_id'], 'pending': {}}
+        return True
+
+    def xreadgroup(self, group: str, consumer: str, streams: dict, count: int = None, block: int = None) -> list:
+        deadline = time.monotonic() + (block or 0) / 1000
+        (key, last_id), = streams.items()
+        while True:
+            with self._lock:
+                self.commands += 1
+                entries = self._read_group(key, group, consumer, last_id, count)
+            if entries or last_id != '>' or time.monotonic() >= deadline:
+                return [[key, entries]] if entries else []
+            time.sleep(0.005)
+
+    @_command
+    def xack(self, key: str, group: str, *ids: str) -> int:
+        pending = self._get_stream(key)['groups'][group]['pending']
+        return sum(pending.pop(entry_id, None) is not None for entry_id in ids)
+
+    @_command
+    def xdel(self, key: str, *ids: str) -> int:
+        entries = self._get_stream(key)['entries']
+        return sum(entries.pop(entry_id, None) is not None for entry_id in ids)
+
+    def _get_stream(self, key: str) -> dict:
+        stream = self._get(key)
+        if stream is None:
+            stream = self._data[key] = {'entries': {}, 'groups': {}, 'last_id': 0}
+        return stream
+
+    def _read_group(self, key: str, group: str, consumer: str, last_id: str, count: int = None) -> list:
+        stream = self._get_stream(key)
+        group_state = stream['groups'][group]
+        if last_id != '>':
+            # Pending entries of the consumer, deleted ones are returned without fields
+            pending = [entry_id for entry_id, owner in group_state['pending'].items() if owner == consumer]
+            return [(entry_id, stream['entries'].get(entry_id)) for entry_id in pending[:count]]
+        new_ids = [
+            entry_id for entry_id in stream['entries'] if int(entry_id.split('-')[0]) > group_state['last_delivered']
+        ][:count]
+        for entry_id in new_ids:
+            group_state['pending'][entry_id] = consumer
+            group_state['last_delivered'] = int(entry_id.split('-')[0])
+        return [(entry_id, stream['entries'][entry_id]) for entry_id in new_ids]
+
+    def pipeline(self, transaction: bool = True):
+        return FakePipeline(self)
+
+    def lock(self, name: str, timeout: float = None, blocking_timeout: float = None):
+        with self._lock:
+            return self._locks[name]
+
+    _command = staticmethod(_command)
+
+
+class FakePipeline:
+    def __init__(self, redis_db: FakeRedis):
+        self.redis_db = redis_db
+        self._commands = []
+
+    def __getattr__(self, name: str):
+        def add_command(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+        return add_command
+
+    def execute(self) -> list:
+        with self.redis_db._lock:
+            results = [getattr(self.redis_db, name)(*args, **kwargs) for name, args, kwargs in self._commands]
+        self._commands = []
+        return results
+
+
+class FakeAsyncRedis:
+    """Substitute of `redis.asyncio.Redis(decode_responses=True)` running commands of `FakeRedis`.
+
+    Args:
+        redis_db(FakeRedis): Storage, may be shared with a synchronous fake.
+    """
+
+    def __init__(self, redis_db: FakeRedis = None):
+        self.redis_db = redis_db or FakeRedis()
+        self._locks = defaultdict(asyncio.Lock)
+
+    def __getattr__(self, name: str):
+        command = getattr(self.redis_db, name)
+
+        async def run_command(*args, **kwargs):
+            return command(*args, **kwargs)
+        return run_command
+
+    def pipeline(self, transaction: bool = True):
+        return FakeAsyncPipeline(self.redis_db)
+
+    def lock(self, name: str, timeout: float = None, blocking_timeout: float = None):
+        return self._locks[name]
+
+    async def close(self):
+        pass
+
+
+class FakeAsyncPipeline(FakePipeline):
+    async def execute(self) -> list:
+        return super().execute()
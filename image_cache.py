@@ -0,0 +1,148 @@
+import hashlib
+import os
+from io import BytesIO
+
+import redis
+import redis.asyncio
+from telegram import Message
+
+import async_strapi_api
+from async_strapi_api import AsyncStrapiClient
+from strapi_api import StrapiClient
+from strapi_api import get_product_img
+
+
+class ProductImageCache:
+    """Cache of product images already uploaded to Telegram.
+
+    After the first upload Telegram returns `file_id` of the photo,
+    which is kept in Redis and sent instead of image bytes on next views.
+    Optionally image bytes are also kept on disk, so a cold start does not
+    download images from STRAPI again.
+    Methods with `_async` suffix do the same with async Redis connection and STRAPI client.
+
+    Args:
+        redis_db(redis.Redis): Redis connection, may be None if only `_async` methods are used.
+        strapi_client(StrapiClient): STRAPI client, may be None if only `_async` methods are used.
+        cache_dir(str): Directory for image bytes. Disk cache is disabled by default.
+        key_prefix(str): Prefix of Redis keys.
+        async_redis_db(redis.asyncio.Redis): Redis connection for `_async` methods.
+        async_strapi_client(AsyncStrapiClient): STRAPI client for `_async` methods.
+    """
+
+    def __init__(self,
+                 redis_db: redis.Redis,
+                 strapi_client: StrapiClient,
+                 cache_dir: str = None,
+                 key_prefix: str = 'fish_shop:tg_file_id',
+                 async_redis_db: redis.asyncio.Redis = None,
+                 async_strapi_client: AsyncStrapiClient = None):
+        self.redis_db = redis_db
+        self.strapi_client = strapi_client
+        self.async_redis_db = async_redis_db
+        self.async_strapi_client = async_strapi_client
+        self.cache_dir = cache_dir
+        self.key_prefix = key_prefix
+        self.hits = 0
+        self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, product_id: int | str, image: dict) -> str:
+        """Get cache key of the product image.
+
+        Args:
+            product_id(int | str): Product ID
+            image(dict): Image attributes from STRAPI, e.g. `product['Image']['data']['attributes']`
+        """
+        return f'{self.key_prefix}:{product_id}:{image["url"]}:{image.get("updatedAt", "")}'
+
+    def get_photo(self, product_id: int | str, image: dict) -> str | BytesIO:
+        """Get Telegram file_id of the product image or its bytes if it was never uploaded."""
+        key = self.get_key(product_id, image)
+        file_id = self.redis_db.get(key)
+        if file_id:
+            self.hits += 1
+            return file_id
+        self.misses += 1
+        photo = self.read_file(product_id, image)
+        if photo:
+            return photo
+        photo = get_product_img(self.strapi_client, image['url'])
+        if self.cache_dir:
+            self.save_file(product_id, image, photo.getvalue())
+        return photo
+
+    async def get_photo_async(self, product_id: int | str, image: dict) -> str | BytesIO:
+        key = self.get_key(product_id, image)
+        file_id = await self.async_redis_db.get(key)
+        if file_id:
+            self.hits += 1
+            return file_id
+        self.misses += 1
+        photo = self.read_file(product_id, image)
+        if photo:
+            return photo
+        photo = await async_strapi_api.get_product_img(self.async_strapi_client, image['url'])
+        if self.cache_dir:
+            self.save_file(product_id, image, photo.getvalue())
+        return photo
+
+    def get_path(self, product_id: int | str, image: dict) -> str:
+        """Get path of the image in disk cache."""
+        return os.path.join(self.cache_dir, hashlib.sha1(self.get_key(product_id, image).encode()).hexdigest())
+
+    def read_file(self, product_id: int | str, image: dict) -> BytesIO | None:
+        """Read image bytes from disk cache, None if they are not cached."""
+        if not self.cache_dir:
+            return None
+        img_path = self.get_path(product_id, image)
+        if not os.path.exists(img_path):
+            return None
+        with open(img_path, 'rb') as img_file:
+            return BytesIO(img_file.read())
+
+    def save_file(self, product_id: int | str, image: dict, content: bytes):
+        """Save image bytes into disk cache."""
+        img_path = self.get_path(product_id, image)
+        tmp_path = f'{img_path}.tmp{os.getpid()}'
+        with open(tmp_path, 'wb') as img_file:
+            img_file.write(content)
+        os.replace(tmp_path, img_path)
+
+    def get_missing(self, images: dict) -> dict:
+        """Select images which were never uploaded to Telegram and are not in disk cache.
+
+        Args:
+            images(dict): Image attributes by product ID
+        Return:
+            dict: Missing images by product ID
+        """
+        pipeline = self.redis_db.pipeline(transaction=False)
+        for product_id, image in images.items():
+            pipeline.exists(self.get_key(product_id, image))
+        uploaded = pipeline.execute()
+        return {
+            product_id: image for (product_id, image), is_uploaded in zip(images.items(), uploaded)
+            if not is_uploaded and not (self.cache_dir and os.path.exists(self.get_path(product_id, image)))
+        }
+
+    def remember(self, product_id: int | str, image: dict, message: Message):
+        """Save file_id of the photo from the message sent to Telegram."""
+        self.redis_db.set(self.get_key(product_id, image), message.photo[-1].file_id)
+
+    async def remember_async(self, product_id: int | str, image: dict, message: Message):
+        await self.async_redis_db.set(self.get_key(product_id, image), message.photo[-1].file_id)
+
+    def forget(self, product_id: int | str, image: dict):
+        self.redis_db.delete(self.get_key(product_id, image))
+
+    async def forget_async(self, product_id: int | str, image: dict):
+        await self.async_redis_db.delete(self.get_key(product_id, image))
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / (self.hits + self.misses) if self.hits + self.misses else 0,
+        }
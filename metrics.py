@@ -0,0 +1,152 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+from environs import Env
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics:
+    """Thread-safe registry of counters, latency histograms and gauges.
+
+    Metrics are rendered in Prometheus text format.
+
+    Args:
+        buckets(tuple): Upper bounds of histogram buckets in seconds.
+    """
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def inc(self, name: str, labels: dict = None, value: float = 1):
+        key = (name, _freeze(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: dict = None):
+        key = (name, _freeze(labels))
+        with self._lock:
+            histogram = self._histograms.setdefault(key, [[0] * len(self.buckets), 0, 0])
+            bucket = bisect_left(self.buckets, value)
+            if bucket < len(self.buckets):
+                histogram[0][bucket] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name: str, labels: dict = None):
+        """Observe duration of the block in seconds."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started_at, labels)
+
+    @contextmanager
+    def track_call(self, name: str, labels: dict = None):
+        """Observe duration of the call made in the block and count it by status.
+
+        The block sets `status` of the yielded dict, e.g. to HTTP status code.
+        Records histogram `<name>_seconds` and counter `<name>s_total`.
+        """
+        call = {'status': 'error'}
+        started_at = time.perf_counter()
+        try:
+            yield call
+        finally:
+            self.observe(f'{name}_seconds', time.perf_counter() - started_at, labels)
+            self.inc(f'{name}s_total', {**(labels or {}), 'status': call['status']})
+
+    def register_gauges(self, prefix: str, get_values: Callable[[], dict]):
+        """Register function returning current values of gauges, e.g. `CatalogCache.stats`.
+
+        Each key of returned dict becomes a gauge `<prefix>_<key>`.
+        """
+        with self._lock:
+            self._gauges[prefix] = get_values
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(counts), total, count) for key, (counts, total, count) in self._histograms.items()}
+            gauges = dict(self._gauges)
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(f'{name}{_render_labels(labels)} {value}')
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            cumulative = 0
+            for upper_bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{_render_labels(labels + (("le", upper_bound),))} {cumulative}')
+            lines.append(f'{name}_bucket{_render_labels(labels + (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{_render_labels(labels)} {total}')
+            lines.append(f'{name}_count{_render_labels(labels)} {count}')
+        for prefix, get_values in sorted(gauges.items()):
+            for name, value in get_values().items():
+                lines.append(f'{prefix}_{name} {float(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def start_http_server(self, listen: str = '127.0.0.1', port: int = 9100) -> ThreadingHTTPServer:
+        """Serve metrics by GET at `/metrics` in a background thread."""
+        server = ThreadingHTTPServer((listen, port), get_metrics_handler(self))
+        threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+        return server
+
+    def start_log_dump(self, interval: float = 60):
+        """Write all metrics into the log every `interval` seconds in a background thread."""
+        def dump():
+            while True:
+                time.sleep(interval)
+                logger.info('Metrics:\n%s', self.render())
+        threading.Thread(target=dump, name='metrics-log-dump', daemon=True).start()
+
+
+def get_metrics_handler(metrics: Metrics) -> type[BaseHTTPRequestHandler]:
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return MetricsHandler
+
+
+def start_metrics(metrics: Metrics, env: Env):
+    """Start metrics exporters configured by METRICS_PORT and METRICS_LOG_INTERVAL."""
+    metrics_port = env.int('METRICS_PORT', None)
+    metrics_log_interval = env.float('METRICS_LOG_INTERVAL', None)
+    if metrics_port:
+        metrics.start_http_server(env.str('METRICS_LISTEN', '127.0.0.1'), metrics_port)
+    if metrics_log_interval:
+        metrics.start_log_dump(metrics_log_interval)
+
+
+def _freeze(labels: dict = None) -> tuple:
+    return tuple(sorted((name, str(value)) for name, value in (labels or {}).items()))
+
+
+def _render_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    rendered_labels = ','.join(f'{name}="{value}"' for name, value in labels)
+    return f'{{{rendered_labels}}}'
@@ -0,0 +1,21 @@
+from environs import Env
+
+
+def get_models_config(env: Env) -> dict:
+    """Read names of STRAPI models from the environment.
+
+    Shared by the bot and batch scripts, e.g. `export_orders.py`.
+    """
+    strapi_product_name = env.str('PRODUCT', 'product')
+    strapi_product_name_plural = env.str('PRODUCT_PLURAL', 'products')
+    strapi_ordered_product_name_plural = env.str('ORDERED_PRODUCT_PLURAL', 'ordered-products')
+    strapi_cart_name_plural = env.str('CART_PLURAL', 'carts')
+    strapi_customer_name_plural = env.str('CUSTOMER_PLURAL', 'customers')
+
+    return {
+        'strapi_product_name': strapi_product_name,
+        'strapi_product_name_plural': strapi_product_name_plural,
+        'strapi_ordered_product_name_plural': strapi_ordered_product_name_plural,
+        'strapi_cart_name_plural': strapi_cart_name_plural,
+        'strapi_customer_name_plural': strapi_customer_name_plural
+    }
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+import requests
+from telegram import Bot
+
+import async_strapi_api
+from async_strapi_api import AsyncStrapiClient
+from catalog_cache import CatalogCache
+from image_cache import ProductImageCache
+from strapi_api import StrapiClient
+
+logger = logging.getLogger(__name__)
+
+
+def prewarm(bot_data: dict, bot: Bot = None, snapshot_key: str = 'fish_shop:catalog_snapshot') -> dict:
+    """Warm connections and caches before the bot starts receiving updates.
+
+    Catalog snapshot saved by the previous run is restored first, so the menu is served
+    even if STRAPI is slow to answer. Then concurrently: STRAPI models are validated
+    through the pooled client, Redis and Telegram connections are opened, and the whole
+    catalog with product details is loaded through the async client. Images of products
+    which were never uploaded to Telegram are downloaded into the disk cache if it is enabled.
+    Fresh catalog is saved as the snapshot for the next run.
+
+    Args:
+        bot_data(dict): Bot data filled by `init_bot_data`
+        bot(Bot): Telegram bot to open connection to Telegram API
+        snapshot_key(str): Redis key of catalog snapshot
+    Return:
+        dict: Durations of prewarm steps in seconds, `total` included
+    Raises:
+        ValueError: If configured STRAPI models are not available
+    """
+    redis_db = bot_data['redis_db']
+    metrics = bot_data['metrics']
+    catalog = bot_data['catalog']
+    started_at = time.perf_counter()
+    durations = {}
+
+    def run_step(step: str, function, *args):
+        step_started_at = time.perf_counter()
+        try:
+            with metrics.timer('bot_prewarm_seconds', {'step': step}):
+                return function(*args)
+        finally:
+            durations[step] = time.perf_counter() - step_started_at
+
+    restored = run_step('snapshot',
+                        restore_catalog_snapshot,
+                        redis_db,
+                        catalog,
+                        bot_data['catalog_page_size'],
+                        snapshot_key)
+    if restored:
+        logger.info('Catalog snapshot restored: %s products', restored)
+
+    with ThreadPoolExecutor(max_workers=4, thread_name_prefix='prewarm') as executor:
+        steps = {
+            'models': executor.submit(run_step, 'models', validate_models, bot_data['strapi_client']),
+            'redis': executor.submit(run_step, 'redis', redis_db.ping),
+            'catalog': executor.submit(run_step,
+                                       'catalog',
+                                       bot_data['async_runner'].run,
+                                       load_catalog(bot_data['async_strapi_client'], catalog.max_details)),
+        }
+        if bot:
+            steps['telegram'] = executor.submit(run_step, 'telegram', bot.get_me)
+        for step, future in steps.items():
+            try:
+                future.result()
+            except Exception:
+                logger.exception('Prewarm step %s failed', step)
+    invalid_models = not steps['models'].exception() and steps['models'].result()
+    if invalid_models:
+        raise ValueError(f'STRAPI models are not available: {", ".join(invalid_models)}')
+
+    catalog_step = steps['catalog']
+    if not catalog_step.exception():
+        products, details = catalog_step.result()
+        catalog.fill(products, details, bot_data['catalog_page_size'])
+        save_catalog_snapshot(redis_db, catalog, snapshot_key)
+        image_cache = bot_data['image_cache']
+        if image_cache.cache_dir:
+            images = {
+                product_id: detail['Image']['data']['attributes']
+                for product_id, detail in details.items() if detail['Image']['data']
+            }
+            try:
+                missing_images = image_cache.get_missing(images)
+                run_step('images',
+                         bot_data['async_runner'].run,
+                         load_images(bot_data['async_strapi_client'], image_cache, missing_images))
+            except Exception:
+                logger.exception('Prewarm step images failed')
+
+    durations['total'] = time.perf_counter() - started_at
+    metrics.observe('bot_startup_seconds', durations['total'])
+    return durations
+
+
+def validate_models(strapi_client: StrapiClient) -> list[str]:
+    """Request one entity of every configured model to open pooled connections and check model names.
+
+    Return:
+        list: Models which STRAPI does not have or the token has no access to
+    """
+    plural_keys = [key for key in strapi_client.models_config if key.endswith('_plural')]
+    with ThreadPoolExecutor(max_workers=len(plural_keys)) as executor:
+        responses = {
+            key: executor.submit(strapi_client.request, 'GET', key, params={'pagination[pageSize]': 1})
+            for key in plural_keys
+        }
+    invalid_models = []
+    for key, response in responses.items():
+        error = response.exception()
+        if isinstance(error, requests.exceptions.HTTPError) and error.response.status_code in (401, 403, 404):
+            invalid_models.append(f'{strapi_client.models_config[key]} ({error.response.status_code})')
+        elif error:
+            raise error
+    return invalid_models
+
+
+async def load_catalog(strapi_client: AsyncStrapiClient, max_details: int) -> tuple[list[dict], dict]:
+    """Load all products and details of the first `max_details` of them concurrently.
+
+    Return:
+        tuple: Products and product details by product ID
+    """
+    products = await async_strapi_api.get_products(strapi_client)
+    product_ids = [str(product['id']) for product in products[:max_details]]
+    details = await asyncio.gather(*[
+        async_strapi_api.get_product_detail(strapi_client, product_id) for product_id in product_ids
+    ], return_exceptions=True)
+    return products, {
+        product_id: detail for product_id, detail in zip(product_ids, details) if not isinstance(detail, Exception)
+    }
+
+
+async def load_images(strapi_client: AsyncStrapiClient, image_cache: ProductImageCache, images: dict):
+    """Download images concurrently into disk cache of `ProductImageCache`."""
+    async def load_image(product_id, image):
+        image_cache.save_file(product_id, image, await strapi_client.get_file(image['url']))
+
+    await asyncio.gather(*[load_image(product_id, image) for product_id, image in images.items()])
+
+
+def save_catalog_snapshot(redis_db: redis.Redis, catalog: CatalogCache, snapshot_key: str):
+    redis_db.set(snapshot_key, json.dumps(catalog.snapshot()))
+
+
+def restore_catalog_snapshot(redis_db: redis.Redis, catalog: CatalogCache, page_size: int, snapshot_key: str) -> int:
+    """Fill catalog cache from the snapshot.
+
+    Return:
+        int: Number of restored products
+    """
+    snapshot = redis_db.get(snapshot_key)
+    if not snapshot:
+        return 0
+    snapshot = json.loads(snapshot)
+    catalog.fill(snapshot['products'], snapshot['details'], page_size)
+    return len(snapshot['products'])
@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+from catalog_cache import CatalogCache
+
+
+class RenderCache:
+    """Screens rendered from the catalog and shared by all chats.
+
+    A screen, e.g. serialized keyboard of a menu page or caption and keyboard of a product card,
+    is rendered once and reused until the catalog version changes or `ttl` of the catalog expires.
+
+    Args:
+        catalog(CatalogCache): Catalog screens are rendered from
+        max_screens(int): Max number of cached screens, evicted in LRU order.
+    """
+
+    def __init__(self, catalog: CatalogCache, max_screens: int = 512):
+        self.catalog = catalog
+        self.max_screens = max_screens
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._version = None
+        self._screens = OrderedDict()
+
+    def get(self, key, render: Callable):
+        """Get cached screen or render it.
+
+        Args:
+            key: Screen key, e.g. `('menu', page, page_size)`
+            render(Callable): Function getting data from the catalog and rendering the screen
+        """
+        version, screen = self._get_cached(key)
+        if screen is not None:
+            return screen
+        screen = render()
+        self._save(version, key, screen)
+        return screen
+
+    async def get_async(self, key, render: Callable[[], Awaitable]):
+        """Same as `get`, but the screen is rendered by a coroutine function."""
+        version, screen = self._get_cached(key)
+        if screen is not None:
+            return screen
+        screen = await render()
+        self._save(version, key, screen)
+        return screen
+
+    def _get_cached(self, key) -> tuple:
+        """Get catalog version and the cached screen, None if it is not cached or expired."""
+        with self._lock:
+            version = self.catalog.version
+            if version != self._version:
+                self._screens.clear()
+                self._version = version
+            cached = self._screens.get(key)
+            if cached and cached[0] > time.monotonic():
+                self._screens.move_to_end(key)
+                self.hits += 1
+                return version, cached[1]
+            self.misses += 1
+            return version, None
+
+    def _save(self, version: int, key, screen):
+        with self._lock:
+            # Screen rendered from the catalog which changed meanwhile is not saved
+            if self.catalog.version == version == self._version:
+                self._screens[key] = (time.monotonic() + self.catalog.ttl, screen)
+                self._screens.move_to_end(key)
+                while len(self._screens) > self.max_screens:
+                    self._screens.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / (self.hits + self.misses) if self.hits + self.misses else 0,
+                'screens_cached': len(self._screens),
+            }
@@ -0,0 +1,258 @@
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import aiohttp
+import requests
+
+
+class StrapiUnavailableError(requests.exceptions.ConnectionError):
+    """STRAPI call was rejected without sending it: circuit is open or too many calls are waiting."""
+
+
+class TokenBucket:
+    """Token bucket rate limiter.
+
+    Args:
+        rate(float): Tokens added per second.
+        capacity(float): Max number of tokens, i.e. allowed burst. Equals the rate by default, but not less than one token.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = max(1, capacity or rate)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: float = None) -> bool:
+        """Take a token, waiting for it at most `timeout` seconds.
+
+        Return:
+            bool: False if no token became available in time
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._take()
+            if not wait:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    async def acquire_async(self, timeout: float = None) -> bool:
+        """Same as `acquire`, but waits without blocking the event loop."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._take()
+            if not wait:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+    def _take(self) -> float:
+        """Take a token if there is one, otherwise return seconds until it appears."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+
+class CircuitBreaker:
+    """Circuit breaker failing fast while STRAPI is down.
+
+    After `failure_threshold` failures in a row the circuit opens and calls are rejected.
+    In `reset_timeout` seconds a single trial call is let through: its success closes the circuit,
+    its failure opens it again.
+
+    Args:
+        failure_threshold(int): Number of consecutive failures opening the circuit.
+        reset_timeout(float): Seconds after which the open circuit lets a trial call through.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None
+
+    def allow(self) -> bool:
+        """Check if a call may be made now."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._trial and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._trial = True
+                return True
+            self.rejected += 1
+            return False
+
+    def release(self):
+        """Give back the trial call which was allowed but not made."""
+        with self._lock:
+            self._trial = False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or (self._opened_at is None and self.failures >= self.failure_threshold):
+                self._opened_at = time.monotonic()
+                self.opened += 1
+            self._trial = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'open': int(self._opened_at is not None),
+                'consecutive_failures': self.failures,
+                'opened': self.opened,
+                'rejected': self.rejected,
+            }
+
+
+class CallGuard:
+    """Limits concurrency and rate of STRAPI calls and fails fast through the circuit breaker.
+
+    Calls of threads and coroutines share the rate and the breaker. Each of them may have
+    up to `max_concurrency` simultaneous calls, coroutines wait for a slot of an asyncio semaphore.
+
+    Args:
+        max_concurrency(int): Max number of simultaneous calls.
+        rate(float): Max calls per second, not limited by default.
+        burst(float): Max calls in a burst above the rate, equals the rate by default.
+        acquire_timeout(float): Max seconds a call waits for a free slot or a rate token.
+        breaker(CircuitBreaker): Circuit breaker, may be shared with the async client.
+    """
+
+    def __init__(self,
+                 max_concurrency: int = 10,
+                 rate: float = None,
+                 burst: float = None,
+                 acquire_timeout: float = 5,
+                 breaker: CircuitBreaker = None):
+        self.max_concurrency = max_concurrency
+        self.acquire_timeout = acquire_timeout
+        self.breaker = breaker or CircuitBreaker()
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.in_flight = 0
+        self.throttled = 0
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._async_semaphore = asyncio.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def call(self):
+        """Guard the call made in the block.
+
+        Raises:
+            StrapiUnavailableError: If the circuit is open or no slot was free in `acquire_timeout`
+        """
+        if not self.breaker.allow():
+            raise StrapiUnavailableError('STRAPI circuit is open')
+        if self.bucket and not self.bucket.acquire(self.acquire_timeout):
+            self._throttle()
+        if not self._semaphore.acquire(timeout=self.acquire_timeout):
+            self._throttle()
+        with self._lock:
+            self.in_flight += 1
+        failed = False
+        try:
+            yield
+        except requests.exceptions.RequestException as error:
+            failed = is_failure(error)
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._semaphore.release()
+            if failed:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+    @asynccontextmanager
+    async def call_async(self):
+        """Same as `call`, for coroutines of a single event loop.
+
+        Raises:
+            StrapiUnavailableError: If the circuit is open or no slot was free in `acquire_timeout`
+        """
+        if not self.breaker.allow():
+            raise StrapiUnavailableError('STRAPI circuit is open')
+        if self.bucket and not await self.bucket.acquire_async(self.acquire_timeout):
+            self._throttle()
+        try:
+            await asyncio.wait_for(self._async_semaphore.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self._throttle()
+        with self._lock:
+            self.in_flight += 1
+        failed = False
+        try:
+            yield
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            failed = is_failure(error)
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+            self._async_semaphore.release()
+            if failed:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'in_flight': self.in_flight,
+                'throttled': self.throttled,
+                **{f'breaker_{key}': value for key, value in self.breaker.stats().items()},
+            }
+
+    def _throttle(self):
+        with self._lock:
+            self.throttled += 1
+        self.breaker.release()
+        raise StrapiUnavailableError('Too many STRAPI calls are waiting')
+
+
+def is_failure(error: Exception) -> bool:
+    """Check if the error means STRAPI is unhealthy: it did not respond or responded with 5xx."""
+    if isinstance(error, requests.exceptions.HTTPError):
+        return error.response is None or error.response.status_code >= 500
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500
+    return isinstance(error, (requests.exceptions.ConnectionError,
+                              requests.exceptions.Timeout,
+                              aiohttp.ClientError,
+                              asyncio.TimeoutError))
+
+
+def is_not_found(error: Exception) -> bool:
+    """Check if STRAPI responded that the requested entity doesn't exist."""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 404
+    response = getattr(error, 'response', None)
+    return response is not None and response.status_code == 404
@@ -0,0 +1,61 @@
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+EMPTY_CART_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton('В меню', callback_data='cancel')]]).to_json()
+
+
+def render_menu_markup(products: list[dict], pagination: dict) -> str:
+    """Собирает клавиатуру страницы меню, сериализованную в JSON, чтобы переиспользовать её во всех чатах."""
+    page = pagination['page']
+    keyboard = [
+        [InlineKeyboardButton(product['attributes']['Title'], callback_data=str(product['id']))] for product in products
+    ]
+    page_buttons = []
+    if page > 1:
+        page_buttons.append(InlineKeyboardButton('◀ Назад', callback_data=f'menu_page;{page - 1}'))
+    if page < pagination['pageCount']:
+        page_buttons.append(InlineKeyboardButton('Вперёд ▶', callback_data=f'menu_page;{page + 1}'))
+    if page_buttons:
+        keyboard.append(page_buttons)
+    keyboard += [[InlineKeyboardButton('Моя корзина', callback_data='cart')]]
+    return InlineKeyboardMarkup(keyboard).to_json()
+
+
+def render_product_card(product_id: int | str, product_detail: dict) -> dict:
+    """Собирает подпись и клавиатуру карточки товара, общие для всех чатов."""
+    keyboard = [
+        [InlineKeyboardButton('Добавить в корзину', callback_data=f'add_to_cart;{product_id}')],
+        [InlineKeyboardButton('Моя корзина', callback_data='cart')],
+        [InlineKeyboardButton('Назад', callback_data='cancel')],
+    ]
+    return {
+        'caption': product_detail['Description'],
+        'reply_markup': InlineKeyboardMarkup(keyboard).to_json(),
+        'image': product_detail['Image']['data']['attributes'],
+    }
+
+
+def get_cart_text(user_cart: dict) -> str:
+    texts = [
+        f'Товар: {product["title"]}\nКол-во (кг): {product["amount"]}\nЦена за кг: {product["fixed_price"]}\n'
+        for product in user_cart['ordered_products']
+    ]
+    texts.append(f'Итого: {user_cart["total_price"]}')
+    return '\n'.join(texts)
+
+
+def render_cart_markup(ordered_products: list[dict]) -> InlineKeyboardMarkup:
+    """Собирает клавиатуру непустой корзины: кнопки отказа от товаров, возврата в меню и оплаты."""
+    keyboard = [[InlineKeyboardButton(f'Отказаться от {product["title"]} {product["amount"]}',
+                                     callback_data=get_remove_callback_data(product))] for product in ordered_products]
+    keyboard += [
+        [InlineKeyboardButton('В меню', callback_data='cancel')],
+        [InlineKeyboardButton('Оплатить', callback_data='payment')]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+
+def get_remove_callback_data(ordered_product: dict) -> str:
+    """Строки удалённого из CRM товара удаляются по ID заказанного товара, остальные — по ID товара."""
+    if ordered_product['product_id'] is None:
+        return f'remove_item;{ordered_product["id"]}'
+    return f'remove_product;{ordered_product["product_id"]}'
@@ -0,0 +1,256 @@
+import threading
+import time
+from collections import defaultdict
+
+import redis
+import redis.asyncio
+
+from metrics import Metrics
+
+
+class Session:
+    """Session data of a chat: user state plus cached per-user data.
+
+    Changes are kept locally and written by `save` of the session store
+    together with the next state, in a single round-trip.
+    """
+
+    def __init__(self, chat_id: int | str, data: dict):
+        self.chat_id = chat_id
+        self.data = data
+        self.changed = {}
+        self.deleted = set()
+
+    def get(self, field: str, default: str = None) -> str | None:
+        return self.data.get(field, default)
+
+    def set(self, field: str, value: int | str):
+        self.data[field] = str(value)
+        self.changed[field] = str(value)
+        self.deleted.discard(field)
+
+    def delete(self, field: str):
+        self.data.pop(field, None)
+        self.changed.pop(field, None)
+        self.deleted.add(field)
+
+
+class RedisSessionStore:
+    """Sessions of chats kept in Redis, one hash per chat.
+
+    Every access prolongs the session, idle sessions expire after `idle_ttl` seconds.
+    State saved by the first versions of the bot under the bare chat ID key
+    is moved into the hash when the chat has no session yet.
+
+    Args:
+        redis_db(redis.Redis): Redis connection
+        namespace(str): Prefix of Redis keys.
+        idle_ttl(int): Seconds after which an idle session expires.
+        lock_timeout(float): Max time in seconds to hold a session lock.
+        metrics(Metrics): Registry for Redis round-trip timings.
+    """
+
+    def __init__(self,
+                 redis_db: redis.Redis,
+                 namespace: str = 'fish_shop',
+                 idle_ttl: int = 30 * 24 * 60 * 60,
+                 lock_timeout: float = 10,
+                 metrics: Metrics = None):
+        self.redis_db = redis_db
+        self.namespace = namespace
+        self.idle_ttl = idle_ttl
+        self.lock_timeout = lock_timeout
+        self.metrics = metrics or Metrics()
+
+    def get_key(self, chat_id: int | str) -> str:
+        return f'{self.namespace}:session:{chat_id}'
+
+    def load(self, chat_id: int | str) -> Session:
+        key = self.get_key(chat_id)
+        pipeline = self.redis_db.pipeline(transaction=False)
+        pipeline.hgetall(key)
+        pipeline.expire(key, self.idle_ttl)
+        with self.metrics.timer('redis_roundtrip_seconds', {'operation': 'session_load'}):
+            data, _ = pipeline.execute()
+        if not data:
+            data = self._migrate_legacy_state(chat_id)
+        return Session(chat_id, data)
+
+    def save(self, session: Session):
+        key = self.get_key(session.chat_id)
+        pipeline = self.redis_db.pipeline(transaction=False)
+        if session.deleted:
+            pipeline.hdel(key, *session.deleted)
+        if session.changed:
+            pipeline.hset(key, mapping=session.changed)
+        pipeline.expire(key, self.idle_ttl)
+        with self.metrics.timer('redis_roundtrip_seconds', {'operation': 'session_save'}):
+            pipeline.execute()
+        session.changed = {}
+        session.deleted = set()
+
+    def read_field(self, chat_id: int | str, field: str) -> str | None:
+        """Read field bypassing the loaded session, e.g. to re-check it under a lock."""
+        return self.redis_db.hget(self.get_key(chat_id), field)
+
+    def write_field(self, session: Session, field: str, value: int | str):
+        """Write field immediately, without waiting for `save`."""
+        session.set(field, value)
+        session.changed.pop(field)
+        self.redis_db.hset(self.get_key(session.chat_id), field, value)
+
+    def delete_field(self, session: Session, field: str):
+        """Delete field immediately, without waiting for `save`."""
+        session.delete(field)
+        session.deleted.discard(field)
+        self.redis_db.hdel(self.get_key(session.chat_id), field)
+
+    def lock(self, chat_id: int | str, name: str):
+        return self.redis_db.lock(f'{self.get_key(chat_id)}:{name}:lock',
+                                  timeout=self.lock_timeout,
+                                  blocking_timeout=self.lock_timeout)
+
+    def _migrate_legacy_state(self, chat_id: int | str) -> dict:
+        """Move state saved by the first versions of the bot under the bare chat ID key into the session hash."""
+        legacy_key = str(chat_id)
+        state = self.redis_db.get(legacy_key)
+        if not state:
+            return {}
+        key = self.get_key(chat_id)
+        pipeline = self.redis_db.pipeline(transaction=False)
+        pipeline.hset(key, 'state', state)
+        pipeline.expire(key, self.idle_ttl)
+        pipeline.delete(legacy_key)
+        pipeline.execute()
+        self.metrics.inc('session_legacy_migrated_total')
+        return {'state': state}
+
+
+class AsyncRedisSessionStore:
+    """Same as `RedisSessionStore`, but on `redis.asyncio`, for async handlers.
+
+    Sessions are kept in the same hashes, so both bot engines see the same state of a chat.
+    """
+
+    def __init__(self,
+                 redis_db: redis.asyncio.Redis,
+                 namespace: str = 'fish_shop',
+                 idle_ttl: int = 30 * 24 * 60 * 60,
+                 lock_timeout: float = 10,
+                 metrics: Metrics = None):
+        self.redis_db = redis_db
+        self.namespace = namespace
+        self.idle_ttl = idle_ttl
+        self.lock_timeout = lock_timeout
+        self.metrics = metrics or Metrics()
+
+    def get_key(self, chat_id: int | str) -> str:
+        return f'{self.namespace}:session:{chat_id}'
+
+    async def load(self, chat_id: int | str) -> Session:
+        key = self.get_key(chat_id)
+        pipeline = self.redis_db.pipeline(transaction=False)
+        pipeline.hgetall(key)
+        pipeline.expire(key, self.idle_ttl)
+        with self.metrics.timer('redis_roundtrip_seconds', {'operation': 'session_load'}):
+            data, _ = await pipeline.execute()
+        if not data:
+            data = await self._migrate_legacy_state(chat_id)
+        return Session(chat_id, data)
+
+    async def save(self, session: Session):
+        key = self.get_key(session.chat_id)
+        pipeline = self.redis_db.pipeline(transaction=False)
+        if session.deleted:
+            pipeline.hdel(key, *session.deleted)
+        if session.changed:
+            pipeline.hset(key, mapping=session.changed)
+        pipeline.expire(key, self.idle_ttl)
+        with self.metrics.timer('redis_roundtrip_seconds', {'operation': 'session_save'}):
+            await pipeline.execute()
+        session.changed = {}
+        session.deleted = set()
+
+    async def read_field(self, chat_id: int | str, field: str) -> str | None:
+        return await self.redis_db.hget(self.get_key(chat_id), field)
+
+    async def write_field(self, session: Session, field: str, value: int | str):
+        session.set(field, value)
+        session.changed.pop(field)
+        await self.redis_db.hset(self.get_key(session.chat_id), field, value)
+
+    async def delete_field(self, session: Session, field: str):
+        session.delete(field)
+        session.deleted.discard(field)
+        await self.redis_db.hdel(self.get_key(session.chat_id), field)
+
+    def lock(self, chat_id: int | str, name: str):
+        """Get lock used as `async with`."""
+        return self.redis_db.lock(f'{self.get_key(chat_id)}:{name}:lock',
+                                  timeout=self.lock_timeout,
+                                  blocking_timeout=self.lock_timeout)
+
+    async def _migrate_legacy_state(self, chat_id: int | str) -> dict:
+        legacy_key = str(chat_id)
+        state = await self.redis_db.get(legacy_key)
+        if not state:
+            return {}
+        key = self.get_key(chat_id)
+        pipeline = self.redis_db.pipeline(transaction=False)
+        pipeline.hset(key, 'state', state)
+        pipeline.expire(key, self.idle_ttl)
+        pipeline.delete(legacy_key)
+        await pipeline.execute()
+        self.metrics.inc('session_legacy_migrated_total')
+        return {'state': state}
+
+
+class InMemorySessionStore:
+    """Process-local stand-in for `RedisSessionStore`, e.g. for tests."""
+
+    def __init__(self, idle_ttl: int = 30 * 24 * 60 * 60):
+        self.idle_ttl = idle_ttl
+        self._sessions = {}
+        self._expire_at = {}
+        self._locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def _get_data(self, chat_id: int | str) -> dict:
+        key = str(chat_id)
+        if self._expire_at.get(key, 0) <= time.monotonic():
+            self._sessions.pop(key, None)
+        self._expire_at[key] = time.monotonic() + self.idle_ttl
+        return self._sessions.setdefault(key, {})
+
+    def load(self, chat_id: int | str) -> Session:
+        with self._lock:
+            return Session(chat_id, dict(self._get_data(chat_id)))
+
+    def save(self, session: Session):
+        with self._lock:
+            data = self._get_data(session.chat_id)
+            for field in session.deleted:
+                data.pop(field, None)
+            data.update(session.changed)
+        session.changed = {}
+        session.deleted = set()
+
+    def read_field(self, chat_id: int | str, field: str) -> str | None:
+        with self._lock:
+            return self._get_data(chat_id).get(field)
+
+    def write_field(self, session: Session, field: str, value: int | str):
+        session.set(field, value)
+        session.changed.pop(field)
+        with self._lock:
+            self._get_data(session.chat_id)[field] = str(value)
+
+    def delete_field(self, session: Session, field: str):
+        session.delete(field)
+        session.deleted.discard(field)
+        with self._lock:
+            self._get_data(session.chat_id).pop(field, None)
+
+    def lock(self, chat_id: int | str, name: str):
+        with self._lock:
+            return self._locks[f'{chat_id}:{name}']
@@ -0,0 +1,241 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from typing import Callable
+
+import redis
+from telegram import Bot, Update
+
+from catalog_cache import CatalogCache
+
+logger = logging.getLogger(__name__)
+
+
+def get_shard(update: Update, shards: int) -> int:
+    """Get shard of the update, all updates of a chat go to the same shard."""
+    chat_id = update.effective_chat.id if update.effective_chat else update.update_id
+    return chat_id % shards
+
+
+class StreamUpdateProducer:
+    """Front side of sharded deployment: puts updates into Redis streams, one stream per shard.
+
+    Has the same `put` and `stats` as `ChatOrderedWorkerPool`, so it can receive updates from the webhook server.
+
+    Args:
+        redis_db(redis.Redis): Redis connection
+        namespace(str): Prefix of Redis keys.
+        shards(int): Number of shards.
+        queue_size(int): Max number of unprocessed updates in the stream of each shard.
+        put_timeout(float): How long to wait for a free slot in a full stream before rejecting an update.
+    """
+
+    def __init__(self,
+                 redis_db: redis.Redis,
+                 namespace: str = 'fish_shop',
+                 shards: int = 4,
+                 queue_size: int = 1000,
+                 put_timeout: float = 5):
+        self.redis_db = redis_db
+        self.namespace = namespace
+        self.shards = shards
+        self.queue_size = queue_size
+        self.put_timeout = put_timeout
+        self.accepted = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def get_stream_key(self, shard: int) -> str:
+        return get_stream_key(self.namespace, shard)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def put(self, update: Update) -> bool:
+        """Put update into the stream of its shard.
+
+        Return:
+            bool: False if the stream stayed full for `put_timeout` seconds and update was rejected.
+        """
+        stream_key = self.get_stream_key(get_shard(update, self.shards))
+        deadline = time.monotonic() + self.put_timeout
+        while self.redis_db.xlen(stream_key) >= self.queue_size:
+            if time.monotonic() > deadline:
+                with self._lock:
+                    self.rejected += 1
+                return False
+            time.sleep(0.05)
+        self.redis_db.xadd(stream_key, {'update': update.to_json()})
+        with self._lock:
+            self.accepted += 1
+        return True
+
+    def stats(self) -> dict:
+        pipeline = self.redis_db.pipeline(transaction=False)
+        for shard in range(self.shards):
+            pipeline.xlen(self.get_stream_key(shard))
+        queued = pipeline.execute()
+        with self._lock:
+            return {
+                'queued': sum(queued),
+                'max_worker_queued': max(queued),
+                'capacity': self.queue_size * self.shards,
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+            }
+
+
+class StreamUpdateConsumer:
+    """Worker side of sharded deployment: processes updates of its shards from Redis streams.
+
+    Each shard is read by a single thread, so updates of a chat are processed in order.
+    Update is acknowledged and deleted from the stream after processing. Updates read
+    but not acknowledged before a crash are processed again when the worker is restarted,
+    so every shard has to be consumed by exactly one worker process.
+
+    Args:
+        redis_db(redis.Redis): Redis connection
+        bot(Bot): Bot the updates are bound to
+        handle_update(Callable): Function processing a single update, e.g. `dispatcher.process_update`.
+        shards(list): Shards consumed by this worker.
+        namespace(str): Prefix of Redis keys.
+        batch_size(int): Max number of updates read at once.
+        block_timeout(float): How long to wait for new updates in seconds.
+    """
+
+    group = 'workers'
+
+    def __init__(self,
+                 redis_db: redis.Redis,
+                 bot: Bot,
+                 handle_update: Callable[[Update], None],
+                 shards: list[int],
+                 namespace: str = 'fish_shop',
+                 batch_size: int = 10,
+                 block_timeout: float = 1):
+        self.redis_db = redis_db
+        self.bot = bot
+        self.handle_update = handle_update
+        self.shards = shards
+        self.namespace = namespace
+        self.batch_size = batch_size
+        self.block_timeout = block_timeout
+        self.processed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for shard in self.shards:
+            thread = threading.Thread(target=self._consume, args=(shard,), name=f'shard-{shard}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """Stop reading streams after the current updates are processed."""
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'shards': len(self.shards),
+                'processed': self.processed,
+                'failed': self.failed,
+            }
+
+    def _consume(self, shard: int):
+        stream_key = get_stream_key(self.namespace, shard)
+        consumer = f'shard-{shard}'
+        try:
+            self.redis_db.xgroup_create(stream_key, self.group, id='0', mkstream=True)
+        except redis.exceptions.ResponseError as error:
+            if 'BUSYGROUP' not in str(error):
+                raise
+        # Updates left unacknowledged by the previous run go first
+        last_id = '0'
+        while not self._stopped.is_set():
+            try:
+                response = self.redis_db.xreadgroup(self.group,
+                                                    consumer,
+                                                    {stream_key: last_id},
+                                                    count=self.batch_size,
+                                                    block=int(self.block_timeout * 1000))
+            except redis.exceptions.RedisError:
+                logger.exception('Reading shard %s failed', shard)
+                self._stopped.wait(self.block_timeout)
+                continue
+            entries = response[0][1] if response else []
+            if last_id == '0' and not entries:
+                last_id = '>'
+                continue
+            for entry_id, fields in entries:
+                # Entry deleted from the stream but left pending has no fields
+                if fields:
+                    self._process(shard, fields)
+                pipeline = self.redis_db.pipeline(transaction=False)
+                pipeline.xack(stream_key, self.group, entry_id)
+                pipeline.xdel(stream_key, entry_id)
+                pipeline.execute()
+
+    def _process(self, shard: int, fields: dict):
+        try:
+            update = Update.de_json(json.loads(fields['update']), self.bot)
+            self.handle_update(update)
+            with self._lock:
+                self.processed += 1
+        except Exception:
+            logger.exception('Update processing in shard %s failed', shard)
+            with self._lock:
+                self.failed += 1
+
+
+def get_stream_key(namespace: str, shard: int) -> str:
+    return f'{namespace}:updates:{shard}'
+
+
+class CatalogSync:
+    """Broadcasts catalog invalidation to all bot processes through Redis pub/sub.
+
+    Args:
+        redis_db(redis.Redis): Redis connection
+        catalog(CatalogCache): Catalog cache of this process
+        namespace(str): Prefix of Redis keys.
+    """
+
+    def __init__(self, redis_db: redis.Redis, catalog: CatalogCache, namespace: str = 'fish_shop'):
+        self.redis_db = redis_db
+        self.catalog = catalog
+        self.channel = f'{namespace}:catalog_invalidate'
+        self.sender_id = uuid.uuid4().hex
+        self._pubsub = None
+        self._thread = None
+
+    def start(self):
+        self._pubsub = self.redis_db.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{self.channel: self._handle_message})
+        self._thread = self._pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def stop(self):
+        if self._thread:
+            self._thread.stop()
+            self._thread.join()
+            self._pubsub.close()
+            self._thread = None
+
+    def publish(self, product_id: int | str = None):
+        """Ask other processes to drop their cached catalog or a single product of it."""
+        self.redis_db.publish(self.channel, json.dumps({'sender': self.sender_id, 'product_id': product_id}))
+
+    def _handle_message(self, message: dict):
+        invalidation = json.loads(message['data'])
+        if invalidation['sender'] != self.sender_id:
+            self.catalog.invalidate(invalidation['product_id'])
@@ -4,107 +4,257 @@ from decimal import Decimal
 import posixpath
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from metrics import Metrics
+from resilience import CallGuard
 
-def get_products(api_token: str, hostname: str, models_config: dict) -> list[dict]:
-    product_model_plural = models_config['strapi_product_name_plural']
-    api_hand = posixpath.join('/api/', product_model_plural)
-    api_url = urljoin(hostname, api_hand)
-    headers = {
-        'Authorization': f'bearer {api_token}'
-    }
-    response = requests.get(api_url, headers=headers)
-    response.raise_for_status()
-    return response.json()['data']
-
-
-def get_ordered_products(api_token: str,
-                         hostname: str,
-                         models_config: dict,
-                         ids: list[int] = None) -> list[dict]:
-    ordered_product_model_plural = models_config['strapi_ordered_product_name_plural']
-    api_hand = posixpath.join('/api/', ordered_product_model_plural)
-    api_url = urljoin(hostname, api_hand)
-    headers = {
-        'Authorization': f'bearer {api_token}'
-    }
-    params = {
-        'populate': f'{models_config["strapi_product_name"]}',
-        'filters[id][$eq]': ids
+
+QUERY_PROFILES = {
+    'product_title': {
+        'fields': ['Title'],
+    },
+    'product_detail': {
+        'fields': ['Title', 'Description', 'Price'],
+        'populate': {
+            'Image': {'fields': ['url', 'updatedAt']},
+        },
+    },
+    'product_detail_without_image': {
+        'fields': ['Title', 'Description', 'Price'],
+    },
+    'cart': {
+        'fields': ['user_tg_id'],
+        'populate': {
+            'ordered_products': {
+                'fields': ['amount', 'fixed_price'],
+                'populate': {
+                    'strapi_product_name': {'fields': ['Title']},
+                },
+            },
+        },
+    },
+    'ordered_product': {
+        'fields': ['amount', 'fixed_price'],
+    },
+    'ordered_product_with_product': {
+        'fields': ['amount', 'fixed_price'],
+        'populate': {
+            'strapi_product_name': {'fields': ['Title']},
+        },
+    },
+    'customer': {
+        'fields': ['telegram_id', 'email'],
+    },
+    'cart_owner': {
+        'fields': ['user_tg_id'],
+    },
+    'ordered_product_export': {
+        'fields': ['amount', 'fixed_price'],
+        'populate': {
+            'strapi_product_name': {'fields': ['Title']},
+            'cart': {'fields': ['id']},
+        },
+    },
+}
+"""Fields and relations each query needs.
+
+Relation names may be keys of models config, e.g. `strapi_product_name`,
+they are replaced with configured names when the profile is compiled.
+"""
+
+
+def compile_query_profile(profile: dict, models_config: dict, prefix: str = '') -> dict:
+    """Compile query profile into STRAPI `fields` and `populate` params.
+
+    Examples:
+        >>> compile_query_profile(QUERY_PROFILES['ordered_product_with_product'], {'strapi_product_name': 'product'})
+        {
+          'fields[0]': 'amount',
+          'fields[1]': 'fixed_price',
+          'populate[product][fields][0]': 'Title'
+        }
+    """
+    params = {}
+    fields_key = f'{prefix}[fields]' if prefix else 'fields'
+    for number, field in enumerate(profile.get('fields', [])):
+        params[f'{fields_key}[{number}]'] = field
+    populate_key = f'{prefix}[populate]' if prefix else 'populate'
+    for relation, relation_profile in profile.get('populate', {}).items():
+        relation_name = models_config.get(relation, relation)
+        params.update(compile_query_profile(relation_profile, models_config, f'{populate_key}[{relation_name}]'))
+    return params
+
+
+class StrapiClient:
+    """Keep-alive STRAPI client with a pooled HTTP session.
+
+    The client is created once at startup and shared by all handlers,
+    so TCP/TLS connections to STRAPI are reused between updates.
+
+    Args:
+        hostname(str): STRAPI host url
+        api_token(str): STRAPI Token
+        models_config(dict): STRAPI models names
+        pool_size(int): Max number of kept-alive connections to STRAPI.
+        timeout(float | tuple): Connect and read timeouts in seconds.
+        retries(int): Number of retries for failed idempotent requests.
+        backoff_factor(float): Backoff factor between retries.
+        metrics(Metrics): Registry for call counts, latencies and status codes of STRAPI endpoints.
+        guard(CallGuard): Concurrency and rate limits with circuit breaker. By default calls are limited by pool size.
+    """
+
+    def __init__(self,
+                 hostname: str,
+                 api_token: str,
+                 models_config: dict,
+                 pool_size: int = 10,
+                 timeout: float | tuple = (3.05, 10),
+                 retries: int = 3,
+                 backoff_factor: float = 0.3,
+                 metrics: Metrics = None,
+                 guard: CallGuard = None):
+        self.hostname = hostname
+        self.models_config = models_config
+        self.timeout = timeout
+        self.metrics = metrics or Metrics()
+        self.guard = guard or CallGuard(max_concurrency=pool_size)
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'bearer {api_token}'
+        retry = Retry(total=retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=(502, 503, 504),
+                      allowed_methods=('GET', 'PUT', 'DELETE'),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._profiles_params = {}
+
+    def get_api_url(self, model_plural_key: str, *path) -> str:
+        model_plural = self.models_config[model_plural_key]
+        api_hand = posixpath.join('/api/', model_plural, *map(str, path))
+        return urljoin(self.hostname, api_hand)
+
+    def get_profile_params(self, profile: str) -> dict:
+        """Get compiled params of the query profile from `QUERY_PROFILES`."""
+        if profile not in self._profiles_params:
+            self._profiles_params[profile] = compile_query_profile(QUERY_PROFILES[profile], self.models_config)
+        return self._profiles_params[profile]
+
+    def request(self,
+                method: str,
+                model_plural_key: str,
+                *path,
+                profile: str = None,
+                params: dict = None,
+                **kwargs) -> dict:
+        """Make request to STRAPI REST API and return decoded JSON.
+
+        Args:
+            method(str): HTTP method.
+            model_plural_key(str): Key of the model plural name in models config,
+            e.g. `strapi_product_name_plural`.
+            *path: Extra url parts, e.g. entity ID.
+            profile(str): Name of the query profile selecting fields and relations of the response.
+            params(dict): Extra query params, e.g. filters.
+            **kwargs: Passed to `requests.Session.request` (json, ...).
+        """
+        api_url = self.get_api_url(model_plural_key, *path)
+        if profile:
+            params = {**self.get_profile_params(profile), **(params or {})}
+        endpoint = posixpath.join('/api/', self.models_config[model_plural_key], ':id' if path else '')
+        labels = {'method': method, 'endpoint': endpoint}
+        with self.guard.call(), self.metrics.track_call('strapi_request', labels) as call:
+            response = self.session.request(method, api_url, params=params, timeout=self.timeout, **kwargs)
+            call['status'] = response.status_code
+            response.raise_for_status()
+        return response.json()
+
+    def get_file(self, file_url: str) -> bytes:
+        full_file_url = urljoin(self.hostname, file_url)
+        labels = {'method': 'GET', 'endpoint': 'file'}
+        with self.guard.call(), self.metrics.track_call('strapi_request', labels) as call:
+            # Media may be served from a third-party storage, so the token is not sent.
+            response = self.session.get(full_file_url, headers={'Authorization': None}, timeout=self.timeout)
+            call['status'] = response.status_code
+            response.raise_for_status()
+        return response.content
+
+    def close(self):
+        self.session.close()
+
+
+def get_page_params(page: int, page_size: int) -> dict:
+    return {
+        'pagination[page]': page,
+        'pagination[pageSize]': page_size,
+        'sort[0]': 'id:asc',
     }
-    response = requests.get(api_url, headers=headers, params=params)
-    response.raise_for_status()
-    return response.json()['data']
 
 
-def get_product_detail(product_id: int | str,
-                       api_token: str,
-                       hostname: str,
-                       models_config: dict,
+def get_products_page(strapi_client: StrapiClient, page: int = 1, page_size: int = 10) -> tuple[list[dict], dict]:
+    """Get one page of products with titles only.
+
+    Return:
+        tuple: Products of the page and STRAPI pagination info, e.g.
+        `{'page': 1, 'pageSize': 10, 'pageCount': 5, 'total': 48}`
+    """
+    response = strapi_client.request('GET',
+                                     'strapi_product_name_plural',
+                                     profile='product_title',
+                                     params=get_page_params(page, page_size))
+    return response['data'], response['meta']['pagination']
+
+
+def get_products(strapi_client: StrapiClient, page_size: int = 100) -> list[dict]:
+    """Get all products with titles only, page by page."""
+    products, pagination = get_products_page(strapi_client, page_size=page_size)
+    for page in range(2, pagination['pageCount'] + 1):
+        products += get_products_page(strapi_client, page, page_size)[0]
+    return products
+
+
+def get_product_detail(strapi_client: StrapiClient,
+                       product_id: int | str,
                        with_img: bool = True) -> dict:
     """Get product detailed info.
 
     Examples:
-        >>> get_product_detail(2, token, with_img=False)
+        >>> get_product_detail(strapi_client, 2, with_img=False)
         {
           'Description': 'Дикий лосось "Стейк рыбацкий" с/м 600г',
           'Price': 420,
-          'Title': 'Дикий лосось «Стейк рыбацкий» свежемороженый 600 г',
-          'createdAt': '2023-09-08T09:30:41.000Z',
-          'publishedAt': '2023-09-08T09:30:42.652Z',
-          'updatedAt': '2023-09-08T09:30:42.656Z'
+          'Title': 'Дикий лосось «Стейк рыбацкий» свежемороженый 600 г'
         }
     """
-    product_model_plural = models_config['strapi_product_name_plural']
-    api_hand = posixpath.join('/api/', product_model_plural, product_id)
-    api_url = urljoin(hostname, api_hand)
-    headers = {
-        'Authorization': f'bearer {api_token}'
-    }
-    params = {
-        'populate': 'Image' if with_img else None
-    }
-    response = requests.get(api_url, headers=headers, params=params)
-    response.raise_for_status()
-    return response.json()['data']['attributes']
+    profile = 'product_detail' if with_img else 'product_detail_without_image'
+    response = strapi_client.request('GET', 'strapi_product_name_plural', product_id, profile=profile)
+    return response['data']['attributes']
 
 
-def get_product_img(img_url: str,
-                    hostname: str) -> BytesIO:
-    full_img_url = urljoin(hostname, img_url)
-    response = requests.get(full_img_url)
-    response.raise_for_status()
-    image = BytesIO(response.content)
+def get_product_img(strapi_client: StrapiClient, img_url: str) -> BytesIO:
+    image = BytesIO(strapi_client.get_file(img_url))
     return image
 
 
-def get_or_create_cart(user_id: int | str,
-                       hostname: str,
-                       models_config: dict,
-                       api_token: str) -> dict:
+def get_or_create_cart(strapi_client: StrapiClient, user_id: int | str) -> dict:
     """Get cart of a specific user.
 
+    Cart is populated with ordered products and their product titles.
+
     Args:
+        strapi_client(StrapiClient): STRAPI client
         user_id(int): ID of the user for whom you want to create or get a cart
-        hostname: STRAPI host url
-        cart_model_plural: cart model plural name
-        api_token(str): STRAPI Token
     Return:
-        int: Cart of a specified user
+        dict: Cart of a specified user
     """
-    cart_model_plural = models_config['strapi_cart_name_plural']
-    api_hand = posixpath.join('/api/', cart_model_plural)
-    api_url = urljoin(hostname, api_hand)
-    headers = {
-        'Authorization': f'bearer {api_token}'
-    }
     params = {
-        'populate': [f'models_config["strapi_ordered_product_name_plural"]', f'{models_config["strapi_product_name_plural"]}'],
         'filters[user_tg_id][$eq]': user_id
     }
-    response = requests.get(api_url, headers=headers, params=params)
-    response.raise_for_status()
-    carts = response.json()['data']
+    response = strapi_client.request('GET', 'strapi_cart_name_plural', profile='cart', params=params)
+    carts = response['data']
     if carts:
         return carts[0]
     new_cart = {
@@ -112,43 +262,63 @@ def get_or_create_cart(user_id: int | str,
             'user_tg_id': user_id
         }
     }
-    create_response = requests.post(api_url, headers=headers, json=new_cart)
-    create_response.raise_for_status()
-    return create_response.json()['data']
-
-
-def get_cart_ordered_products(cart: dict,
-                              api_token: str,
-                              hostname: str,
-                              models_config: dict,
-                              as_text: bool = False):
-    ordered_products_raw = cart['attributes']['ordered_products']['data']
-    ordered_products_ids = [product['id'] for product in ordered_products_raw]
-    ordered_products_with_products_raw = get_ordered_products(api_token,
-                                                              ids=ordered_products_ids,
-                                                              models_config=models_config,
-                                                              hostname=hostname)
-    ordered_products = [
+    create_response = strapi_client.request('POST', 'strapi_cart_name_plural', profile='cart', json=new_cart)
+    return create_response['data']
+
+
+def get_cart(strapi_client: StrapiClient, cart_id: int | str) -> dict:
+    """Get cart by ID populated with ordered products and their product titles."""
+    response = strapi_client.request('GET', 'strapi_cart_name_plural', cart_id, profile='cart')
+    return response['data']
+
+
+def parse_cart(cart: dict, models_config: dict) -> dict:
+    """Convert populated STRAPI cart into a flat cart.
+
+    Examples:
+        >>> parse_cart(get_or_create_cart(strapi_client, 99), strapi_client.models_config)
         {
-            'amount': product['attributes']['amount'],
-            'fixed_price': product['attributes']['fixed_price'],
-            'id': product['id'],
-            'title': product['attributes']['product']['data']['attributes']['Title']
-        } for product in ordered_products_with_products_raw
-    ]
-    if not as_text:
-        return ordered_products
-    texts = [
-        f'Товар: {product["title"]}\nКол-во (кг): {product["amount"]}\nЦена за кг: {product["fixed_price"]}\n' for product in ordered_products
-    ]
-    text = '\n'.join(texts)
-    return text
-
-
-def create_ordered_product(product_id: int | str,
-                           api_token: str,
-                           hostname: str,
-                           models_config: dict,
+          'id': 4,
+          'ordered_products': [
+            {
+              'id': 5,
+              'product_id': 2,
+              'title': 'Дикий лосось «Стейк рыбацкий» свежемороженый 600 г',
+              'amount': 1,
+              'fixed_price': 420
+            }
+          ],
+          'total_price': Decimal('420')
+        }
+    """
+    ordered_products_raw = cart['attributes'].get('ordered_products') or {'data': []}
+    product_name = models_config['strapi_product_name']
+    ordered_products = []
+    for ordered_product in ordered_products_raw['data']:
+        product = ordered_product['attributes'][product_name]['data']
+        ordered_products.append({
+            'id': ordered_product['id'],
+            'product_id': product['id'] if product else None,
+            'title': product['attributes']['Title'] if product else '',
+            'amount': ordered_product['attributes']['amount'],
+            'fixed_price': ordered_product['attributes']['fixed_price'],
+        })
+    return {
+        'id': cart['id'],
+        'ordered_products': ordered_products,
+        'total_price': get_cart_total(ordered_products),
+    }
+
+
+def get_cart_total(ordered_products: list[dict]) -> Decimal:
+    return sum(
+        (Decimal(str(product['fixed_price'] or 0)) * Decimal(str(product['amount'] or 0)) for product in ordered_products),
+        Decimal(0)
+    )
+
+
+def create_ordered_product(strapi_client: StrapiClient,
+                           product_id: int | str,
                            cart_id: int | str = None,
                            amount: float = 1.0,
                            fixed_price: Decimal = None) -> dict:
@@ -158,10 +328,8 @@ def create_ordered_product(product_id: int | str,
     with specified amount and price (if needed).
 
     Args:
+        strapi_client(StrapiClient): STRAPI client.
         product_id(int | str): Product ID.
-        api_token(str): STRAPI Token.
-        hostname: ...
-        models_config: ...
         cart_id(int | str): Cart ID to which created OrderedProduct should be connected. None by default.
         amount(float): Product amount. 1 kg by default.
         fixed_price(Decimal): Price that will be fixed for this product in this particular OrderedProduct.
@@ -171,51 +339,17 @@ def create_ordered_product(product_id: int | str,
         dict: Created OrderedProduct
 
     Examples:
-        >>> create_ordered_product(2, token, cart_id)
+        >>> create_ordered_product(strapi_client, 2, cart_id)
         {
           "attributes":{
             "amount":1,
-            "cart":{
-              "data":{
-                "attributes":{
-                  "createdAt":"2023-09-10T07:54:26.730Z",
-                  "publishedAt":"2023-09-10T07:54:26.706Z",
-                  "total_price":"None",
-                  "updatedAt":"2023-09-10T07:54:26.730Z",
-                  "user_tg_id":"99"
-                },
-                "id":4
-              }
-            },
-            "createdAt":"2023-09-10T08:17:45.877Z",
-            "fixed_price":420,
-            "product":{
-              "data":{
-                "attributes":{
-                  "Description":"Дикий лосось Стейк рыбацкийnс/м 600г",
-                  "Price":420,
-                  "Title":"Дикий лосось «Стейк рыбацкий» свежемороженый 600 г",
-                  "createdAt":"2023-09-08T09:30:41.000Z",
-                  "publishedAt":"2023-09-08T09:30:42.652Z",
-                  "updatedAt":"2023-09-08T09:30:42.656Z"
-                },
-                "id":2
-              }
-            },
-            "publishedAt":"2023-09-10T08:17:45.868Z",
-            "updatedAt":"2023-09-10T08:17:45.877Z"
+            "fixed_price":420
           },
           "id":5
         }
     """
-    ordered_product_model_plural = models_config['strapi_ordered_product_name_plural']
-    api_hand = posixpath.join('/api/', ordered_product_model_plural)
-    api_url = urljoin(hostname, api_hand)
-    headers = {
-        'Authorization': f'bearer {api_token}'
-    }
     if not fixed_price:
-        product = get_product_detail(product_id, api_token, with_img=False)
+        product = get_product_detail(strapi_client, product_id, with_img=False)
         fixed_price = product['Price']
     new_ordered_product = {
         'data': {
@@ -229,64 +363,76 @@ def create_ordered_product(product_id: int | str,
             'fixed_price': fixed_price,
         }
     }
-    params = {
-        'populate': ['product', 'cart'],
-    }
-    create_response = requests.post(api_url,
-                                    headers=headers,
-                                    params=params,
-                                    json=new_ordered_product)
-    create_response.raise_for_status()
-    return create_response.json()['data']
-
-
-def remove_ordered_product(product_id: int | str,
-                           api_token: str,
-                           hostname: str,
-                           models_config: dict):
-    ordered_product_model_plural = models_config['strapi_ordered_product_name_plural']
-    api_hand = posixpath.join('/api/', ordered_product_model_plural, product_id)
-    api_url = urljoin(hostname, api_hand)
-    headers = {
-        'Authorization': f'bearer {api_token}'
+    create_response = strapi_client.request('POST',
+                                            'strapi_ordered_product_name_plural',
+                                            profile='ordered_product',
+                                            json=new_ordered_product)
+    return create_response['data']
+
+
+def remove_ordered_product(strapi_client: StrapiClient, product_id: int | str):
+    response = strapi_client.request('DELETE', 'strapi_ordered_product_name_plural', product_id)
+    return response
+
+
+def update_ordered_product_amount(strapi_client: StrapiClient,
+                                  ordered_product_id: int | str,
+                                  amount: float) -> dict:
+    """Set amount of OrderedProduct.
+
+    Args:
+        strapi_client(StrapiClient): STRAPI client
+        ordered_product_id(int | str): OrderedProduct ID
+        amount(float): New product amount
+    Return:
+        dict: Updated OrderedProduct
+    """
+    update_json = {
+        'data': {
+            'amount': amount,
+        }
     }
-    response = requests.delete(api_url, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    response = strapi_client.request('PUT',
+                                     'strapi_ordered_product_name_plural',
+                                     ordered_product_id,
+                                     profile='ordered_product',
+                                     json=update_json)
+    return response['data']
 
 
-def add_ordered_product_into_cart(ordered_product_id: int | str,
-                                  cart_id: int | str,
-                                  api_token: str) -> dict:
+def add_ordered_product_into_cart(strapi_client: StrapiClient,
+                                  ordered_product_id: int | str,
+                                  cart_id: int | str) -> dict:
     """Add OrderedProduct into specific Cart.
 
     Args:
+        strapi_client(StrapiClient): STRAPI client
         ordered_product_id(int | str): OrderedProduct ID, which will be added into Cart
         cart_id(int | str): Cart ID
-        api_token(str): STRAPI Token
     Return:
         dict: Updated OrderedProduct
     """
-    #  TODO: fill up this function :)
-    #  use requests.put!
-
-
-def get_or_create_customer(user_tg_id: int | str,
-                           api_token: str,
-                           hostname: str,
-                           models_config: dict) -> dict:
-    customer_model_plural = models_config['strapi_customer_name_plural']
-    api_hand = posixpath.join('/api/', customer_model_plural)
-    api_url = urljoin(hostname, api_hand)
-    headers = {
-        'Authorization': f'bearer {api_token}'
+    update_json = {
+        'data': {
+            'cart': {
+                'connect': [cart_id, ]
+            },
+        }
     }
+    response = strapi_client.request('PUT',
+                                     'strapi_ordered_product_name_plural',
+                                     ordered_product_id,
+                                     profile='ordered_product',
+                                     json=update_json)
+    return response['data']
+
+
+def get_or_create_customer(strapi_client: StrapiClient, user_tg_id: int | str) -> dict:
     params = {
         'filters[telegram_id][$eq]': user_tg_id
     }
-    response = requests.get(api_url, headers=headers, params=params)
-    response.raise_for_status()
-    users = response.json()['data']
+    response = strapi_client.request('GET', 'strapi_customer_name_plural', profile='customer', params=params)
+    users = response['data']
     if users:
         return users[0]
     new_customer = {
@@ -294,28 +440,17 @@ def get_or_create_customer(user_tg_id: int | str,
             'telegram_id': user_tg_id,
         }
     }
-    create_response = requests.post(api_url, headers=headers, json=new_customer)
-    create_response.raise_for_status()
-    return create_response.json()['data']
-
-
-def save_customer_email(customer_id: int | str,
-                        email: str,
-                        api_token: str,
-                        hostname: str,
-                        models_config: dict
-                        ):
-    customer_model_plural = models_config['strapi_customer_name_plural']
-    api_hand = posixpath.join('/api/', customer_model_plural, customer_id)
-    api_url = urljoin(hostname, api_hand)
-    headers = {
-        'Authorization': f'bearer {api_token}'
-    }
+    create_response = strapi_client.request('POST', 'strapi_customer_name_plural', profile='customer', json=new_customer)
+    return create_response['data']
+
+
+def save_customer_email(strapi_client: StrapiClient,
+                        customer_id: int | str,
+                        email: str):
     update_json = {
         'data': {
             'email': email,
         }
     }
-    response = requests.put(api_url, headers=headers, json=update_json)
-    response.raise_for_status()
-    return response.json()['data']
+    response = strapi_client.request('PUT', 'strapi_customer_name_plural', customer_id, profile='customer', json=update_json)
+    return response['data']
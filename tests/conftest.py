@@ -0,0 +1,39 @@
+import pytest
+from environs import Env
+from telegram import Bot
+
+from fakes import FakeRedis, FakeStrapi
+from models_config import get_models_config
+from session_store import InMemorySessionStore
+from strapi_api import StrapiClient
+
+
+@pytest.fixture
+def fake_strapi():
+    fake_strapi = FakeStrapi(products_count=5, image_size=10)
+    fake_strapi.start()
+    yield fake_strapi
+    fake_strapi.stop()
+
+
+@pytest.fixture
+def strapi_client(fake_strapi):
+    hostname = f'http://127.0.0.1:{fake_strapi.server.server_port}/'
+    strapi_client = StrapiClient(hostname, 'token', get_models_config(Env()), retries=0)
+    yield strapi_client
+    strapi_client.close()
+
+
+@pytest.fixture
+def fake_redis():
+    return FakeRedis()
+
+
+@pytest.fixture
+def sessions():
+    return InMemorySessionStore()
+
+
+@pytest.fixture
+def bot():
+    return Bot('123456:ABCdefGHIjklMNOpqrSTUvwxYZ012345678')
@@ -0,0 +1,47 @@
+import random
+import socket
+import threading
+import time
+from typing import Callable
+
+from telegram import Update
+
+
+def get_update_data(update_id: int, chat_id: int, text: str) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+            'text': text,
+        },
+    }
+
+
+class UpdatesRecorder:
+    """Update handler remembering texts of messages by chat, optionally with a random delay."""
+
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.texts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, update: Update):
+        time.sleep(random.uniform(0, self.delay))
+        with self._lock:
+            self.texts.setdefault(update.effective_chat.id, []).append(update.effective_message.text)
+
+
+def wait_until(condition: Callable[[], bool], timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'Condition was not met in time'
+        time.sleep(0.001)
+
+
+def get_closed_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
@@ -0,0 +1,246 @@
+import asyncio
+import json
+import time
+from itertools import count
+
+import pytest
+import telegram.ext
+from environs import Env
+
+from fakes import FakeAsyncRedis
+from tests.helpers import get_closed_port
+
+if not hasattr(telegram.ext, 'Application'):
+    pytest.skip('Async engine needs python-telegram-bot 20', allow_module_level=True)
+
+from telegram import Update  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+from telegram.request import BaseRequest, RequestData  # noqa: E402
+
+from async_bot import add_handlers, close_bot_data, init_bot_data  # noqa: E402
+
+TOKEN = '123456:ABCdefGHIjklMNOpqrSTUvwxYZ012345678'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Shop', 'username': 'shop_bot'}
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Answers Bot API calls of the handlers like Telegram does and records them by chat.
+
+    Args:
+        broken_file_ids(set): File IDs Telegram doesn't accept anymore.
+    """
+
+    def __init__(self, broken_file_ids: set = None):
+        self.broken_file_ids = broken_file_ids or set()
+        self.calls = []
+        self.messages = {}
+        self.last_messages = {}
+        self._message_ids = count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: RequestData = None, **kwargs) -> tuple[int, bytes]:
+        api_method = url.rsplit('/', 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        is_upload = bool(request_data and request_data.multipart_data)
+        self.calls.append((api_method, parameters.get('chat_id'), is_upload))
+        await asyncio.sleep(0)
+        if api_method in ('getMe', 'answerCallbackQuery', 'deleteMessage'):
+            result = BOT_USER if api_method == 'getMe' else True
+        elif api_method == 'sendMessage':
+            result = self._save_message(parameters, text=parameters['text'])
+        elif api_method == 'editMessageText':
+            result = self._save_message(parameters, text=parameters['text'], edited=True)
+        elif api_method in ('sendPhoto', 'editMessageMedia'):
+            media = parameters.get('media', {})
+            file_id = parameters.get('photo') or media.get('media')
+            if file_id in self.broken_file_ids:
+                return 400, json.dumps({'ok': False, 'description': 'Bad Request: wrong file identifier'}).encode()
+            result = self._save_message(parameters,
+                                        caption=parameters.get('caption') or media.get('caption'),
+                                        photo=file_id if file_id and not file_id.startswith('attach://') else None,
+                                        edited=api_method == 'editMessageMedia')
+        else:
+            raise AssertionError(f'Unexpected Bot API method {api_method}')
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    def _save_message(self,
+                      parameters: dict,
+                      text: str = None,
+                      caption: str = None,
+                      photo: str = None,
+                      edited: bool = False) -> dict:
+        message_id = parameters['message_id'] if edited else next(self._message_ids)
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': parameters['chat_id'], 'type': 'private'},
+            'from': BOT_USER,
+        }
+        if edited:
+            message['edit_date'] = int(time.time())
+        if text is not None:
+            message['text'] = text
+        else:
+            file_id = photo or f'file-{message_id}-{time.monotonic_ns()}'
+            message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 1, 'height': 1}]
+            message['caption'] = caption
+        reply_markup = parameters.get('reply_markup')
+        if reply_markup:
+            message['reply_markup'] = json.loads(reply_markup) if isinstance(reply_markup, str) else reply_markup
+        self.messages[parameters['chat_id'], message_id] = message
+        self.last_messages[parameters['chat_id']] = message
+        return message
+
+
+class AsyncJourney:
+    """Sends updates of users into the application and taps buttons of the messages bot sent back."""
+
+    def __init__(self, application: Application, request: FakeTelegramRequest):
+        self.application = application
+        self.request = request
+        self._update_ids = count(1)
+
+    async def send_message(self, chat_id: int, text: str) -> dict:
+        update_id = next(self._update_ids)
+        return await self._process(chat_id, {
+            'update_id': update_id,
+            'message': {
+                'message_id': 100000 + update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+                'text': text,
+            },
+        })
+
+    async def tap_button(self, message: dict, callback_data: str) -> dict:
+        chat_id = message['chat']['id']
+        update_id = next(self._update_ids)
+        return await self._process(chat_id, {
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': 'User'},
+                'chat_instance': str(chat_id),
+                'message': self.request.messages[chat_id, message['message_id']],
+                'data': callback_data,
+            },
+        })
+
+    async def run(self, chat_id: int, product_id: int):
+        menu = await self.send_message(chat_id, '/start')
+        product_card = await self.tap_button(menu, str(product_id))
+        menu = await self.tap_button(product_card, f'add_to_cart;{product_id}')
+        cart = await self.tap_button(menu, 'cart')
+        await self.tap_button(cart, 'payment')
+        await self.send_message(chat_id, f'user{chat_id}@example.com')
+
+    async def _process(self, chat_id: int, update_data: dict) -> dict:
+        """Process update and return the last message bot sent to the chat or edited."""
+        await self.application.process_update(Update.de_json(update_data, self.application.bot))
+        return self.request.last_messages[chat_id]
+
+
+@pytest.fixture
+def telegram_request():
+    return FakeTelegramRequest()
+
+
+@pytest.fixture
+def fake_async_redis():
+    return FakeAsyncRedis()
+
+
+@pytest.fixture
+def strapi_env(monkeypatch, fake_strapi):
+    monkeypatch.setenv('STRAPI_HOST', f'http://127.0.0.1:{fake_strapi.server.server_port}/')
+    monkeypatch.setenv('STRAPI_TOKEN', 'token')
+
+
+def run_with_application(telegram_request: FakeTelegramRequest, redis_db: FakeAsyncRedis, scenario):
+    async def run():
+        application = Application.builder().token(TOKEN).request(telegram_request).build()
+        init_bot_data(application.bot_data, Env(), redis_db)
+        add_handlers(application, admin_tg_ids=[])
+        await application.initialize()
+        try:
+            await scenario(AsyncJourney(application, telegram_request))
+        finally:
+            await application.shutdown()
+            await close_bot_data(application)
+
+    asyncio.run(run())
+
+
+def test_journey_fills_cart_and_saves_email(strapi_env, fake_strapi, telegram_request, fake_async_redis):
+    async def scenario(journey: AsyncJourney):
+        await journey.run(chat_id=99, product_id=1)
+
+    run_with_application(telegram_request, fake_async_redis, scenario)
+
+    assert [ordered_product['amount'] for ordered_product in fake_strapi.ordered_products.values()] == [1]
+    assert [customer['email'] for customer in fake_strapi.customers.values()] == ['user99@example.com']
+    assert fake_async_redis.redis_db.hget('fish_shop:session:99', 'state') == 'HANDLE_MENU'
+
+
+def test_chats_are_processed_concurrently(strapi_env, fake_strapi, telegram_request, fake_async_redis):
+    chat_ids = range(1, 21)
+
+    async def scenario(journey: AsyncJourney):
+        await asyncio.gather(*(journey.run(chat_id, chat_id % 5 + 1) for chat_id in chat_ids))
+
+    run_with_application(telegram_request, fake_async_redis, scenario)
+
+    assert len(fake_strapi.ordered_products) == len(chat_ids)
+    assert sorted(customer['email'] for customer in fake_strapi.customers.values()) == sorted(
+        f'user{chat_id}@example.com' for chat_id in chat_ids
+    )
+
+
+def test_updates_of_chat_are_processed_in_order(strapi_env, fake_strapi, telegram_request, fake_async_redis):
+    async def scenario(journey: AsyncJourney):
+        menu = await journey.send_message(99, '/start')
+        product_card = await journey.tap_button(menu, '1')
+        # Cart is shown only after the product is added, though both taps are processed at once
+        await asyncio.gather(journey.tap_button(product_card, 'add_to_cart;1'),
+                             journey.tap_button(product_card, 'cart'))
+
+    run_with_application(telegram_request, fake_async_redis, scenario)
+
+    assert [ordered_product['amount'] for ordered_product in fake_strapi.ordered_products.values()] == [1]
+    assert telegram_request.last_messages[99]['text'].startswith('Товар:')
+    assert fake_async_redis.redis_db.hget('fish_shop:session:99', 'state') == 'HANDLE_CART'
+
+
+def test_broken_file_id_is_uploaded_again(strapi_env, telegram_request, fake_async_redis):
+    async def scenario(journey: AsyncJourney):
+        menu = await journey.send_message(99, '/start')
+        product_card = await journey.tap_button(menu, '1')
+        file_id = product_card['photo'][-1]['file_id']
+        telegram_request.broken_file_ids.add(file_id)
+        menu = await journey.send_message(99, '/start')
+        product_card = await journey.tap_button(menu, '1')
+        assert product_card['photo'][-1]['file_id'] != file_id
+
+    run_with_application(telegram_request, fake_async_redis, scenario)
+
+    uploads = [is_upload for api_method, _, is_upload in telegram_request.calls if api_method == 'sendPhoto']
+    assert uploads == [True, False, True]
+
+
+def test_unavailable_strapi_keeps_state(monkeypatch, telegram_request, fake_async_redis):
+    monkeypatch.setenv('STRAPI_HOST', f'http://127.0.0.1:{get_closed_port()}/')
+    monkeypatch.setenv('STRAPI_TOKEN', 'token')
+
+    async def scenario(journey: AsyncJourney):
+        message = await journey.send_message(99, '/start')
+        assert message['text'] == 'Магазин временно недоступен, попробуйте через минуту.'
+
+    run_with_application(telegram_request, fake_async_redis, scenario)
+
+    assert fake_async_redis.redis_db.hget('fish_shop:session:99', 'state') is None
@@ -0,0 +1,34 @@
+from benchmark import compare_reports
+
+
+def get_report(updates_per_second: float = 100, strapi_calls: float = 5, p99: float = 0.01) -> dict:
+    return {
+        'updates_per_second': updates_per_second,
+        'strapi_calls_per_journey': strapi_calls,
+        'redis_commands_per_journey': 20,
+        'latencies': {'cart': {'p50': p99 / 2, 'p99': p99}},
+    }
+
+
+def test_changes_within_allowed_regression_pass():
+    report = get_report(updates_per_second=85, strapi_calls=5.5, p99=0.0115)
+
+    assert compare_reports(report, get_report(), max_regression=0.2) == []
+
+
+def test_improvements_are_not_regressions():
+    report = get_report(updates_per_second=300, strapi_calls=1, p99=0.001)
+
+    assert compare_reports(report, get_report(), max_regression=0.2) == []
+
+
+def test_regressions_are_reported():
+    report = get_report(updates_per_second=70, strapi_calls=7, p99=0.02)
+
+    regressions = compare_reports(report, get_report(), max_regression=0.2)
+
+    assert [regression.split(':')[0] for regression in regressions] == [
+        'updates_per_second',
+        'strapi_calls_per_journey',
+        'cart p99',
+    ]
@@ -0,0 +1,74 @@
+import copy
+
+import pytest
+from environs import Env
+
+from benchmark import FakeTelegram, JourneyRunner, send_message, tap_button
+from bot import close_bot_data, init_bot_data
+
+CHAT_ID = 99
+
+
+@pytest.fixture
+def runner(monkeypatch, fake_strapi, fake_redis, sessions):
+    monkeypatch.setenv('STRAPI_HOST', f'http://127.0.0.1:{fake_strapi.server.server_port}/')
+    monkeypatch.setenv('STRAPI_TOKEN', 'token')
+    monkeypatch.setenv('WRITE_BEHIND', 'false')
+    bot_data = {}
+    init_bot_data(bot_data, Env(), fake_redis)
+    bot_data['sessions'] = sessions
+    yield JourneyRunner(bot_data, FakeTelegram(), products_count=len(fake_strapi.products))
+    close_bot_data(bot_data)
+
+
+def test_journey_fills_cart_and_saves_email(runner, fake_strapi):
+    runner.run_journey(CHAT_ID, 0)
+
+    assert [ordered_product['amount'] for ordered_product in fake_strapi.ordered_products.values()] == [1]
+    assert [customer['email'] for customer in fake_strapi.customers.values()] == [f'user{CHAT_ID}@example.com']
+
+
+def test_unknown_button_keeps_state(runner, sessions):
+    menu = runner.step('start', send_message(runner.telegram, CHAT_ID, '/start'))
+    cart = runner.step('cart', tap_button(menu, 'cart'))
+    with pytest.raises(RuntimeError, match='sent nothing'):
+        runner.step('unknown', tap_button(cart, 'unknown'))
+
+    assert sessions.read_field(CHAT_ID, 'state') == 'HANDLE_CART'
+    runner.step('cancel', tap_button(cart, 'cancel'))
+    assert sessions.read_field(CHAT_ID, 'state') == 'HANDLE_MENU'
+
+
+def test_unknown_state_falls_back_to_start(runner, sessions):
+    sessions.write_field(sessions.load(CHAT_ID), 'state', 'BROKEN')
+
+    runner.step('text', send_message(runner.telegram, CHAT_ID, 'hello'))
+
+    assert sessions.read_field(CHAT_ID, 'state') == 'HANDLE_MENU'
+
+
+def test_fast_paging_is_not_deduplicated(runner):
+    runner.bot_data['catalog_page_size'] = 2
+    menu = runner.step('start', send_message(runner.telegram, CHAT_ID, '/start'))
+
+    # Going back and forth within a second shows the same screens with the same edit time again
+    for callback_data in ('menu_page;2', 'menu_page;1', 'menu_page;2', 'menu_page;1'):
+        menu = runner.step('page', tap_button(menu, callback_data))
+
+    assert runner.telegram.calls['editMessageText'] == 4
+    assert runner.bot_data['chat_guard'].stats()['duplicates'] == 0
+
+
+def test_double_add_to_cart_tap_adds_product_once(runner, fake_strapi):
+    menu = runner.step('start', send_message(runner.telegram, CHAT_ID, '/start'))
+    product_card = runner.step('product', tap_button(menu, '1'))
+    # Second tap carries the card as it was before the bot answered the first one
+    product_card_copy = copy.copy(product_card)
+
+    runner.step('add', tap_button(product_card, 'add_to_cart;1'))
+    with pytest.raises(RuntimeError, match='sent nothing'):
+        runner.step('add', tap_button(product_card_copy, 'add_to_cart;1'))
+
+    assert [ordered_product['amount'] for ordered_product in fake_strapi.ordered_products.values()] == [1]
+    assert runner.telegram.calls['answerCallbackQuery'] == 3
+    assert runner.bot_data['chat_guard'].stats()['duplicates'] == 1
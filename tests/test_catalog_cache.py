@@ -0,0 +1,100 @@
+import asyncio
+
+import aiohttp
+import pytest
+import requests
+from environs import Env
+
+from async_strapi_api import AsyncStrapiClient
+from catalog_cache import CatalogCache
+from models_config import get_models_config
+from strapi_api import StrapiClient
+from tests.helpers import get_closed_port
+
+
+@pytest.fixture
+def unavailable_strapi_client():
+    strapi_client = StrapiClient(f'http://127.0.0.1:{get_closed_port()}/', 'token', get_models_config(Env()), retries=0)
+    yield strapi_client
+    strapi_client.close()
+
+
+def test_fresh_entry_is_served_from_cache(strapi_client, fake_strapi):
+    catalog = CatalogCache(strapi_client, ttl=60)
+
+    assert catalog.get_product_detail(2) == catalog.get_product_detail(2)
+    assert fake_strapi.calls['GET /api/products/:id'] == 1
+    assert catalog.stats()['hits'] == 1
+
+
+def test_expired_entry_is_served_while_strapi_is_unavailable(strapi_client, unavailable_strapi_client):
+    catalog = CatalogCache(strapi_client, ttl=0)
+    detail = catalog.get_product_detail(2)
+    products = catalog.get_products()
+
+    catalog.strapi_client = unavailable_strapi_client
+
+    assert catalog.get_product_detail(2) == detail
+    assert catalog.get_products() == products
+    assert catalog.stats()['stale_hits'] == 2
+
+
+def test_deleted_product_is_evicted(strapi_client, fake_strapi):
+    catalog = CatalogCache(strapi_client, ttl=0)
+    catalog.get_product_detail(2)
+    version = catalog.version
+    del fake_strapi.products[2]
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        catalog.get_product_detail(2)
+
+    assert catalog.stats()['details_cached'] == 0
+    assert catalog.stats()['stale_hits'] == 0
+    assert catalog.version > version
+
+
+def test_async_methods_share_entries(strapi_client, fake_strapi):
+    async_strapi_client = AsyncStrapiClient(strapi_client.hostname, 'token', strapi_client.models_config)
+    catalog = CatalogCache(strapi_client, ttl=60, async_strapi_client=async_strapi_client)
+    detail = catalog.get_product_detail(2)
+
+    async def get_details():
+        try:
+            return await asyncio.gather(catalog.get_product_detail_async(2), catalog.get_product_detail_async(3))
+        finally:
+            await async_strapi_client.close()
+
+    assert asyncio.run(get_details())[0] == detail
+    assert fake_strapi.calls['GET /api/products/:id'] == 2
+    assert catalog.stats()['details_cached'] == 2
+
+
+def test_expired_entry_is_served_async_while_strapi_is_unavailable(strapi_client):
+    async_strapi_client = AsyncStrapiClient(f'http://127.0.0.1:{get_closed_port()}/', 'token', strapi_client.models_config)
+    catalog = CatalogCache(strapi_client, ttl=0, async_strapi_client=async_strapi_client)
+    detail = catalog.get_product_detail(2)
+
+    async def get_detail():
+        try:
+            return await catalog.get_product_detail_async(2)
+        finally:
+            await async_strapi_client.close()
+
+    assert asyncio.run(get_detail()) == detail
+    assert catalog.stats()['stale_hits'] == 1
+
+
+def test_deleted_product_is_evicted_async(strapi_client, fake_strapi):
+    async_strapi_client = AsyncStrapiClient(strapi_client.hostname, 'token', strapi_client.models_config)
+    catalog = CatalogCache(None, ttl=0, async_strapi_client=async_strapi_client)
+    del fake_strapi.products[2]
+
+    async def get_detail():
+        try:
+            return await catalog.get_product_detail_async(2)
+        finally:
+            await async_strapi_client.close()
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        asyncio.run(get_detail())
+    assert catalog.stats()['details_cached'] == 0
@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from chat_guard import ChatGuard, RedisChatGuard
+from tests.helpers import wait_until
+
+CHAT_ID = 99
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def chat_guard(request, fake_redis):
+    if request.param == 'redis':
+        return RedisChatGuard(fake_redis, dedup_window=0.2)
+    return ChatGuard(dedup_window=0.2)
+
+
+def test_same_tap_is_duplicate_within_window(chat_guard):
+    assert not chat_guard.is_duplicate(CHAT_ID, 1, 'cart', 'screen')
+    assert chat_guard.is_duplicate(CHAT_ID, 1, 'cart', 'screen')
+
+    time.sleep(0.25)
+
+    assert not chat_guard.is_duplicate(CHAT_ID, 1, 'cart', 'screen')
+    assert chat_guard.stats()['duplicates'] == 1
+
+
+def test_other_taps_are_not_duplicates(chat_guard):
+    assert not chat_guard.is_duplicate(CHAT_ID, 1, 'cart', 'menu')
+
+    assert not chat_guard.is_duplicate(CHAT_ID, 1, 'cancel', 'menu')
+    assert not chat_guard.is_duplicate(CHAT_ID, 2, 'cart', 'menu')
+    assert not chat_guard.is_duplicate(CHAT_ID + 1, 1, 'cart', 'menu')
+    assert chat_guard.stats()['duplicates'] == 0
+
+
+def test_tap_on_edited_screen_is_not_duplicate(chat_guard):
+    assert not chat_guard.is_duplicate(CHAT_ID, 1, 'menu_page;2', 'page 1')
+    assert not chat_guard.is_duplicate(CHAT_ID, 1, 'menu_page;1', 'page 2')
+
+    # Back on the first page, the same button of the same screen is tapped again
+    assert not chat_guard.is_duplicate(CHAT_ID, 1, 'menu_page;2', 'page 1')
+    assert chat_guard.stats()['duplicates'] == 0
+
+
+def test_chat_lock_is_released_after_last_user(chat_guard):
+    first_locked = threading.Event()
+    release_first = threading.Event()
+    order = []
+
+    def process(name: str, locked: threading.Event = None, release: threading.Event = None):
+        with chat_guard.lock(CHAT_ID):
+            if locked:
+                locked.set()
+                release.wait(1)
+            order.append(name)
+
+    first = threading.Thread(target=process, args=('first', first_locked, release_first))
+    first.start()
+    first_locked.wait(1)
+    second = threading.Thread(target=process, args=('second',))
+    second.start()
+    if isinstance(chat_guard, ChatGuard):
+        wait_until(lambda: chat_guard._chat_locks[CHAT_ID][1] == 2)
+    assert chat_guard.stats()['locked_chats'] == 1
+
+    release_first.set()
+    first.join(1)
+    second.join(1)
+
+    assert order == ['first', 'second']
+    assert chat_guard.stats()['locked_chats'] == 0
+
+
+def test_async_chat_lock_keeps_order_and_is_released():
+    chat_guard = ChatGuard()
+    order = []
+
+    async def process(name: str):
+        async with chat_guard.lock_async(CHAT_ID):
+            await asyncio.sleep(0)
+            order.append(name)
+
+    async def process_all():
+        tasks = [asyncio.create_task(process(name)) for name in ('first', 'second', 'third')]
+        await asyncio.sleep(0)
+        assert chat_guard.stats()['locked_chats'] == 1
+        await asyncio.gather(*tasks)
+
+    asyncio.run(process_all())
+
+    assert order == ['first', 'second', 'third']
+    assert chat_guard.stats()['locked_chats'] == 0
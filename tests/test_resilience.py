@@ -0,0 +1,154 @@
+import asyncio
+import threading
+import time
+
+import aiohttp
+import pytest
+import requests
+
+from resilience import CallGuard, CircuitBreaker, StrapiUnavailableError, TokenBucket, is_failure
+
+
+def get_http_error(status_code: int) -> requests.exceptions.HTTPError:
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.exceptions.HTTPError(response=response)
+
+
+def test_token_bucket_allows_burst_then_waits_for_rate():
+    bucket = TokenBucket(rate=20, capacity=2)
+
+    assert bucket.acquire(timeout=0)
+    assert bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0)
+    assert bucket.acquire(timeout=0.2)
+
+
+def test_token_bucket_with_rate_below_one_holds_a_token():
+    assert TokenBucket(0.5).acquire(timeout=0)
+
+
+def test_token_bucket_acquire_async():
+    bucket = TokenBucket(rate=20, capacity=1)
+
+    async def acquire_twice():
+        return await bucket.acquire_async(timeout=0), await bucket.acquire_async(timeout=0)
+
+    assert asyncio.run(acquire_twice()) == (True, False)
+
+
+def test_circuit_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert not breaker.is_open
+
+    breaker.record_failure()
+    assert breaker.is_open
+    assert not breaker.allow()
+    assert breaker.stats()['rejected'] == 1
+
+
+def test_circuit_breaker_lets_single_trial_call_after_reset_timeout():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    breaker.record_failure()
+    assert breaker.is_open
+    time.sleep(0.02)
+    assert breaker.allow()
+    breaker.record_success()
+    assert not breaker.is_open
+    assert breaker.allow()
+
+
+def test_call_guard_records_only_strapi_failures():
+    guard = CallGuard(breaker=CircuitBreaker(failure_threshold=1))
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        with guard.call():
+            raise get_http_error(404)
+    assert not guard.breaker.is_open
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        with guard.call():
+            raise get_http_error(502)
+    assert guard.breaker.is_open
+
+    with pytest.raises(StrapiUnavailableError):
+        with guard.call():
+            pass
+
+
+def test_call_guard_rejects_call_when_no_slot_is_free():
+    guard = CallGuard(max_concurrency=1, acquire_timeout=0.05)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def hold_slot():
+        with guard.call():
+            entered.set()
+            release.wait()
+
+    thread = threading.Thread(target=hold_slot)
+    thread.start()
+    entered.wait()
+    with pytest.raises(StrapiUnavailableError):
+        with guard.call():
+            pass
+    release.set()
+    thread.join()
+
+    assert guard.stats()['throttled'] == 1
+    assert guard.stats()['in_flight'] == 0
+    with guard.call():
+        pass
+
+
+def test_call_guard_limits_concurrency_of_coroutines():
+    guard = CallGuard(max_concurrency=2, acquire_timeout=None)
+    peak = 0
+
+    async def call():
+        nonlocal peak
+        async with guard.call_async():
+            peak = max(peak, guard.in_flight)
+            await asyncio.sleep(0.01)
+
+    async def call_many():
+        await asyncio.gather(*[call() for _ in range(10)])
+
+    asyncio.run(call_many())
+    assert peak == 2
+    assert guard.in_flight == 0
+
+
+def test_call_guard_records_failures_of_coroutines():
+    guard = CallGuard(breaker=CircuitBreaker(failure_threshold=1))
+
+    async def fail():
+        async with guard.call_async():
+            raise aiohttp.ClientConnectionError()
+
+    with pytest.raises(aiohttp.ClientConnectionError):
+        asyncio.run(fail())
+    assert guard.breaker.is_open
+
+
+@pytest.mark.parametrize('error, expected', [
+    (get_http_error(500), True),
+    (get_http_error(404), False),
+    (requests.exceptions.ConnectTimeout(), True),
+    (aiohttp.ClientResponseError(None, (), status=503), True),
+    (aiohttp.ClientResponseError(None, (), status=400), False),
+    (asyncio.TimeoutError(), True),
+    (ValueError(), False),
+])
+def test_is_failure(error, expected):
+    assert is_failure(error) == expected
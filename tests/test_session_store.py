@@ -0,0 +1,75 @@
+import asyncio
+
+from fakes import FakeAsyncRedis
+from session_store import AsyncRedisSessionStore, RedisSessionStore
+
+
+def test_async_store_shares_sessions_with_sync_one(fake_redis):
+    sessions = RedisSessionStore(fake_redis)
+    async_sessions = AsyncRedisSessionStore(FakeAsyncRedis(fake_redis))
+    session = sessions.load(99)
+    session.set('state', 'HANDLE_MENU')
+    session.set('cart', '{}')
+    sessions.save(session)
+
+    async def update_session():
+        session = await async_sessions.load(99)
+        session.set('state', 'HANDLE_CART')
+        session.delete('cart')
+        await async_sessions.save(session)
+        await async_sessions.write_field(session, 'cart_id', 5)
+        return session
+
+    session = asyncio.run(update_session())
+
+    assert session.get('cart_id') == '5'
+    assert fake_redis.hgetall('fish_shop:session:99') == {'state': 'HANDLE_CART', 'cart_id': '5'}
+    assert sessions.load(99).get('state') == 'HANDLE_CART'
+
+
+def test_async_store_lock_serializes_chat(fake_redis):
+    async_sessions = AsyncRedisSessionStore(FakeAsyncRedis(fake_redis))
+    events = []
+
+    async def create_cart(name: str):
+        async with async_sessions.lock(99, 'cart_id'):
+            events.append(f'{name} started')
+            await asyncio.sleep(0)
+            events.append(f'{name} finished')
+
+    async def create_carts():
+        await asyncio.gather(create_cart('first'), create_cart('second'))
+
+    asyncio.run(create_carts())
+
+    assert events == ['first started', 'first finished', 'second started', 'second finished']
+
+
+def test_legacy_state_is_migrated(fake_redis):
+    sessions = RedisSessionStore(fake_redis)
+    fake_redis.set('99', 'HANDLE_CART')
+
+    assert sessions.load(99).get('state') == 'HANDLE_CART'
+
+    assert fake_redis.get('99') is None
+    assert fake_redis.hgetall('fish_shop:session:99') == {'state': 'HANDLE_CART'}
+    assert sessions.load(99).get('state') == 'HANDLE_CART'
+
+
+def test_legacy_state_is_migrated_async(fake_redis):
+    async_sessions = AsyncRedisSessionStore(FakeAsyncRedis(fake_redis))
+    fake_redis.set('99', 'WAITING_EMAIL')
+
+    session = asyncio.run(async_sessions.load(99))
+
+    assert session.get('state') == 'WAITING_EMAIL'
+    assert fake_redis.get('99') is None
+    assert fake_redis.hget('fish_shop:session:99', 'state') == 'WAITING_EMAIL'
+
+
+def test_session_is_preferred_to_legacy_state(fake_redis):
+    sessions = RedisSessionStore(fake_redis)
+    sessions.write_field(sessions.load(99), 'state', 'HANDLE_MENU')
+    fake_redis.set('99', 'HANDLE_CART')
+
+    assert sessions.load(99).get('state') == 'HANDLE_MENU'
@@ -0,0 +1,55 @@
+from telegram import Update
+
+from sharding import StreamUpdateConsumer, StreamUpdateProducer, get_shard, get_stream_key
+from tests.helpers import UpdatesRecorder, get_update_data, wait_until
+
+
+def test_updates_of_a_chat_go_to_the_same_shard(bot):
+    updates = [Update.de_json(get_update_data(update_id, 5, 'text'), bot) for update_id in range(1, 4)]
+
+    assert {get_shard(update, 3) for update in updates} == {2}
+
+
+def test_consumer_processes_updates_of_a_chat_in_order(fake_redis, bot):
+    producer = StreamUpdateProducer(fake_redis, namespace='test', shards=2)
+    update_id = 0
+    for number in range(10):
+        for chat_id in range(1, 5):
+            update_id += 1
+            assert producer.put(Update.de_json(get_update_data(update_id, chat_id, str(number)), bot))
+    assert producer.stats()['queued'] == 40
+
+    recorder = UpdatesRecorder(delay=0.002)
+    consumer = StreamUpdateConsumer(fake_redis, bot, recorder, [0, 1], namespace='test', block_timeout=0.05)
+    consumer.start()
+    wait_until(lambda: consumer.stats()['processed'] == 40)
+    consumer.stop()
+
+    assert recorder.texts == {chat_id: [str(number) for number in range(10)] for chat_id in range(1, 5)}
+    assert producer.stats()['queued'] == 0
+
+
+def test_consumer_processes_updates_left_unacknowledged_by_crashed_worker(fake_redis, bot):
+    producer = StreamUpdateProducer(fake_redis, namespace='test', shards=1)
+    stream_key = get_stream_key('test', 0)
+    producer.put(Update.de_json(get_update_data(1, 1, 'first'), bot))
+    fake_redis.xgroup_create(stream_key, StreamUpdateConsumer.group, id='0')
+    # Crashed worker read the update but didn't acknowledge it
+    fake_redis.xreadgroup(StreamUpdateConsumer.group, 'shard-0', {stream_key: '>'})
+    producer.put(Update.de_json(get_update_data(2, 1, 'second'), bot))
+
+    recorder = UpdatesRecorder()
+    consumer = StreamUpdateConsumer(fake_redis, bot, recorder, [0], namespace='test', block_timeout=0.05)
+    consumer.start()
+    wait_until(lambda: consumer.stats()['processed'] == 2)
+    consumer.stop()
+
+    assert recorder.texts == {1: ['first', 'second']}
+
+
+def test_producer_rejects_update_when_stream_is_full(fake_redis, bot):
+    producer = StreamUpdateProducer(fake_redis, namespace='test', shards=1, queue_size=1, put_timeout=0)
+
+    assert producer.put(Update.de_json(get_update_data(1, 1, 'first'), bot))
+    assert not producer.put(Update.de_json(get_update_data(2, 1, 'second'), bot))
+    assert producer.stats()['rejected'] == 1
@@ -0,0 +1,34 @@
+from strapi_api import QUERY_PROFILES
+from strapi_api import add_ordered_product_into_cart, compile_query_profile, create_ordered_product, get_or_create_cart
+
+
+def test_add_ordered_product_into_cart(strapi_client, fake_strapi):
+    first_cart_id = get_or_create_cart(strapi_client, 1)['id']
+    second_cart_id = get_or_create_cart(strapi_client, 2)['id']
+    ordered_product = create_ordered_product(strapi_client, 1, cart_id=first_cart_id, fixed_price=101)
+
+    add_ordered_product_into_cart(strapi_client, ordered_product['id'], second_cart_id)
+
+    assert fake_strapi.ordered_products[ordered_product['id']]['cart'] == second_cart_id
+
+
+def test_cart_profile_populates_configured_product_relation():
+    params = compile_query_profile(QUERY_PROFILES['cart'], {'strapi_product_name': 'fish'})
+
+    assert params == {
+        'fields[0]': 'user_tg_id',
+        'populate[ordered_products][fields][0]': 'amount',
+        'populate[ordered_products][fields][1]': 'fixed_price',
+        'populate[ordered_products][populate][fish][fields][0]': 'Title',
+    }
+
+
+def test_ordered_product_export_profile_populates_product_and_cart():
+    params = compile_query_profile(QUERY_PROFILES['ordered_product_export'], {'strapi_product_name': 'product'})
+
+    assert params == {
+        'fields[0]': 'amount',
+        'fields[1]': 'fixed_price',
+        'populate[product][fields][0]': 'Title',
+        'populate[cart][fields][0]': 'id',
+    }
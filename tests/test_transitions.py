@@ -0,0 +1,124 @@
+from collections import Counter
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import BadRequest
+
+from benchmark import FakeCallbackQuery, FakeMessage, FakeTelegram
+from screens import EMPTY_CART_MARKUP
+from transitions import get_screen_id, show_photo, show_text
+
+CHAT_ID = 99
+
+
+class BrokenFileIdMessage(FakeMessage):
+    """Message Telegram refuses to send photos by outdated file IDs to."""
+
+    def reply_photo(self, photo, *args, **kwargs) -> FakeMessage:
+        if isinstance(photo, str):
+            self.telegram.call('sendPhoto(file_id)', self.chat_id)
+            raise BadRequest('Wrong file identifier/http url specified')
+        return super().reply_photo(photo, *args, **kwargs)
+
+
+class BrokenFileIdCallbackQuery(FakeCallbackQuery):
+    def edit_message_media(self, media, reply_markup=None, **kwargs) -> FakeMessage:
+        if isinstance(media.media, str):
+            self.message.telegram.call('editMessageMedia(file_id)', self.message.chat_id)
+            raise BadRequest('Wrong file identifier/http url specified')
+        return super().edit_message_media(media, reply_markup=reply_markup, **kwargs)
+
+
+class TransitionsRecorder:
+    """Stand-in for `Metrics` counting transitions by kind."""
+
+    def __init__(self):
+        self.transitions = Counter()
+
+    def inc(self, name: str, labels: dict = None, value: float = 1):
+        assert name == 'telegram_transitions_total'
+        self.transitions[labels['kind']] += value
+
+
+@pytest.fixture
+def telegram():
+    return FakeTelegram()
+
+
+@pytest.fixture
+def metrics():
+    return TransitionsRecorder()
+
+
+def tap(message: FakeMessage, query_class: type = FakeCallbackQuery) -> SimpleNamespace:
+    return SimpleNamespace(message=None, callback_query=query_class(message, 'cancel'))
+
+
+def test_text_is_edited_in_place(telegram, metrics):
+    source = FakeMessage(telegram, CHAT_ID, 1, text='Меню')
+
+    message = show_text(tap(source), 'Корзина', reply_markup=EMPTY_CART_MARKUP, metrics=metrics)
+
+    assert message is source
+    assert message.text == 'Корзина'
+    assert telegram.calls == {'editMessageText': 1}
+    assert metrics.transitions == {'edit': 1}
+
+
+def test_same_screen_is_not_edited(telegram, metrics):
+    source = FakeMessage(telegram, CHAT_ID, 1, text='Корзина')
+    source.reply_markup = EMPTY_CART_MARKUP
+
+    message = show_text(tap(source), 'Корзина', reply_markup=EMPTY_CART_MARKUP, metrics=metrics)
+
+    assert message is source
+    assert not telegram.calls
+    assert metrics.transitions == {'skip': 1}
+
+
+def test_photo_is_replaced_with_new_text_message(telegram, metrics):
+    source = FakeMessage(telegram, CHAT_ID, 1, photo=True)
+
+    message = show_text(tap(source), 'Меню', metrics=metrics)
+
+    assert message is not source
+    assert message.text == 'Меню'
+    assert telegram.calls == {'sendMessage': 1, 'deleteMessage': 1}
+    assert metrics.transitions == {'send': 1}
+
+
+def test_broken_file_id_fails_for_caller(telegram, metrics):
+    source = BrokenFileIdMessage(telegram, CHAT_ID, 1, photo=True)
+
+    with pytest.raises(BadRequest):
+        show_photo(tap(source, BrokenFileIdCallbackQuery), 'broken-file-id', 'Карп', metrics=metrics)
+
+    assert telegram.calls == {'editMessageMedia(file_id)': 1, 'sendPhoto(file_id)': 1}
+    assert not telegram.calls['deleteMessage']
+
+
+def test_photo_is_uploaded_instead_of_broken_file_id(telegram, metrics):
+    source = BrokenFileIdMessage(telegram, CHAT_ID, 1, photo=True)
+    update = tap(source, BrokenFileIdCallbackQuery)
+    with pytest.raises(BadRequest):
+        show_photo(update, 'broken-file-id', 'Карп', metrics=metrics)
+
+    message = show_photo(update, BytesIO(b'image'), 'Карп', metrics=metrics)
+
+    assert message is source
+    assert message.caption == 'Карп'
+    assert telegram.calls['editMessageMedia(upload)'] == 1
+    assert metrics.transitions == {'edit': 1}
+
+
+def test_screen_id_changes_with_every_edit(telegram):
+    message = FakeMessage(telegram, CHAT_ID, 1, text='Меню')
+    query = FakeCallbackQuery(message, 'menu_page;2')
+    screen_ids = [get_screen_id(message)]
+    for text in ('Страница 2', 'Страница 1'):
+        query.edit_message_text(text)
+        screen_ids.append(get_screen_id(message))
+
+    # Edits within the same second differ by the content of the screen
+    assert len(set(screen_ids)) == 3
@@ -0,0 +1,100 @@
+import threading
+
+import pytest
+import requests
+from telegram import Update
+
+from tests.helpers import UpdatesRecorder, get_update_data, wait_until
+from webhook import ChatOrderedWorkerPool, get_webhook_server
+
+SECRET_TOKEN = 'secret'
+
+
+def send_update(url: str, update_data: dict, secret_token: str = None) -> int:
+    """Post update to the webhook the way Telegram does and return the response status."""
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret_token} if secret_token else {}
+    return requests.post(url, json=update_data, headers=headers, timeout=5).status_code
+
+
+def test_updates_of_a_chat_are_processed_in_order(bot):
+    recorder = UpdatesRecorder(delay=0.002)
+    pool = ChatOrderedWorkerPool(recorder, workers=3)
+    pool.start()
+    update_ids = iter(range(1, 1000))
+    for number in range(20):
+        for chat_id in range(1, 6):
+            assert pool.put(Update.de_json(get_update_data(next(update_ids), chat_id, str(number)), bot))
+    pool.stop()
+
+    assert recorder.texts == {chat_id: [str(number) for number in range(20)] for chat_id in range(1, 6)}
+    assert pool.stats()['processed'] == 100
+
+
+def test_failed_update_does_not_stop_worker(bot):
+    def handle_update(update: Update):
+        if update.effective_message.text == 'fail':
+            raise ValueError
+        recorder(update)
+
+    recorder = UpdatesRecorder()
+    pool = ChatOrderedWorkerPool(handle_update, workers=1)
+    pool.start()
+    pool.put(Update.de_json(get_update_data(1, 1, 'fail'), bot))
+    pool.put(Update.de_json(get_update_data(2, 1, 'ok'), bot))
+    pool.stop()
+
+    assert recorder.texts == {1: ['ok']}
+    assert pool.stats()['failed'] == 1
+
+
+def test_full_queue_rejects_update(bot):
+    release = threading.Event()
+    pool = ChatOrderedWorkerPool(lambda update: release.wait(), workers=1, queue_size=1, put_timeout=0)
+    pool.start()
+    assert pool.put(Update.de_json(get_update_data(1, 1, 'first'), bot))
+    # Wait until the worker takes the first update and blocks on it
+    wait_until(lambda: not pool.stats()['queued'])
+
+    assert pool.put(Update.de_json(get_update_data(2, 1, 'second'), bot))
+    assert not pool.put(Update.de_json(get_update_data(3, 1, 'third'), bot))
+    release.set()
+    pool.stop()
+    assert pool.stats()['rejected'] == 1
+
+
+@pytest.fixture
+def webhook(bot):
+    recorder = UpdatesRecorder()
+    pool = ChatOrderedWorkerPool(recorder, workers=2)
+    pool.start()
+    server = get_webhook_server(bot, pool, SECRET_TOKEN, listen='127.0.0.1', port=0, url_path='telegram')
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}', pool, recorder
+    server.shutdown()
+    server.server_close()
+    pool.stop()
+
+
+def test_webhook_passes_updates_of_telegram_into_pool(webhook):
+    url, pool, recorder = webhook
+    for number in range(10):
+        assert send_update(f'{url}/telegram', get_update_data(number + 1, 7, str(number)), SECRET_TOKEN) == 200
+    pool.stop()
+
+    assert recorder.texts == {7: [str(number) for number in range(10)]}
+
+
+def test_webhook_rejects_update_without_secret_token(webhook):
+    url, pool, recorder = webhook
+
+    assert send_update(f'{url}/telegram', get_update_data(1, 7, 'forged')) == 403
+    assert send_update(f'{url}/telegram', get_update_data(2, 7, 'forged'), 'wrong') == 403
+    assert send_update(f'{url}/other', get_update_data(3, 7, 'lost'), SECRET_TOKEN) == 404
+    assert requests.post(f'{url}/telegram',
+                         data='not json',
+                         headers={'X-Telegram-Bot-Api-Secret-Token': SECRET_TOKEN},
+                         timeout=5).status_code == 400
+    pool.stop()
+
+    assert recorder.texts == {}
+    assert pool.stats()['accepted'] == 0
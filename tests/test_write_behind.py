@@ -0,0 +1,175 @@
+import json
+
+import pytest
+from environs import Env
+
+import write_behind
+from models_config import get_models_config
+from strapi_api import StrapiClient, get_or_create_cart, get_or_create_customer
+from tests.helpers import get_closed_port
+from write_behind import WriteBehindQueue
+
+CHAT_ID = 99
+
+
+@pytest.fixture
+def queue(fake_redis, strapi_client, sessions):
+    return WriteBehindQueue(fake_redis, strapi_client, sessions, namespace='test', retry_delay=0)
+
+
+@pytest.fixture
+def cart_id(strapi_client):
+    return get_or_create_cart(strapi_client, CHAT_ID)['id']
+
+
+def get_cart_lines(fake_strapi, cart_id: int) -> list[tuple[int, float]]:
+    return sorted(
+        (ordered_product['product'], ordered_product['amount'])
+        for ordered_product in fake_strapi.ordered_products.values() if ordered_product['cart'] == cart_id
+    )
+
+
+def test_mutations_of_a_line_in_a_batch_are_coalesced(queue, fake_strapi, cart_id):
+    for amount in (1, 2, 5):
+        queue.set_cart_line(CHAT_ID, cart_id, 1, amount, fixed_price=101)
+    queue.set_cart_line(CHAT_ID, cart_id, 2, 1, fixed_price=102)
+
+    assert queue.flush() == 4
+    assert get_cart_lines(fake_strapi, cart_id) == [(1, 5), (2, 1)]
+    assert fake_strapi.calls['POST /api/ordered-products'] == 2
+    assert queue.stats() == {'pending': 0, 'processing': 0, 'dead': 0, 'flushed': 4, 'failed': 0}
+
+
+def test_mutations_are_applied_in_journal_order(fake_redis, strapi_client, sessions, fake_strapi, cart_id):
+    queue = WriteBehindQueue(fake_redis, strapi_client, sessions, namespace='test', batch_size=1)
+    queue.set_cart_line(CHAT_ID, cart_id, 1, 1, fixed_price=101)
+    queue.set_cart_line(CHAT_ID, cart_id, 1, 3, fixed_price=101)
+
+    assert queue.flush() == 1
+    assert get_cart_lines(fake_strapi, cart_id) == [(1, 1)]
+    assert queue.flush() == 1
+    assert get_cart_lines(fake_strapi, cart_id) == [(1, 3)]
+
+    queue.set_cart_line(CHAT_ID, cart_id, 1, 0)
+    queue.flush()
+    assert get_cart_lines(fake_strapi, cart_id) == []
+
+
+def test_zero_amount_removes_all_lines_of_a_product(queue, fake_strapi, cart_id):
+    for ordered_product_id in (101, 102):
+        fake_strapi.ordered_products[ordered_product_id] = {'product': 1, 'cart': cart_id, 'amount': 1, 'fixed_price': 101}
+
+    queue.set_cart_line(CHAT_ID, cart_id, 1, 0)
+    queue.flush()
+
+    assert get_cart_lines(fake_strapi, cart_id) == []
+
+
+def test_applied_mutation_is_not_applied_again(queue, fake_redis, fake_strapi, cart_id):
+    queue.set_cart_line(CHAT_ID, cart_id, 1, 1, fixed_price=101)
+    raw_mutation = fake_redis.lmove(queue.get_journal_key(0), queue.get_journal_key(0), 'RIGHT', 'LEFT')
+    queue.flush()
+    fake_strapi.ordered_products.clear()
+
+    fake_redis.lpush(queue.get_journal_key(0), raw_mutation)
+    queue.flush()
+
+    assert get_cart_lines(fake_strapi, cart_id) == []
+
+
+def test_recover_returns_unfinished_mutations_into_journal(queue, fake_redis, fake_strapi, cart_id):
+    queue.set_cart_line(CHAT_ID, cart_id, 1, 2, fixed_price=101)
+    queue.set_cart_line(CHAT_ID, cart_id, 2, 1, fixed_price=102)
+    # Worker crashed after taking a batch
+    fake_redis.rpoplpush(queue.get_journal_key(0), queue.get_processing_key(0))
+    assert queue.stats()['processing'] == 1
+
+    queue.recover()
+    assert queue.stats()['pending'] == 2
+    assert queue.stats()['processing'] == 0
+    queue.flush()
+
+    assert get_cart_lines(fake_strapi, cart_id) == [(1, 2), (2, 1)]
+
+
+def test_failed_mutations_are_retried_then_moved_to_dead_letters(fake_redis, sessions):
+    strapi_client = StrapiClient(f'http://127.0.0.1:{get_closed_port()}/', 'token', get_models_config(Env()), retries=0)
+    queue = WriteBehindQueue(fake_redis, strapi_client, sessions, namespace='test', max_attempts=2)
+    queue.set_cart_line(CHAT_ID, 1, 1, 1, fixed_price=101)
+
+    queue.flush()
+    assert queue.stats()['pending'] == 1
+    assert json.loads(fake_redis.lmove(queue.get_journal_key(0), queue.get_journal_key(0)))['attempts'] == 1
+
+    queue.flush()
+    assert queue.stats() == {'pending': 0, 'processing': 0, 'dead': 1, 'flushed': 0, 'failed': 2}
+    strapi_client.close()
+
+
+def test_batch_failed_with_unexpected_error_is_retried(fake_redis, strapi_client, sessions, cart_id, monkeypatch):
+    def parse_unexpected_cart(cart, models_config):
+        raise KeyError('ordered_products')
+
+    monkeypatch.setattr(write_behind, 'parse_cart', parse_unexpected_cart)
+    queue = WriteBehindQueue(fake_redis, strapi_client, sessions, namespace='test', max_attempts=2)
+    queue.set_cart_line(CHAT_ID, cart_id, 1, 1, fixed_price=101)
+
+    queue.flush()
+    assert queue.stats() == {'pending': 1, 'processing': 0, 'dead': 0, 'flushed': 0, 'failed': 1}
+    queue.flush()
+    assert queue.stats() == {'pending': 0, 'processing': 0, 'dead': 1, 'flushed': 0, 'failed': 2}
+
+
+def test_worker_flushes_only_its_shards(fake_redis, strapi_client, sessions, fake_strapi):
+    first_worker = WriteBehindQueue(fake_redis, strapi_client, sessions, namespace='test', shards=2, worker_shards=[0])
+    second_worker = WriteBehindQueue(fake_redis, strapi_client, sessions, namespace='test', shards=2, worker_shards=[1])
+    first_cart_id = get_or_create_cart(strapi_client, 100)['id']
+    second_cart_id = get_or_create_cart(strapi_client, 101)['id']
+    first_worker.set_cart_line(100, first_cart_id, 1, 1, fixed_price=101)
+    first_worker.set_cart_line(101, second_cart_id, 1, 1, fixed_price=101)
+
+    assert second_worker.flush() == 1
+    assert get_cart_lines(fake_strapi, first_cart_id) == []
+    assert get_cart_lines(fake_strapi, second_cart_id) == [(1, 1)]
+    assert first_worker.stats()['pending'] == 1
+
+
+def test_email_of_unknown_customer_caches_customer_id(queue, sessions, fake_strapi):
+    queue.save_email(CHAT_ID, 'user@example.com')
+    queue.flush()
+    queue.save_email(CHAT_ID, 'other@example.com')
+    queue.flush()
+
+    customer_id = sessions.read_field(CHAT_ID, 'customer_id')
+    assert customer_id
+    assert fake_strapi.customers[int(customer_id)]['email'] == 'other@example.com'
+    assert fake_strapi.calls['POST /api/customers'] == 1
+    assert fake_strapi.calls['GET /api/customers'] == 1
+
+
+def test_email_of_deleted_customer_replaces_cached_customer_id(queue, sessions, strapi_client, fake_strapi):
+    stale_customer_id = get_or_create_customer(strapi_client, CHAT_ID)['id']
+    sessions.write_field(sessions.load(CHAT_ID), 'customer_id', stale_customer_id)
+    del fake_strapi.customers[stale_customer_id]
+
+    queue.save_email(CHAT_ID, 'user@example.com', customer_id=stale_customer_id)
+    queue.flush()
+
+    customer_id = int(sessions.read_field(CHAT_ID, 'customer_id'))
+    assert customer_id != stale_customer_id
+    assert fake_strapi.customers[customer_id]['email'] == 'user@example.com'
+
+
+def test_lines_of_deleted_cart_go_into_new_cart(queue, sessions, fake_strapi, cart_id):
+    session = sessions.load(CHAT_ID)
+    sessions.write_field(session, 'cart_id', cart_id)
+    sessions.write_field(session, 'cart', '{}')
+    del fake_strapi.carts[cart_id]
+
+    queue.set_cart_line(CHAT_ID, cart_id, 1, 2, fixed_price=101)
+    queue.flush()
+
+    new_cart_id = int(sessions.read_field(CHAT_ID, 'cart_id'))
+    assert new_cart_id != cart_id
+    assert sessions.read_field(CHAT_ID, 'cart') is None
+    assert get_cart_lines(fake_strapi, new_cart_id) == [(1, 2)]
@@ -0,0 +1,186 @@
+import hashlib
+import json
+from io import BytesIO
+
+from telegram import InlineKeyboardMarkup, InputMediaPhoto, Message, Update
+from telegram.error import BadRequest
+
+from metrics import Metrics
+
+
+def show_text(update: Update,
+              text: str,
+              reply_markup: InlineKeyboardMarkup | str = None,
+              metrics: Metrics = None) -> Message:
+    """Show text screen in place of the message whose button was tapped.
+
+    Text message is edited, unless its text and keyboard are already the same.
+    Photo message can't become a text one, so the new message is sent and the old one is deleted.
+    Reply to a user message is always sent as a new message.
+
+    Args:
+        update(Update): Update of the tap or of the user message
+        text(str): Text of the screen
+        reply_markup(InlineKeyboardMarkup | str): Keyboard of the screen, may be serialized to JSON
+        metrics(Metrics): Registry counting transitions by kind
+    Return:
+        Message: Message showing the screen
+    """
+    query = update.callback_query
+    if not query:
+        return _count(metrics, 'send', update.message.reply_text(text, reply_markup=reply_markup))
+    source = query.message
+    if not source.photo:
+        if _is_text_shown(source, text, reply_markup):
+            return _count(metrics, 'skip', source)
+        try:
+            return _count(metrics, 'edit', query.edit_message_text(text, reply_markup=reply_markup))
+        except BadRequest as error:
+            if is_not_modified(error):
+                return _count(metrics, 'skip', source)
+    message = source.reply_text(text, reply_markup=reply_markup)
+    _delete_message(query)
+    return _count(metrics, 'send', message)
+
+
+async def show_text_async(update: Update,
+                          text: str,
+                          reply_markup: InlineKeyboardMarkup | str = None,
+                          metrics: Metrics = None) -> Message:
+    """Same as `show_text` for async handlers."""
+    query = update.callback_query
+    if not query:
+        return _count(metrics, 'send', await update.message.reply_text(text, reply_markup=reply_markup))
+    source = query.message
+    if not source.photo:
+        if _is_text_shown(source, text, reply_markup):
+            return _count(metrics, 'skip', source)
+        try:
+            return _count(metrics, 'edit', await query.edit_message_text(text, reply_markup=reply_markup))
+        except BadRequest as error:
+            if is_not_modified(error):
+                return _count(metrics, 'skip', source)
+    message = await source.reply_text(text, reply_markup=reply_markup)
+    await _delete_message_async(query)
+    return _count(metrics, 'send', message)
+
+
+def show_photo(update: Update,
+               photo: str | BytesIO,
+               caption: str,
+               reply_markup: InlineKeyboardMarkup | str = None,
+               metrics: Metrics = None) -> Message:
+    """Show photo screen in place of the message whose button was tapped.
+
+    Photo message is edited with the new photo, caption and keyboard, unless they are already the same.
+    Text message can't become a photo one, so the new message is sent and the old one is deleted.
+
+    Args:
+        update(Update): Update of the tap
+        photo(str | BytesIO): Telegram file_id or bytes of the photo
+        caption(str): Caption of the photo
+        reply_markup(InlineKeyboardMarkup | str): Keyboard of the screen, may be serialized to JSON
+        metrics(Metrics): Registry counting transitions by kind
+    Return:
+        Message: Message showing the screen
+    """
+    query = update.callback_query
+    source = query.message
+    if source.photo:
+        if _is_photo_shown(source, photo, caption, reply_markup):
+            return _count(metrics, 'skip', source)
+        try:
+            media = InputMediaPhoto(photo, caption=caption)
+            return _count(metrics, 'edit', query.edit_message_media(media=media, reply_markup=reply_markup))
+        except BadRequest as error:
+            if is_not_modified(error):
+                return _count(metrics, 'skip', source)
+            # Broken file_id fails the sending too and is handled by the caller
+            if not isinstance(photo, str):
+                photo.seek(0)
+    message = source.reply_photo(photo, caption=caption, reply_markup=reply_markup)
+    _delete_message(query)
+    return _count(metrics, 'send', message)
+
+
+async def show_photo_async(update: Update,
+                           photo: str | BytesIO,
+                           caption: str,
+                           reply_markup: InlineKeyboardMarkup | str = None,
+                           metrics: Metrics = None) -> Message:
+    """Same as `show_photo` for async handlers."""
+    query = update.callback_query
+    source = query.message
+    if source.photo:
+        if _is_photo_shown(source, photo, caption, reply_markup):
+            return _count(metrics, 'skip', source)
+        try:
+            media = InputMediaPhoto(photo, caption=caption)
+            return _count(metrics, 'edit', await query.edit_message_media(media=media, reply_markup=reply_markup))
+        except BadRequest as error:
+            if is_not_modified(error):
+                return _count(metrics, 'skip', source)
+            if not isinstance(photo, str):
+                photo.seek(0)
+    message = await source.reply_photo(photo, caption=caption, reply_markup=reply_markup)
+    await _delete_message_async(query)
+    return _count(metrics, 'send', message)
+
+
+def get_screen_id(message: Message) -> str:
+    """Identify the screen shown by the message, it changes every time the message is edited.
+
+    Edit time has one second resolution, so the text or caption and the keyboard are a part of the ID too.
+    """
+    edited_at = int(message.edit_date.timestamp()) if message.edit_date else 0
+    content = json.dumps([message.text or message.caption, _get_markup_dict(message.reply_markup)], sort_keys=True)
+    return f'{edited_at}:{hashlib.blake2b(content.encode(), digest_size=8).hexdigest()}'
+
+
+def is_not_modified(error: BadRequest) -> bool:
+    return 'not modified' in error.message.lower()
+
+
+def _is_text_shown(source: Message, text: str, reply_markup: InlineKeyboardMarkup | str | None) -> bool:
+    return source.text == text and _is_same_markup(source.reply_markup, reply_markup)
+
+
+def _is_photo_shown(source: Message,
+                    photo: str | BytesIO,
+                    caption: str,
+                    reply_markup: InlineKeyboardMarkup | str | None) -> bool:
+    is_same_photo = isinstance(photo, str) and photo in {size.file_id for size in source.photo}
+    return is_same_photo and source.caption == caption and _is_same_markup(source.reply_markup, reply_markup)
+
+
+def _is_same_markup(markup: InlineKeyboardMarkup | str | None, other_markup: InlineKeyboardMarkup | str | None) -> bool:
+    return _get_markup_dict(markup) == _get_markup_dict(other_markup)
+
+
+def _get_markup_dict(markup: InlineKeyboardMarkup | str | None) -> dict | None:
+    if markup is None:
+        return None
+    if isinstance(markup, str):
+        return json.loads(markup)
+    return markup.to_dict()
+
+
+def _delete_message(query):
+    try:
+        query.delete_message()
+    except BadRequest:
+        # Message is too old to be deleted, user just sees both of them
+        pass
+
+
+async def _delete_message_async(query):
+    try:
+        await query.delete_message()
+    except BadRequest:
+        pass
+
+
+def _count(metrics: Metrics | None, kind: str, message: Message) -> Message:
+    if metrics:
+        metrics.inc('telegram_transitions_total', {'kind': kind})
+    return message
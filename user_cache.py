@@ -0,0 +1,332 @@
+import json
+from decimal import Decimal
+
+import aiohttp
+import requests
+
+import async_strapi_api
+from async_strapi_api import AsyncStrapiClient
+from resilience import is_not_found
+from session_store import AsyncRedisSessionStore, RedisSessionStore, Session
+from strapi_api import StrapiClient
+from strapi_api import create_ordered_product, get_cart, get_cart_total, get_or_create_cart, get_or_create_customer
+from strapi_api import parse_cart, remove_ordered_product, update_ordered_product_amount
+from write_behind import WriteBehindQueue
+
+
+def load_user_cart(strapi_client: StrapiClient, sessions: RedisSessionStore, session: Session) -> dict:
+    """Load flat cart of the user, looking it up by cart ID cached in the session first.
+
+    Falls back to lookup-or-create query if cart ID is not cached or cart was deleted in STRAPI.
+    """
+    cart_id = session.get('cart_id')
+    if cart_id:
+        try:
+            user_cart = parse_cart(get_cart(strapi_client, cart_id), strapi_client.models_config)
+            save_session_cart(session, user_cart)
+            return user_cart
+        except requests.exceptions.HTTPError as error:
+            if not is_not_found(error):
+                raise
+            sessions.delete_field(session, 'cart_id')
+    with sessions.lock(session.chat_id, 'cart_id'):
+        user_cart = get_or_create_cart(strapi_client, session.chat_id)
+        sessions.write_field(session, 'cart_id', user_cart['id'])
+    user_cart = parse_cart(user_cart, strapi_client.models_config)
+    save_session_cart(session, user_cart)
+    return user_cart
+
+
+async def load_user_cart_async(strapi_client: AsyncStrapiClient,
+                               sessions: AsyncRedisSessionStore,
+                               session: Session) -> dict:
+    """Same as `load_user_cart` for async handlers."""
+    cart_id = session.get('cart_id')
+    if cart_id:
+        try:
+            user_cart = parse_cart(await async_strapi_api.get_cart(strapi_client, cart_id), strapi_client.models_config)
+            save_session_cart(session, user_cart)
+            return user_cart
+        except aiohttp.ClientResponseError as error:
+            if not is_not_found(error):
+                raise
+            await sessions.delete_field(session, 'cart_id')
+    async with sessions.lock(session.chat_id, 'cart_id'):
+        user_cart = await async_strapi_api.get_or_create_cart(strapi_client, session.chat_id)
+        await sessions.write_field(session, 'cart_id', user_cart['id'])
+    user_cart = parse_cart(user_cart, strapi_client.models_config)
+    save_session_cart(session, user_cart)
+    return user_cart
+
+
+def get_session_cart(strapi_client: StrapiClient, sessions: RedisSessionStore, session: Session) -> dict:
+    """Get flat cart cached in the session, load it from STRAPI if it is not cached."""
+    cached_cart = session.get('cart')
+    if not cached_cart:
+        return load_user_cart(strapi_client, sessions, session)
+    return _parse_session_cart(cached_cart)
+
+
+async def get_session_cart_async(strapi_client: AsyncStrapiClient,
+                                 sessions: AsyncRedisSessionStore,
+                                 session: Session) -> dict:
+    """Same as `get_session_cart` for async handlers."""
+    cached_cart = session.get('cart')
+    if not cached_cart:
+        return await load_user_cart_async(strapi_client, sessions, session)
+    return _parse_session_cart(cached_cart)
+
+
+def _parse_session_cart(cached_cart: str) -> dict:
+    user_cart = json.loads(cached_cart)
+    user_cart['total_price'] = Decimal(user_cart['total_price'])
+    return user_cart
+
+
+def save_session_cart(session: Session, user_cart: dict):
+    session.set('cart', json.dumps(user_cart, default=str))
+
+
+def add_product_to_cart(strapi_client: StrapiClient,
+                        sessions: RedisSessionStore,
+                        session: Session,
+                        product_id: int,
+                        title: str,
+                        price: float,
+                        amount: float = 1.0,
+                        write_behind: WriteBehindQueue = None) -> dict:
+    """Add product into the user cart.
+
+    If the cart already has a line with this product, its amount is increased,
+    otherwise a new OrderedProduct is created.
+    With write-behind queue only the cart cached in the session is changed at once,
+    STRAPI is updated by the queue worker later.
+
+    Return:
+        dict: Updated flat cart
+    """
+    user_cart = get_session_cart(strapi_client, sessions, session)
+    if write_behind:
+        line = _find_product_line(user_cart, product_id)
+        if line:
+            line['amount'] += amount
+        else:
+            line = {'id': None, 'product_id': product_id, 'title': title, 'amount': amount, 'fixed_price': price}
+            user_cart['ordered_products'].append(line)
+        write_behind.set_cart_line(session.chat_id, user_cart['id'], product_id, line['amount'], price)
+        user_cart['total_price'] = get_cart_total(user_cart['ordered_products'])
+        save_session_cart(session, user_cart)
+        return user_cart
+    try:
+        _add_product_line(strapi_client, user_cart, product_id, title, price, amount)
+    except requests.exceptions.HTTPError as error:
+        # Cached cart is outdated, e.g. the line or the cart itself was deleted in STRAPI
+        if error.response is None or error.response.status_code not in (400, 404):
+            raise
+        user_cart = load_user_cart(strapi_client, sessions, session)
+        _add_product_line(strapi_client, user_cart, product_id, title, price, amount)
+    user_cart['total_price'] = get_cart_total(user_cart['ordered_products'])
+    save_session_cart(session, user_cart)
+    return user_cart
+
+
+async def add_product_to_cart_async(strapi_client: AsyncStrapiClient,
+                                    sessions: AsyncRedisSessionStore,
+                                    session: Session,
+                                    product_id: int,
+                                    title: str,
+                                    price: float,
+                                    amount: float = 1.0) -> dict:
+    """Same as `add_product_to_cart` for async handlers, STRAPI is always updated at once."""
+    user_cart = await get_session_cart_async(strapi_client, sessions, session)
+    try:
+        await _add_product_line_async(strapi_client, user_cart, product_id, title, price, amount)
+    except aiohttp.ClientResponseError as error:
+        if error.status not in (400, 404):
+            raise
+        user_cart = await load_user_cart_async(strapi_client, sessions, session)
+        await _add_product_line_async(strapi_client, user_cart, product_id, title, price, amount)
+    user_cart['total_price'] = get_cart_total(user_cart['ordered_products'])
+    save_session_cart(session, user_cart)
+    return user_cart
+
+
+def remove_product_from_cart(strapi_client: StrapiClient,
+                             sessions: RedisSessionStore,
+                             session: Session,
+                             product_id: int,
+                             write_behind: WriteBehindQueue = None) -> dict:
+    """Remove lines of the product from the user cart.
+
+    Carts filled before lines were incremented may have several lines of a product, all of them are removed.
+
+    Return:
+        dict: Updated flat cart
+    """
+    user_cart = get_session_cart(strapi_client, sessions, session)
+    lines = [line for line in user_cart['ordered_products'] if line['product_id'] == product_id]
+    if not lines:
+        return user_cart
+    if write_behind:
+        write_behind.set_cart_line(session.chat_id, user_cart['id'], product_id, 0)
+    else:
+        for line in lines:
+            if line['id']:
+                _remove_ordered_product(strapi_client, line['id'])
+    return _save_cart_without(session, user_cart, lines)
+
+
+async def remove_product_from_cart_async(strapi_client: AsyncStrapiClient,
+                                         sessions: AsyncRedisSessionStore,
+                                         session: Session,
+                                         product_id: int) -> dict:
+    """Same as `remove_product_from_cart` for async handlers, STRAPI is always updated at once."""
+    user_cart = await get_session_cart_async(strapi_client, sessions, session)
+    lines = [line for line in user_cart['ordered_products'] if line['product_id'] == product_id]
+    for line in lines:
+        if line['id']:
+            await _remove_ordered_product_async(strapi_client, line['id'])
+    return _save_cart_without(session, user_cart, lines)
+
+
+def remove_ordered_product_from_cart(strapi_client: StrapiClient,
+                                     sessions: RedisSessionStore,
+                                     session: Session,
+                                     ordered_product_id: int | str) -> dict:
+    """Remove a single line from the user cart by OrderedProduct ID, e.g. a line of a product deleted from STRAPI.
+
+    Line is removed from STRAPI at once even with write-behind queue, since the queue tracks lines by product.
+
+    Return:
+        dict: Updated flat cart
+    """
+    user_cart = get_session_cart(strapi_client, sessions, session)
+    _remove_ordered_product(strapi_client, ordered_product_id)
+    lines = [line for line in user_cart['ordered_products'] if str(line['id']) == str(ordered_product_id)]
+    return _save_cart_without(session, user_cart, lines)
+
+
+async def remove_ordered_product_from_cart_async(strapi_client: AsyncStrapiClient,
+                                                 sessions: AsyncRedisSessionStore,
+                                                 session: Session,
+                                                 ordered_product_id: int | str) -> dict:
+    """Same as `remove_ordered_product_from_cart` for async handlers."""
+    user_cart = await get_session_cart_async(strapi_client, sessions, session)
+    await _remove_ordered_product_async(strapi_client, ordered_product_id)
+    lines = [line for line in user_cart['ordered_products'] if str(line['id']) == str(ordered_product_id)]
+    return _save_cart_without(session, user_cart, lines)
+
+
+def _remove_ordered_product(strapi_client: StrapiClient, ordered_product_id: int | str):
+    try:
+        remove_ordered_product(strapi_client, ordered_product_id)
+    except requests.exceptions.HTTPError as error:
+        if not is_not_found(error):
+            raise
+
+
+async def _remove_ordered_product_async(strapi_client: AsyncStrapiClient, ordered_product_id: int | str):
+    try:
+        await async_strapi_api.remove_ordered_product(strapi_client, ordered_product_id)
+    except aiohttp.ClientResponseError as error:
+        if not is_not_found(error):
+            raise
+
+
+def _save_cart_without(session: Session, user_cart: dict, lines: list[dict]) -> dict:
+    user_cart['ordered_products'] = [line for line in user_cart['ordered_products'] if line not in lines]
+    user_cart['total_price'] = get_cart_total(user_cart['ordered_products'])
+    save_session_cart(session, user_cart)
+    return user_cart
+
+
+def _find_product_line(user_cart: dict, product_id: int) -> dict | None:
+    for line in user_cart['ordered_products']:
+        if line['product_id'] == product_id:
+            return line
+    return None
+
+
+def _add_product_line(strapi_client: StrapiClient,
+                      user_cart: dict,
+                      product_id: int,
+                      title: str,
+                      price: float,
+                      amount: float):
+    line = _find_product_line(user_cart, product_id)
+    if line:
+        update_ordered_product_amount(strapi_client, line['id'], line['amount'] + amount)
+        line['amount'] += amount
+        return
+    ordered_product = create_ordered_product(strapi_client,
+                                             product_id,
+                                             cart_id=user_cart['id'],
+                                             amount=amount,
+                                             fixed_price=price)
+    _append_product_line(user_cart, ordered_product['id'], product_id, title, price, amount)
+
+
+async def _add_product_line_async(strapi_client: AsyncStrapiClient,
+                                  user_cart: dict,
+                                  product_id: int,
+                                  title: str,
+                                  price: float,
+                                  amount: float):
+    line = _find_product_line(user_cart, product_id)
+    if line:
+        await async_strapi_api.update_ordered_product_amount(strapi_client, line['id'], line['amount'] + amount)
+        line['amount'] += amount
+        return
+    ordered_product = await async_strapi_api.create_ordered_product(strapi_client,
+                                                                    product_id,
+                                                                    cart_id=user_cart['id'],
+                                                                    amount=amount,
+                                                                    fixed_price=price)
+    _append_product_line(user_cart, ordered_product['id'], product_id, title, price, amount)
+
+
+def _append_product_line(user_cart: dict,
+                         ordered_product_id: int,
+                         product_id: int,
+                         title: str,
+                         price: float,
+                         amount: float):
+    user_cart['ordered_products'].append({
+        'id': ordered_product_id,
+        'product_id': product_id,
+        'title': title,
+        'amount': amount,
+        'fixed_price': price,
+    })
+
+
+def get_user_customer_id(strapi_client: StrapiClient, sessions: RedisSessionStore, session: Session) -> str:
+    return _get_user_entity_id(sessions,
+                               session,
+                               'customer_id',
+                               lambda: get_or_create_customer(strapi_client, session.chat_id))
+
+
+async def get_user_customer_id_async(strapi_client: AsyncStrapiClient,
+                                     sessions: AsyncRedisSessionStore,
+                                     session: Session) -> str:
+    """Same as `get_user_customer_id` for async handlers."""
+    customer_id = session.get('customer_id')
+    if customer_id:
+        return customer_id
+    async with sessions.lock(session.chat_id, 'customer_id'):
+        customer_id = await sessions.read_field(session.chat_id, 'customer_id')
+        if not customer_id:
+            customer_id = (await async_strapi_api.get_or_create_customer(strapi_client, session.chat_id))['id']
+        await sessions.write_field(session, 'customer_id', customer_id)
+    return str(customer_id)
+
+
+def _get_user_entity_id(sessions: RedisSessionStore, session: Session, field: str, get_or_create) -> str:
+    entity_id = session.get(field)
+    if entity_id:
+        return entity_id
+    with sessions.lock(session.chat_id, field):
+        entity_id = sessions.read_field(session.chat_id, field) or get_or_create()['id']
+        sessions.write_field(session, field, entity_id)
+    return str(entity_id)
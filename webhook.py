@@ -0,0 +1,148 @@
+import hmac
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+from telegram import Bot, Update
+
+from sharding import StreamUpdateProducer
+
+logger = logging.getLogger(__name__)
+
+
+class ChatOrderedWorkerPool:
+    """Pool of workers processing updates from bounded queues.
+
+    All updates of a chat go to the same worker, so they are processed
+    in the order they were received.
+
+    Args:
+        handle_update(Callable): Function processing a single update, e.g. `dispatcher.process_update`.
+        workers(int): Number of worker threads.
+        queue_size(int): Max number of updates waiting in the queue of each worker.
+        put_timeout(float): How long to wait for a free slot in a full queue before rejecting an update.
+    """
+
+    def __init__(self,
+                 handle_update: Callable[[Update], None],
+                 workers: int = 4,
+                 queue_size: int = 100,
+                 put_timeout: float = 5):
+        self.handle_update = handle_update
+        self.queue_size = queue_size
+        self.put_timeout = put_timeout
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for worker_number, updates_queue in enumerate(self.queues):
+            thread = threading.Thread(target=self._work,
+                                      args=(updates_queue,),
+                                      name=f'update-worker-{worker_number}',
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for updates_queue in self.queues:
+            updates_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def put(self, update: Update) -> bool:
+        """Put update into the queue of its chat worker.
+
+        Return:
+            bool: False if the queue stayed full for `put_timeout` seconds and update was rejected.
+        """
+        chat_id = update.effective_chat.id if update.effective_chat else update.update_id
+        updates_queue = self.queues[chat_id % len(self.queues)]
+        try:
+            updates_queue.put(update, timeout=self.put_timeout)
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.accepted += 1
+        return True
+
+    def stats(self) -> dict:
+        queued = [updates_queue.qsize() for updates_queue in self.queues]
+        with self._lock:
+            return {
+                'queued': sum(queued),
+                'max_worker_queued': max(queued),
+                'capacity': self.queue_size * len(self.queues),
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'processed': self.processed,
+                'failed': self.failed,
+            }
+
+    def _work(self, updates_queue: queue.Queue):
+        while True:
+            update = updates_queue.get()
+            if update is None:
+                return
+            try:
+                self.handle_update(update)
+                with self._lock:
+                    self.processed += 1
+            except Exception:
+                logger.exception('Update %s processing failed', update.update_id)
+                with self._lock:
+                    self.failed += 1
+
+
+def get_webhook_server(bot: Bot,
+                       worker_pool: ChatOrderedWorkerPool | StreamUpdateProducer,
+                       secret_token: str,
+                       listen: str = '0.0.0.0',
+                       port: int = 8443,
+                       url_path: str = 'telegram') -> ThreadingHTTPServer:
+    """Create HTTP server receiving Telegram updates into the worker pool.
+
+    Updates are accepted by POST at `/<url_path>`. Metrics are not served here, the server is public.
+    Only requests with `secret_token` passed to `set_webhook` in `X-Telegram-Bot-Api-Secret-Token` header
+    are accepted, others are rejected with 403, so updates can't be forged by anyone reaching the server.
+    Updates go to the worker pool of this process or, in sharded deployment, to Redis streams of worker processes.
+    If the pool is full, server responds with 503 and Telegram delivers the update later.
+    """
+    webhook_path = f'/{url_path.strip("/")}'
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != webhook_path:
+                self.send_error(404)
+                return
+            request_token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(request_token.encode(), secret_token.encode()):
+                self.send_error(403)
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            try:
+                update = Update.de_json(json.loads(body), bot)
+            except ValueError:
+                self.send_error(400)
+                return
+            if update is None or not worker_pool.put(update):
+                self.send_error(503)
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return ThreadingHTTPServer((listen, port), WebhookHandler)
@@ -0,0 +1,316 @@
+import json
+import logging
+import threading
+import uuid
+
+import redis
+import requests
+
+from metrics import Metrics
+from session_store import RedisSessionStore
+from strapi_api import StrapiClient
+from strapi_api import create_ordered_product, get_cart, get_or_create_cart, get_or_create_customer, parse_cart
+from strapi_api import remove_ordered_product, save_customer_email, update_ordered_product_amount
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """Journal of cart and checkout writes flushed to STRAPI in background.
+
+    Mutations are pushed into a Redis list and acknowledged immediately.
+    A worker thread moves them in batches into a processing list,
+    applies them to STRAPI and removes them after success, so after a restart
+    unfinished mutations are returned into the journal and nothing is lost.
+
+    Journal is split into shards by chat the same way updates are. Each shard is flushed
+    only by the worker owning it, so mutations of a cart are applied in order and never concurrently.
+
+    Cart mutations carry the resulting amount of a product line instead of a delta,
+    so applying one twice is harmless and only the last mutation of a line in a batch is sent.
+    Each mutation has an idempotency key, applied keys are remembered for `applied_ttl` seconds
+    and skipped if the mutation comes again.
+
+    Args:
+        redis_db(redis.Redis): Redis connection
+        strapi_client(StrapiClient): STRAPI client
+        sessions(RedisSessionStore): Sessions where customer and cart IDs found by the worker are cached.
+        namespace(str): Prefix of Redis keys.
+        shards(int): Number of journal shards.
+        worker_shards(list): Shards flushed by this worker, all by default.
+        batch_size(int): Max number of mutations flushed at once.
+        flush_interval(float): Seconds to wait for new mutations when the journal is empty.
+        max_attempts(int): Failed mutation is moved into dead letter list after this number of attempts.
+        retry_delay(float): Seconds to wait after a failed flush, doubled on every next failure.
+        applied_ttl(int): Seconds to remember idempotency keys of applied mutations.
+        metrics(Metrics): Registry for flush timings.
+    """
+
+    def __init__(self,
+                 redis_db: redis.Redis,
+                 strapi_client: StrapiClient,
+                 sessions: RedisSessionStore,
+                 namespace: str = 'fish_shop',
+                 shards: int = 1,
+                 worker_shards: list[int] = None,
+                 batch_size: int = 50,
+                 flush_interval: float = 0.5,
+                 max_attempts: int = 5,
+                 retry_delay: float = 1,
+                 applied_ttl: int = 24 * 60 * 60,
+                 metrics: Metrics = None):
+        self.redis_db = redis_db
+        self.strapi_client = strapi_client
+        self.sessions = sessions
+        self.namespace = namespace
+        self.shards = shards
+        self.worker_shards = list(range(shards)) if worker_shards is None else worker_shards
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.applied_ttl = applied_ttl
+        self.metrics = metrics or Metrics()
+        self.dead_key = f'{namespace}:write_behind:dead'
+        self.flushed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def set_cart_line(self,
+                      chat_id: int | str,
+                      cart_id: int | str,
+                      product_id: int,
+                      amount: float,
+                      fixed_price: float = None):
+        """Journal the amount a product line of the cart should have, zero amount removes the line."""
+        self.enqueue({
+            'type': 'set_cart_line',
+            'chat_id': chat_id,
+            'cart_id': cart_id,
+            'product_id': product_id,
+            'amount': amount,
+            'fixed_price': fixed_price,
+        })
+
+    def save_email(self, chat_id: int | str, email: str, customer_id: int | str = None):
+        """Journal email of the customer placing an order."""
+        self.enqueue({
+            'type': 'save_email',
+            'chat_id': chat_id,
+            'customer_id': customer_id,
+            'email': email,
+        })
+
+    def enqueue(self, mutation: dict):
+        mutation = {'id': uuid.uuid4().hex, 'attempts': 0, **mutation}
+        shard = int(mutation['chat_id']) % self.shards
+        self.redis_db.lpush(self.get_journal_key(shard), json.dumps(mutation, default=str))
+
+    def get_journal_key(self, shard: int) -> str:
+        return f'{self.namespace}:write_behind:journal:{shard}'
+
+    def get_processing_key(self, shard: int) -> str:
+        return f'{self.namespace}:write_behind:processing:{shard}'
+
+    def start(self):
+        self.recover()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._work, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the worker after it flushes the current batch."""
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def recover(self):
+        """Return mutations left in processing lists by a stopped worker into the head of journals."""
+        for shard in self.worker_shards:
+            while self.redis_db.lmove(self.get_processing_key(shard), self.get_journal_key(shard), 'LEFT', 'RIGHT'):
+                pass
+
+    def flush(self) -> int:
+        """Apply the next batch of mutations of every shard of the worker to STRAPI.
+
+        Return:
+            int: Number of mutations taken from journals
+        """
+        return sum(self._flush_shard(shard) for shard in self.worker_shards)
+
+    def _flush_shard(self, shard: int) -> int:
+        journal_key = self.get_journal_key(shard)
+        processing_key = self.get_processing_key(shard)
+        pipeline = self.redis_db.pipeline(transaction=False)
+        for _ in range(self.batch_size):
+            pipeline.rpoplpush(journal_key, processing_key)
+        raw_mutations = [raw_mutation for raw_mutation in pipeline.execute() if raw_mutation]
+        if not raw_mutations:
+            return 0
+        try:
+            with self.metrics.timer('write_behind_flush_seconds'):
+                failed = self._apply(raw_mutations)
+        except Exception:
+            # Batch left in the processing list would wait for a restart, so it is retried as failed
+            logger.exception('Write-behind flush of shard %s failed', shard)
+            failed = raw_mutations
+        pipeline = self.redis_db.pipeline(transaction=False)
+        for raw_mutation in raw_mutations:
+            pipeline.lrem(processing_key, 1, raw_mutation)
+        # Failed mutations go back to the head of the journal keeping their order
+        for raw_mutation in reversed(failed):
+            mutation = json.loads(raw_mutation)
+            mutation['attempts'] += 1
+            if mutation['attempts'] >= self.max_attempts:
+                logger.error('Write-behind mutation %s is moved to dead letters', mutation['id'])
+                pipeline.lpush(self.dead_key, json.dumps(mutation))
+            else:
+                pipeline.rpush(journal_key, json.dumps(mutation))
+        pipeline.execute()
+        with self._lock:
+            self.flushed += len(raw_mutations) - len(failed)
+            self.failed += len(failed)
+        self.metrics.inc('write_behind_mutations_total', {'status': 'flushed'}, len(raw_mutations) - len(failed))
+        if failed:
+            self.metrics.inc('write_behind_mutations_total', {'status': 'failed'}, len(failed))
+        return len(raw_mutations)
+
+    def stats(self) -> dict:
+        pipeline = self.redis_db.pipeline(transaction=False)
+        for shard in self.worker_shards:
+            pipeline.llen(self.get_journal_key(shard))
+            pipeline.llen(self.get_processing_key(shard))
+        pipeline.llen(self.dead_key)
+        *lengths, dead = pipeline.execute()
+        with self._lock:
+            return {
+                'pending': sum(lengths[::2]),
+                'processing': sum(lengths[1::2]),
+                'dead': dead,
+                'flushed': self.flushed,
+                'failed': self.failed,
+            }
+
+    def _work(self):
+        failures = 0
+        while not self._stopped.is_set():
+            failed_before = self.failed
+            try:
+                taken = self.flush()
+                failures = failures + 1 if self.failed > failed_before else 0
+            except Exception:
+                logger.exception('Write-behind flush failed')
+                failures += 1
+                taken = 0
+            if failures:
+                self._stopped.wait(self.retry_delay * 2 ** (failures - 1))
+            elif not taken:
+                self._stopped.wait(self.flush_interval)
+
+    def _apply(self, raw_mutations: list[str]) -> list[str]:
+        """Apply mutations in journal order and return the raw ones that failed.
+
+        Mutations overridden by a later one of the same cart line or customer are dropped.
+        """
+        mutations = [json.loads(raw_mutation) for raw_mutation in raw_mutations]
+        applied = self.redis_db.pipeline(transaction=False)
+        for mutation in mutations:
+            applied.exists(self._get_applied_key(mutation))
+        already_applied = applied.execute()
+
+        cart_lines = {}
+        emails = {}
+        for raw_mutation, mutation, is_applied in zip(raw_mutations, mutations, already_applied):
+            if is_applied:
+                continue
+            if mutation['type'] == 'set_cart_line':
+                key = (mutation['chat_id'], mutation['cart_id'])
+                cart_lines.setdefault(key, {})[mutation['product_id']] = (raw_mutation, mutation)
+            elif mutation['type'] == 'save_email':
+                emails[mutation['chat_id']] = (raw_mutation, mutation)
+
+        failed = []
+        applied = self.redis_db.pipeline(transaction=False)
+        for (chat_id, cart_id), lines in cart_lines.items():
+            try:
+                self._apply_cart_lines(chat_id, cart_id, [mutation for _, mutation in lines.values()])
+            except requests.exceptions.RequestException:
+                logger.exception('Write-behind flush of cart %s failed', cart_id)
+                failed += [raw_mutation for raw_mutation, _ in lines.values()]
+                continue
+            for _, mutation in lines.values():
+                applied.set(self._get_applied_key(mutation), 1, ex=self.applied_ttl)
+        for raw_mutation, mutation in emails.values():
+            try:
+                self._apply_email(mutation)
+            except requests.exceptions.RequestException:
+                logger.exception('Write-behind flush of customer %s email failed', mutation['chat_id'])
+                failed.append(raw_mutation)
+                continue
+            applied.set(self._get_applied_key(mutation), 1, ex=self.applied_ttl)
+        applied.execute()
+        return failed
+
+    def _apply_cart_lines(self, chat_id: int | str, cart_id: int | str, mutations: list[dict]):
+        try:
+            cart = get_cart(self.strapi_client, cart_id)
+        except requests.exceptions.HTTPError as error:
+            if error.response is None or error.response.status_code != 404:
+                raise
+            cart = self._replace_deleted_cart(chat_id)
+        user_cart = parse_cart(cart, self.strapi_client.models_config)
+        # Carts filled before lines were incremented may have several lines of a product
+        lines = {}
+        for line in user_cart['ordered_products']:
+            lines.setdefault(line['product_id'], []).append(line)
+        for mutation in mutations:
+            product_lines = lines.get(mutation['product_id'], [])
+            line = product_lines[0] if product_lines else None
+            if mutation['amount'] <= 0:
+                for product_line in product_lines:
+                    remove_ordered_product(self.strapi_client, product_line['id'])
+            elif not line:
+                create_ordered_product(self.strapi_client,
+                                       mutation['product_id'],
+                                       cart_id=user_cart['id'],
+                                       amount=mutation['amount'],
+                                       fixed_price=mutation['fixed_price'])
+            elif line['amount'] != mutation['amount']:
+                update_ordered_product_amount(self.strapi_client, line['id'], mutation['amount'])
+
+    def _replace_deleted_cart(self, chat_id: int | str) -> dict:
+        """Get or create cart of the user instead of the deleted one and cache its ID in the session.
+
+        Cart cached in the session is dropped, so the next handler loads the new cart.
+        """
+        session = self.sessions.load(chat_id)
+        with self.sessions.lock(chat_id, 'cart_id'):
+            cart = get_or_create_cart(self.strapi_client, chat_id)
+            self.sessions.write_field(session, 'cart_id', cart['id'])
+            self.sessions.delete_field(session, 'cart')
+        return cart
+
+    def _apply_email(self, mutation: dict):
+        customer_id = mutation['customer_id']
+        if customer_id:
+            try:
+                save_customer_email(self.strapi_client, customer_id, mutation['email'])
+                return
+            except requests.exceptions.HTTPError as error:
+                if error.response is None or error.response.status_code != 404:
+                    raise
+        chat_id = mutation['chat_id']
+        session = self.sessions.load(chat_id)
+        with self.sessions.lock(chat_id, 'customer_id'):
+            # Customer may be already found by an earlier flush or by a handler
+            cached_customer_id = self.sessions.read_field(chat_id, 'customer_id')
+            if not cached_customer_id or cached_customer_id == str(customer_id):
+                cached_customer_id = get_or_create_customer(self.strapi_client, chat_id)['id']
+                self.sessions.write_field(session, 'customer_id', cached_customer_id)
+        save_customer_email(self.strapi_client, cached_customer_id, mutation['email'])
+
+    def _get_applied_key(self, mutation: dict) -> str:
+        return f'{self.namespace}:write_behind:applied:{mutation["id"]}'